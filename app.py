@@ -3,26 +3,44 @@ from dotenv import load_dotenv
 load_dotenv()
 import streamlit as st
 import os
-import datetime
-import json
 import base64
 import tempfile
-import threading
 import html
+import uuid
 from io import BytesIO
 from PIL import Image
-from utils.ui_components import render_voice_command_ui, render_floating_voice_button
+from utils.ui_components import render_voice_command_ui, render_floating_voice_button, render_fanout_panel, render_provider_health
 from utils.themes import apply_theme, THEMES
 from utils.emoji_picker import render_emoji_gif_picker, add_to_message_input
 from utils.models import (
-    get_gemini_response,
-    get_vertex_ai_response,
-    get_openai_response,
-    get_anthropic_response,
-    get_perplexity_response
+    get_model_response,
+    stream_model_response,
+    supports_streaming,
+    parse_model_option,
+    MODEL_OPTIONS
 )
+from utils.context import build_context
+from utils.memory import new_memory_state, schedule_summary, collect_summary, apply_summary
+from utils.fanout import FanOutRun
+from utils.resilience import ProviderError, CallCancelledError, get_provider_health
+from utils.rate_limit import get_rate_limit_stats
+from utils.images import prepare_image
+from utils.call_context import call_scope, cancel_calls
+from utils.prompt_cache import get_cache_stats
+from utils.streaming import get_stream_stats
+from utils.single_flight import get_single_flight_stats
+from utils.routing import get_routing_stats
+from utils.key_pool import get_key_pool_stats
+from utils.usage import get_user_spend, get_user_budget
+from utils.history_cache import get_history_cache_stats
+from utils.vertex_regions import get_region_stats
+from utils.drafts import DraftCheckpointer, draft_message, is_unfinished, continuation_history, CONTINUE_PROMPT
 from utils.auth import check_login, logout_user
-from utils.database import init_db, save_conversation, load_conversations, get_most_recent_chat
+from utils.database import init_db, save_conversation, get_most_recent_chat
+
+# Newest messages drawn in the transcript; older ones are loaded a page at a time
+TRANSCRIPT_WINDOW = int(os.environ.get("TRANSCRIPT_WINDOW", "40"))
+TRANSCRIPT_PAGE = int(os.environ.get("TRANSCRIPT_PAGE", "40"))
 
 # Set page configuration
 st.set_page_config(
@@ -45,8 +63,31 @@ if "uploaded_image" not in st.session_state:
     st.session_state.uploaded_image = None
 if "send_message_cooldown" not in st.session_state:
     st.session_state.send_message_cooldown = False
+# Text of a message sent from the message box, until the transcript answers it
+if "pending_reply" not in st.session_state:
+    st.session_state.pending_reply = None
+# How many of the newest messages the transcript draws
+if "transcript_window" not in st.session_state:
+    st.session_state.transcript_window = TRANSCRIPT_WINDOW
 if "last_sent_time" not in st.session_state:
     st.session_state.last_sent_time = None
+if "last_error" not in st.session_state:
+    st.session_state.last_error = None
+    
+# Rolling summary memory for long conversations
+if "chat_memory" not in st.session_state:
+    st.session_state.chat_memory = new_memory_state()
+# Stable identifier for the current conversation (summary jobs, prompt cache stats)
+if "conversation_key" not in st.session_state:
+    st.session_state.conversation_key = str(uuid.uuid4())
+    
+# Multi-model comparison state
+if "compare_mode" not in st.session_state:
+    st.session_state.compare_mode = False
+if "compare_models" not in st.session_state:
+    st.session_state.compare_models = []
+if "fanout_run" not in st.session_state:
+    st.session_state.fanout_run = None
     
 # Voice command state variables
 if "voice_commands_active" not in st.session_state:
@@ -205,19 +246,808 @@ check_login()
 # Helper function to encode image for API calls
 def encode_image(uploaded_file):
     if uploaded_file is not None:
-        # Read the file and encode it
-        bytes_data = uploaded_file.getvalue()
+        # Reuse the previous encoding while the same upload stays selected
+        upload_id = getattr(uploaded_file, "file_id", None) or f"{uploaded_file.name}:{uploaded_file.size}"
+        cached = st.session_state.get("encoded_upload")
+        if cached and cached[0] == upload_id:
+            return cached[1]
         
-        # Convert to base64
-        encoded = base64.b64encode(bytes_data).decode('utf-8')
+        # Downsize and re-encode once so large phone photos are not stored or sent at full size
+        encoded = prepare_image(uploaded_file.getvalue(), "storage").base64
+        st.session_state.encoded_upload = (upload_id, encoded)
         return encoded
     return None
 
+def pick_fanout_answer(model_option, response):
+    """Keep the chosen comparison answer and drop the rest."""
+    st.session_state.messages.append({"role": "assistant", "content": response, "model": model_option})
+    st.session_state.fanout_run = None
+    save_conversation(
+        st.session_state.user,
+        st.session_state.current_model,
+        st.session_state.messages,
+        memory=st.session_state.chat_memory
+    )
+    st.rerun()
+
+def user_bubble(content):
+    """HTML for a user message in the transcript."""
+    return f"""
+    <div class="user-message">
+        <div class="avatar user-avatar">👤</div>
+        <div class="message-bubble user-bubble">
+            <p class="message-text">{html.escape(content).replace(chr(10), '<br>')}</p>
+        </div>
+    </div>
+    """
+
+def assistant_bubble(content, cursor=False):
+    """HTML for an AI message in the transcript, with a typing cursor while it streams."""
+    return f"""
+    <div class="ai-message">
+        <div class="avatar">🤖</div>
+        <div class="message-bubble">
+            <p class="message-text">{html.escape(content).replace(chr(10), '<br>')}{"▌" if cursor else ""}</p>
+        </div>
+    </div>
+    """
+
+def keep_partial_answer(chunks):
+    """Save what streamed before a generation was stopped, marked as cancelled."""
+    if not chunks:
+        # Nothing arrived: take the turn back, as for a failed call
+        st.session_state.messages.pop()
+        return
+    st.session_state.messages.append({"role": "assistant", "content": "".join(chunks), "cancelled": True})
+    st.session_state.uploaded_image = None
+    save_conversation(
+        st.session_state.user,
+        st.session_state.current_model,
+        st.session_state.messages,
+        memory=st.session_state.chat_memory
+    )
+
+def save_draft(messages, text):
+    """Checkpoint a streaming answer to the conversation store as a draft, leaving the transcript alone."""
+    save_conversation(
+        st.session_state.user,
+        st.session_state.current_model,
+        messages + [draft_message(text)],
+        memory=st.session_state.chat_memory
+    )
+
+def collect_memory():
+    """Swap in any finished background summary, showing a failed one as an error."""
+    try:
+        collect_summary(st.session_state.conversation_key, st.session_state.chat_memory)
+    except Exception as e:
+        st.session_state.last_error = f"Could not summarize earlier messages: {e}"
+
+def switch_model():
+    """Use the model picked in the settings; a real switch stops generation still running for this conversation."""
+    selected = st.session_state.model_select
+    if selected != st.session_state.current_model:
+        st.session_state.current_model = selected
+        cancel_calls(st.session_state.conversation_key, "model switched")
+
+def continue_answer():
+    """Ask the model to finish the interrupted answer at the end of the transcript."""
+    partial = st.session_state.messages[-1]
+    earlier = st.session_state.messages[:-1]
+    _, model_call_sign = parse_model_option(st.session_state.current_model)
+    history = continuation_history(apply_summary(st.session_state.messages, st.session_state.chat_memory))
+    context_messages = build_context(history, model_call_sign or st.session_state.current_model)
+    checkpointer = DraftCheckpointer(lambda text: save_draft(earlier, partial["content"] + text))
+    response_placeholder = st.empty()
+    chunks = []
+    stopped = None
+
+    def finish():
+        # Replace the partial answer with everything so far, still marked if it stopped again
+        answer = {key: value for key, value in partial.items() if key not in ("draft", "cancelled")}
+        answer["content"] = partial["content"] + "".join(chunks)
+        if stopped is not None:
+            answer["cancelled"] = True
+        st.session_state.messages[-1] = answer
+        save_conversation(
+            st.session_state.user,
+            st.session_state.current_model,
+            st.session_state.messages,
+            memory=st.session_state.chat_memory
+        )
+
+    with call_scope(conversation_id=st.session_state.conversation_key, user=st.session_state.user):
+        stream = stream_model_response(
+            st.session_state.current_model,
+            CONTINUE_PROMPT,
+            context_messages,
+            temperature=st.session_state.temperature
+        )
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                checkpointer.update("".join(chunks))
+                response_placeholder.markdown(partial["content"] + "".join(chunks) + "▌")
+        except ProviderError as e:
+            stopped = e
+            st.session_state.last_error = f"Could not continue the answer: {e}"
+        except BaseException:
+            stream.close()
+            stopped = True
+            if chunks:
+                finish()
+            raise
+        finally:
+            stream.close()
+    response_placeholder.empty()
+    if chunks or stopped is None:
+        finish()
+    st.rerun(scope="fragment")
+
+@st.fragment(run_every=0.5)
+def fanout_panel():
+    """Poll the running comparison and redraw only its panes."""
+    run = st.session_state.fanout_run
+    if run is None:
+        return
+    render_fanout_panel(run, pick_fanout_answer)
+    if run.is_done() and st.button("Dismiss comparison", key="fanout_dismiss"):
+        st.session_state.fanout_run = None
+        st.rerun()
+    elif not run.is_done() and st.button("Stop remaining models", key="fanout_stop"):
+        run.cancel()
+
+def reply_to(user_input):
+    """
+    Answer the user message at the end of the transcript, streaming into its bubble.
+    
+    Runs inside the transcript fragment, so the reply is drawn in place and
+    a completed turn needs no further rerun.
+    """
+    user_message = st.session_state.messages[-1]
+    
+    # In compare mode, send the turn to every selected model at once
+    if st.session_state.compare_mode and len(st.session_state.compare_models) > 1:
+        if st.session_state.fanout_run:
+            st.session_state.fanout_run.cancel()
+        collect_memory()
+        with call_scope(conversation_id=st.session_state.conversation_key, user=st.session_state.user):
+            st.session_state.fanout_run = FanOutRun(
+                user_input,
+                apply_summary(st.session_state.messages, st.session_state.chat_memory),
+                st.session_state.compare_models,
+                image_data=user_message.get("image"),
+                audio_data=user_message.get("audio"),
+                temperature=st.session_state.temperature
+            )
+        st.session_state.uploaded_image = None
+        st.rerun()
+
+    # The answer fills its bubble below the transcript as it arrives
+    response_placeholder = st.empty()
+    stop_placeholder = st.empty()
+
+    # Get AI response based on selected model
+    completed = False
+    with call_scope(conversation_id=st.session_state.conversation_key, user=st.session_state.user):
+        try:
+            image_data = user_message.get("image")
+            
+            # Resolve the provider and model call sign for the selected option
+            _, model_call_sign = parse_model_option(st.session_state.current_model)
+            
+            # Swap in any finished background summary for the older turns
+            collect_memory()
+            history = apply_summary(st.session_state.messages, st.session_state.chat_memory)
+            
+            # Only send the newest history that fits the model's token budget
+            context_messages = build_context(history, model_call_sign or st.session_state.current_model)
+            
+            cancelled = False
+            if supports_streaming(st.session_state.current_model):
+                # Render streaming models progressively as chunks arrive
+                response_placeholder.markdown(assistant_bubble("", cursor=True), unsafe_allow_html=True)
+                # Clicking Stop (like changing any widget or closing the tab)
+                # interrupts this script run, which cancels the upstream stream
+                stop_placeholder.button("⏹ Stop generating", key="stop_generating")
+                stream = stream_model_response(
+                    st.session_state.current_model,
+                    user_input,
+                    context_messages,
+                    image_data=image_data,
+                    audio_data=user_message.get("audio"),
+                    temperature=st.session_state.temperature
+                )
+                chunks = []
+                # Save the partial answer as a draft every few tokens, so a dead
+                # session leaves something to continue from
+                checkpointer = DraftCheckpointer(
+                    lambda text: save_draft(st.session_state.messages, text)
+                )
+                try:
+                    for chunk in stream:
+                        chunks.append(chunk)
+                        partial_answer = "".join(chunks)
+                        checkpointer.update(partial_answer)
+                        response_placeholder.markdown(assistant_bubble(partial_answer, cursor=True), unsafe_allow_html=True)
+                except CallCancelledError as e:
+                    # Deadline passed or cancelled from another run: keep what arrived
+                    cancelled = True
+                    if not chunks:
+                        st.session_state.last_error = f"Generation stopped: {e.reason}"
+                except ProviderError as e:
+                    if not chunks:
+                        raise
+                    # The provider failed mid-answer: keep what arrived so it can be continued
+                    cancelled = True
+                    st.session_state.last_error = str(e)
+                except BaseException:
+                    # Streamlit stopped this run; save the partial answer on the way out
+                    stream.close()
+                    keep_partial_answer(chunks)
+                    raise
+                finally:
+                    stream.close()
+                stop_placeholder.empty()
+                ai_response = "".join(chunks)
+            else:
+                with st.spinner(f"Thinking... using {st.session_state.current_model}"):
+                    ai_response = get_model_response(
+                        st.session_state.current_model,
+                        user_input,
+                        context_messages,
+                        image_data=image_data,
+                        audio_data=user_message.get("audio"),
+                        temperature=st.session_state.temperature
+                    )
+            
+            if cancelled:
+                keep_partial_answer(chunks)
+            else:
+                # Add AI response to chat
+                st.session_state.messages.append({"role": "assistant", "content": ai_response})
+                
+                # Clear uploaded image after processing
+                st.session_state.uploaded_image = None
+                
+                # Summarize older turns in the background once the chat grows long
+                schedule_summary(
+                    st.session_state.conversation_key,
+                    st.session_state.messages,
+                    st.session_state.chat_memory
+                )
+                
+                # Save conversation to database
+                save_conversation(
+                    st.session_state.user,
+                    st.session_state.current_model,
+                    st.session_state.messages,
+                    memory=st.session_state.chat_memory
+                )
+                
+                # The finished answer stays in its bubble; no redraw of the page is needed
+                response_placeholder.markdown(assistant_bubble(ai_response), unsafe_allow_html=True)
+                completed = True
+            
+        except ProviderError as e:
+            # Provider failures are not answers: take the turn back and show the error
+            st.session_state.messages.pop()
+            st.session_state.last_error = str(e)
+            
+        except Exception as e:
+            st.error(f"Error: {str(e)}")
+            st.session_state.messages.append({"role": "assistant", "content": f"Sorry, I encountered an error: {str(e)}"})
+            
+            # Clear uploaded image if there was an error
+            st.session_state.uploaded_image = None
+
+    # A stopped or failed turn is redrawn to show its error or partial answer
+    if not completed:
+        st.rerun()
+
+@st.fragment
+def transcript():
+    """The chat messages; reactions and Continue rerun only this part of the page."""
+    # Only the newest messages are drawn; a placeholder stands in for the rest
+    first = max(0, len(st.session_state.messages) - st.session_state.transcript_window)
+    if first:
+        st.caption(f"⋯ {first} earlier messages not shown")
+        if st.button(f"Load {min(first, TRANSCRIPT_PAGE)} earlier", key="load_earlier"):
+            st.session_state.transcript_window += TRANSCRIPT_PAGE
+            st.rerun(scope="fragment")
+
+    for i, message in enumerate(st.session_state.messages[first:], start=first):
+        # Custom styling for messages based on role
+        if message["role"] == "user":
+            # User message with custom styling
+            st.markdown(user_bubble(message["content"]), unsafe_allow_html=True)
+        
+            # If there's an image in the message
+            if message.get("image"):
+                try:
+                    # Display the image below the text
+                    image_data = base64.b64decode(message["image"])
+                    image = Image.open(BytesIO(image_data))
+                    st.image(image, caption="Uploaded Image", width=300)
+                except Exception as e:
+                    st.error(f"Could not display image: {str(e)}")
+        else:
+            # AI message with custom styling
+            st.markdown(assistant_bubble(message["content"]), unsafe_allow_html=True)
+            if message.get("draft"):
+                st.caption("⏸ Interrupted while generating — this is the part saved before the session ended")
+            elif message.get("cancelled"):
+                st.caption("⏹ Stopped before the answer was complete")
+            if (
+                i == len(st.session_state.messages) - 1
+                and is_unfinished(message)
+                and not st.session_state.fanout_run
+                and st.button("▶ Continue answer", key="continue_answer")
+            ):
+                continue_answer()
+            
+            # Add simplified reaction buttons for AI messages 
+            if i > 0 and message["role"] == "assistant":
+                # Create a unique key for each message's reaction section
+                message_key = f"reaction_{i}"
+                
+                # Initialize reaction counts in session state if not already set
+                if message_key not in st.session_state:
+                    st.session_state[message_key] = {"👍": 0, "❤️": 0, "😂": 0, "😮": 0, "🔥": 0}
+                
+                # Display the reactions as small text instead of buttons
+                reaction_html = ""
+                reactions = ["👍", "❤️", "😂", "😮", "🔥"]
+                
+                for emoji in reactions:
+                    count = st.session_state[message_key][emoji]
+                    reaction_html += f"<span style='margin-right:8px;font-size:15px;'>{emoji} {count if count > 0 else ''}</span>"
+                
+                # Show them in a clean HTML layout
+                st.markdown(f"""
+                <div style="margin-top:5px;margin-bottom:10px;margin-left:40px;">
+                    {reaction_html}
+                </div>
+                """, unsafe_allow_html=True)
+                
+                # Only show react button if there are no counts yet
+                empty_reactions = all(count == 0 for count in st.session_state[message_key].values())
+                
+                # Add react button
+                cols = st.columns([1, 3])
+                if cols[0].button("👍 React", key=f"react_btn_{i}", use_container_width=True):
+                    st.session_state[message_key]["👍"] += 1
+    
+    # Answer a message just sent from the message box, below the messages
+    if st.session_state.pending_reply is not None:
+        user_input = st.session_state.pending_reply
+        st.session_state.pending_reply = None
+        reply_to(user_input)
+
+@st.fragment
+def attachments():
+    """Image, audio and document inputs; uploads and recordings rerun only this part."""
+    # Input options area with tabs for different input types
+    input_tabs = st.tabs(["Image Upload", "Audio Recording", "File Upload"])
+    
+    # Image upload tab
+    with input_tabs[0]:
+        uploaded_file = st.file_uploader("Upload an image for analysis", type=["jpg", "jpeg", "png"])
+        if uploaded_file:
+            # Save the uploaded image to session state
+            st.session_state.uploaded_image = encode_image(uploaded_file)
+            
+            # Preview the image
+            st.image(uploaded_file, caption="Image ready for analysis", width=300)
+    
+    # Audio recording tab
+    with input_tabs[1]:
+        if "audio_data" not in st.session_state:
+            st.session_state.audio_data = None
+            st.session_state.audio_path = None
+            st.session_state.audio_recording_unavailable = False
+        
+        # Check if audio recording was previously determined to be unavailable
+        if not st.session_state.audio_recording_unavailable:
+            # Place buttons side by side without nested columns
+            st.write("Choose recording duration:")
+            b1, b2 = st.columns(2) # This is not nested - it's at the root level of the tab
+            
+            # Record 5-second audio
+            if b1.button("Record Audio (5 seconds)", use_container_width=True):
+                try:
+                    from utils.audio import record_audio, encode_audio, cleanup_audio_file
+                    
+                    # Record audio for 5 seconds
+                    audio_bytes, temp_file_path = record_audio(duration=5)
+                    
+                    # Save to session state
+                    st.session_state.audio_data = encode_audio(audio_bytes)
+                    st.session_state.audio_path = temp_file_path
+                    
+                    # Show success message
+                    st.success("Audio recorded successfully!")
+                    
+                    # Add an audio player to preview the recording
+                    st.audio(temp_file_path)
+                except Exception as e:
+                    error_message = str(e)
+                    if "microphone is not accessible" in error_message or "Invalid input device" in error_message:
+                        st.error("Microphone not available in this environment.")
+                        st.info("You can upload an audio file instead or use text input.")
+                        st.session_state.audio_recording_unavailable = True
+                    else:
+                        st.error(f"Failed to record audio: {error_message}")
+            
+            # Record 10-second audio
+            if b2.button("Record Audio (10 seconds)", use_container_width=True):
+                try:
+                    from utils.audio import record_audio, encode_audio, cleanup_audio_file
+                    
+                    # Record audio for 10 seconds
+                    audio_bytes, temp_file_path = record_audio(duration=10)
+                    
+                    # Save to session state
+                    st.session_state.audio_data = encode_audio(audio_bytes)
+                    st.session_state.audio_path = temp_file_path
+                    
+                    # Show success message
+                    st.success("Audio recorded successfully!")
+                    
+                    # Add an audio player to preview the recording
+                    st.audio(temp_file_path)
+                except Exception as e:
+                    error_message = str(e)
+                    if "microphone is not accessible" in error_message or "Invalid input device" in error_message:
+                        st.error("Microphone not available in this environment.")
+                        st.info("You can upload an audio file instead or use text input.")
+                        st.session_state.audio_recording_unavailable = True
+                    else:
+                        st.error(f"Failed to record audio: {error_message}")
+        else:
+            # Show alternative options when recording is unavailable
+            st.warning("Audio recording is not available in this environment.")
+            st.info("You can upload a pre-recorded audio file or use text input instead.")
+            st.session_state.audio_recording_unavailable = True
+        
+        # Upload audio file as alternative
+        uploaded_audio = st.file_uploader("Or upload audio file", type=["wav", "mp3", "ogg"], key="audio_upload")
+        if uploaded_audio:
+            try:
+                # Read the file and encode it
+                audio_bytes = uploaded_audio.getvalue()
+                
+                # Create temporary file
+                temp_file = tempfile.NamedTemporaryFile(suffix="." + uploaded_audio.name.split(".")[-1], delete=False)
+                temp_file_path = temp_file.name
+                temp_file.write(audio_bytes)
+                temp_file.close()
+                
+                # Save to session state
+                from utils.audio import encode_audio
+                st.session_state.audio_data = encode_audio(audio_bytes)
+                st.session_state.audio_path = temp_file_path
+                
+                # Show success and preview
+                st.success("Audio file uploaded successfully!")
+                st.audio(temp_file_path)
+            except Exception as e:
+                st.error(f"Failed to process audio file: {str(e)}")
+        
+        # Button to clear recorded/uploaded audio
+        if st.session_state.audio_data and st.button("Clear Audio"):
+            if st.session_state.audio_path:
+                try:
+                    from utils.audio import cleanup_audio_file
+                    cleanup_audio_file(st.session_state.audio_path)
+                except:
+                    pass
+            st.session_state.audio_data = None
+            st.session_state.audio_path = None
+            st.rerun()
+            
+    # File upload tab
+    with input_tabs[2]:
+        uploaded_doc = st.file_uploader("Upload a document", type=["txt", "pdf", "doc", "docx"], 
+                                      help="Upload a document for the AI to analyze")
+        if uploaded_doc:
+            # Read file content
+            if uploaded_doc.type == "text/plain":
+                # Handle text files
+                text_content = uploaded_doc.getvalue().decode("utf-8")
+                st.text_area("Document Content", text_content, height=200)
+                if st.button("Send Document to AI"):
+                    # Add document content to user message
+                    st.session_state.document_text = f"I'm sharing this document with you: \n\n{text_content}\n\nPlease analyze this content."
+            else:
+                # For other file types, just show the filename
+                st.info(f"File '{uploaded_doc.name}' uploaded. Send a message to the AI to analyze it.")
+
+@st.fragment
+def emoji_menu():
+    """Emoji & GIF picker; browsing and searching rerun only this part."""
+    # Emoji & GIF Picker in a small expander to be less prominent
+    with st.expander("📋 Emoji & GIF Menu", expanded=False):
+        render_emoji_gif_picker()
+
+@st.fragment
+def composer():
+    """The message box with Send and Clear; typing reruns only this part until a message is sent."""
+    # Chat input with custom container and improved sizing
+    st.markdown("""
+    <div class="chat-input-container">
+        <h4 style="margin-bottom: 10px; color: #4285f4;">Message</h4>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    # Show the error from the last failed send, once
+    if st.session_state.last_error:
+        st.error(st.session_state.last_error)
+        st.session_state.last_error = None
+    
+    # Create message input with larger height
+    user_input = st.text_area(
+        "Message the AI...",
+        height=120,
+        key="message_input",
+        placeholder="Type your message here...",
+        label_visibility="collapsed"
+    )
+    
+    # Add cooldown mechanism to prevent double-sending
+    col1, col2 = st.columns([3, 1])
+    send_button_disabled = st.session_state.send_message_cooldown
+    
+    with col1:
+        if st.button("Send Message", disabled=send_button_disabled, use_container_width=True, type="primary"):
+            # Implement cooldown
+            import time
+            current_time = time.time()
+            
+            # Check if we're in cooldown (prevent rapid clicking)
+            cooldown_active = False
+            if hasattr(st.session_state, 'last_sent_time'):
+                if st.session_state.last_sent_time and (current_time - st.session_state.last_sent_time) < 1.0:
+                    cooldown_active = True
+            
+            if not cooldown_active and user_input.strip():
+                # Set cooldown flag
+                st.session_state.send_message_cooldown = True
+                st.session_state.last_sent_time = current_time
+                
+                # If document was uploaded and button clicked, use document text as message
+                message_to_send = user_input
+                if hasattr(st.session_state, 'document_text'):
+                    message_to_send = st.session_state.document_text
+                    # Clear it after use
+                    delattr(st.session_state, 'document_text')
+                
+                # Create message object
+                user_message = {"role": "user", "content": message_to_send}
+                
+                # Add image to message if one is uploaded
+                if st.session_state.uploaded_image:
+                    user_message["image"] = st.session_state.uploaded_image
+                    
+                # Add audio to message if recorded
+                if hasattr(st.session_state, 'audio_data') and st.session_state.audio_data:
+                    user_message["audio"] = st.session_state.audio_data
+                    # Clear audio data after use
+                    st.session_state.audio_data = None
+                    st.session_state.audio_path = None
+                
+                # Add user message to chat
+                st.session_state.messages.append(user_message)
+                
+                # The transcript answers it on the full rerun, below the new message
+                st.session_state.pending_reply = user_input
+                st.rerun()
+
+    with col2:
+        # Clear button
+        if st.button("Clear", use_container_width=True):
+            # Stop any generation still running for this conversation
+            cancel_calls(st.session_state.conversation_key, "cleared")
+            # Reset the input field
+            st.session_state.user_message = ""
+            # Force a rerun to clear the text area
+            st.rerun()
+
+@st.fragment
+def settings_panel():
+    """The settings column; its widgets rerun only this part of the page."""
+    # Sidebar with enhanced Google AI Studio style settings
+    with st.container():
+        st.markdown("""
+        <div style="padding: 10px 0; border-bottom: 1px solid #333; margin-bottom: 15px;">
+            <h3 style="color: #4285f4; font-size: 1.3rem;">AI Studio Settings</h3>
+        </div>
+        """, unsafe_allow_html=True)
+        
+        # Voice command functions
+        def toggle_voice_commands(enable):
+            """Toggle voice commands on/off"""
+            if enable:
+                if not st.session_state.voice_processor:
+                    try:
+                        # Import voice command processor
+                        from utils.voice_commands import VoiceCommandProcessor
+                        
+                        # Initialize processor with command callbacks
+                        processor = VoiceCommandProcessor()
+                        
+                        # Register command callbacks
+                        processor.register_callback("new_chat", lambda: st.session_state.update(messages=[], transcript_window=TRANSCRIPT_WINDOW))
+                        processor.register_callback("select_model_gemini", lambda: st.session_state.update(current_model="Gemini"))
+                        processor.register_callback("select_model_claude", lambda: st.session_state.update(current_model="Anthropic (claude-3-5-sonnet-20241022)"))
+                        processor.register_callback("select_model_gpt", lambda: st.session_state.update(current_model="OpenAI (gpt-4o)"))
+                        processor.register_callback("set_theme_amazonqpurple", lambda: st.session_state.update(current_theme="Amazon Q Purple"))
+                        processor.register_callback("set_theme_light", lambda: st.session_state.update(current_theme="Light"))
+                        processor.register_callback("set_theme_dark", lambda: st.session_state.update(current_theme="Dark"))
+                        processor.register_callback("add_emoji_thumbsup", lambda: add_to_message_input("👍"))
+                        processor.register_callback("add_emoji_heart", lambda: add_to_message_input("❤️"))
+                        processor.register_callback("send_message", lambda: st.session_state.update(send_message=True)) # placeholder only
+                        
+                        # Start listening
+                        st.session_state.voice_processor = processor
+                        st.session_state.voice_processor.start_listening()
+                        st.session_state.is_listening = True
+                        st.success("Voice commands are now active. Try saying 'New chat', 'Select Model Gemini', 'Add Emoji Thumbs Up', etc.")
+                    except Exception as e:
+                        st.error(f"Could not initialize voice commands: {str(e)}")
+                        st.info("Ensure you have the required dependencies installed and microphone access is enabled.")
+            else:
+                if st.session_state.voice_processor:
+                    # Stop listening
+                    st.session_state.voice_processor.stop_listening()
+                    st.session_state.voice_processor = None
+                    st.session_state.is_listening = False
+                    st.info("Voice commands disabled.")
+        
+        # Toggle voice commands
+        voice_commands_enabled = st.checkbox(
+            "Enable Voice Commands",
+            value=st.session_state.voice_commands_active,
+            help="Enable/disable voice command processing"
+        )
+        
+        # Apply toggle if changed
+        if voice_commands_enabled != st.session_state.voice_commands_active:
+            st.session_state.voice_commands_active = voice_commands_enabled
+            toggle_voice_commands(voice_commands_enabled)
+        
+        # Show current voice command status
+        status_text = "🟢 Listening..." if st.session_state.is_listening else "🔴 Not Listening"
+        status_color = "green" if st.session_state.is_listening else "red"
+        st.markdown(f"<p style='color:{status_color};'>{status_text}</p>", unsafe_allow_html=True)
+        
+        # Model selection
+        model_options = MODEL_OPTIONS
+        # Follow switches made elsewhere (e.g. voice commands)
+        if st.session_state.get("model_select") != st.session_state.current_model:
+            st.session_state.model_select = st.session_state.current_model
+        st.selectbox(
+            "Choose AI Model",
+            options=model_options,
+            key="model_select",
+            on_change=switch_model,
+            help="Select the AI model to use for generating responses"
+        )
+        
+        # Side-by-side comparison across several models
+        st.session_state.compare_mode = st.toggle(
+            "Compare models",
+            value=st.session_state.compare_mode,
+            help="Send each message to several models at once and pick the best answer"
+        )
+        if st.session_state.compare_mode:
+            st.session_state.compare_models = st.multiselect(
+                "Models to compare",
+                options=model_options,
+                default=st.session_state.compare_models or model_options[:2],
+                max_selections=4
+            )
+        
+        # Provider health from the resilience layer
+        with st.expander("Provider Health", expanded=False):
+            render_provider_health(get_provider_health(), get_rate_limit_stats())
+            
+            # Provider prompt cache effectiveness for this conversation
+            cache_stats = get_cache_stats(st.session_state.conversation_key)
+            if cache_stats["calls"]:
+                saving = f" · {cache_stats['latency_saving']:.2f}s faster when cached" if cache_stats["latency_saving"] is not None else ""
+                st.caption(
+                    f"Prompt cache: {cache_stats['cached_tokens']}/{cache_stats['input_tokens']} input tokens cached "
+                    f"({cache_stats['hit_ratio']:.0%}){saving}"
+                )
+
+            # What this user has spent today, against their budget
+            budget = get_user_budget(st.session_state.user)
+            spent = get_user_spend(st.session_state.user) if st.session_state.user else 0.0
+            if spent or budget:
+                st.caption(f"Spent today: ${spent:.4f}" + (f" of ${budget:.2f} budget" if budget else ""))
+
+            # Messages whose provider-formatted version was reused instead of rebuilt
+            history_stats = get_history_cache_stats()
+            if history_stats["converted"]:
+                st.caption(f"History formatting: {history_stats['reused']} reused, {history_stats['converted']} converted")
+
+            # Time to first chunk and chunk cadence for streaming models
+            for provider, stream_stats in get_stream_stats().items():
+                if stream_stats["avg_ttfc"] is not None:
+                    gap = f", {stream_stats['avg_gap'] * 1000:.0f}ms between chunks" if stream_stats["avg_gap"] is not None else ""
+                    st.caption(
+                        f"{provider} streaming: first chunk after {stream_stats['avg_ttfc']:.2f}s{gap} "
+                        f"({stream_stats['streams']} streams, {stream_stats['cancelled']} cancelled)"
+                    )
+
+            # Per-key load for providers with several API keys
+            for provider, keys in get_key_pool_stats().items():
+                if len(keys) > 1:
+                    summary = ", ".join(
+                        f"{fingerprint}: {counters['requests']} req"
+                        + (f" (quarantined {counters['quarantined_for']:.0f}s)" if counters["quarantined_for"] else "")
+                        for fingerprint, counters in keys.items()
+                    )
+                    st.caption(f"{provider} keys — {summary}")
+
+            # Where "Auto" tiers were routed, and why
+            for tier, routing in get_routing_stats().items():
+                last = routing["last"]
+                if not last:
+                    continue
+                served = last["option"] or "no model available"
+                failovers = f", {last['failovers']} failover(s)" if last["failovers"] else ""
+                st.caption(f"Auto ({tier}) → {served}{failovers}")
+                for option, stats in routing["models"].items():
+                    if stats["samples"]:
+                        ttft = f"{stats['ttft']:.2f}s" if stats["ttft"] is not None else "-"
+                        latency = f"{stats['latency']:.2f}s" if stats["latency"] is not None else "-"
+                        st.caption(f"  {option}: p95 TTFT {ttft}, p95 total {latency}, {stats['error_rate']:.0%} errors, {stats['samples']} calls")
+
+            # Identical concurrent requests that shared one upstream call
+            flight_stats = get_single_flight_stats()
+            if flight_stats["shared"]:
+                st.caption(f"Deduplicated requests: {flight_stats['shared']} shared {flight_stats['leaders']} upstream calls")
+
+            # Vertex AI auth timing, once a Vertex client has been set up
+            try:
+                from utils.vertex_ai import get_vertex_auth_stats
+                auth_stats = get_vertex_auth_stats()
+            except ImportError:
+                auth_stats = None
+            if auth_stats and auth_stats["credentials_load_seconds"] is not None:
+                refresh = f", last token refresh {auth_stats['last_refresh_seconds']:.2f}s" if auth_stats["last_refresh_seconds"] is not None else ""
+                st.caption(
+                    f"Vertex auth: credentials loaded in {auth_stats['credentials_load_seconds']:.2f}s, "
+                    f"{auth_stats['refresh_count']} token refreshes{refresh}"
+                )
+            
+            # Vertex AI region in use and the latency probed for each candidate
+            region_stats = get_region_stats()
+            if len(region_stats["regions"]) > 1:
+                latencies = ", ".join(
+                    f"{region} {stats['latency_ms']:.0f}ms" if stats["healthy"] and stats["latency_ms"] is not None
+                    else f"{region} {'down' if not stats['healthy'] else 'not probed'}"
+                    for region, stats in region_stats["regions"].items()
+                )
+                st.caption(f"Vertex region: {region_stats['chosen']} ({latencies})")
+
 # Main function
 def main():
     # Initialize database
     init_db()
     
+    # Reopen the latest conversation if the session died while its answer was streaming
+    if st.session_state.user and not st.session_state.messages and not st.session_state.get("drafts_checked"):
+        st.session_state.drafts_checked = True
+        chat_id, saved_messages, saved_memory = get_most_recent_chat(st.session_state.user, st.session_state.current_model)
+        if saved_messages and saved_messages[-1].get("draft"):
+            st.session_state.chat_id = chat_id
+            st.session_state.messages = saved_messages
+            st.session_state.transcript_window = TRANSCRIPT_WINDOW
+            st.session_state.chat_memory = saved_memory or new_memory_state()
+    
     # Layout with main content area and sidebar - improve ratio for better chat display
     col1, col2 = st.columns([4, 1])
     
@@ -258,463 +1088,16 @@ def main():
         
         # Display chat messages in a clean Google AI Studio style within the fixed container
         with chat_container:
-            for i, message in enumerate(st.session_state.messages):
-                # Custom styling for messages based on role
-                if message["role"] == "user":
-                    # User message with custom styling
-                    st.markdown(f"""
-                    <div class="user-message">
-                        <div class="avatar user-avatar">👤</div>
-                        <div class="message-bubble user-bubble">
-                            <p class="message-text">{html.escape(message["content"]).replace(chr(10), '<br>')}</p>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                
-                    # If there's an image in the message
-                    if message.get("image"):
-                        try:
-                            # Display the image below the text
-                            image_data = base64.b64decode(message["image"])
-                            image = Image.open(BytesIO(image_data))
-                            st.image(image, caption="Uploaded Image", width=300)
-                        except Exception as e:
-                            st.error(f"Could not display image: {str(e)}")
-                else:
-                    # AI message with custom styling
-                    st.markdown(f"""
-                    <div class="ai-message">
-                        <div class="avatar">🤖</div>
-                        <div class="message-bubble">
-                            <p class="message-text">{html.escape(message["content"]).replace(chr(10), '<br>')}</p>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    # Add simplified reaction buttons for AI messages 
-                    if i > 0 and message["role"] == "assistant":
-                        # Create a unique key for each message's reaction section
-                        message_key = f"reaction_{i}"
-                        
-                        # Initialize reaction counts in session state if not already set
-                        if message_key not in st.session_state:
-                            st.session_state[message_key] = {"👍": 0, "❤️": 0, "😂": 0, "😮": 0, "🔥": 0}
-                        
-                        # Display the reactions as small text instead of buttons
-                        reaction_html = ""
-                        reactions = ["👍", "❤️", "😂", "😮", "🔥"]
-                        
-                        for emoji in reactions:
-                            count = st.session_state[message_key][emoji]
-                            reaction_html += f"<span style='margin-right:8px;font-size:15px;'>{emoji} {count if count > 0 else ''}</span>"
-                        
-                        # Show them in a clean HTML layout
-                        st.markdown(f"""
-                        <div style="margin-top:5px;margin-bottom:10px;margin-left:40px;">
-                            {reaction_html}
-                        </div>
-                        """, unsafe_allow_html=True)
-                        
-                        # Only show react button if there are no counts yet
-                        empty_reactions = all(count == 0 for count in st.session_state[message_key].values())
-                        
-                        # Add react button
-                        cols = st.columns([1, 3])
-                        if cols[0].button("👍 React", key=f"react_btn_{i}", use_container_width=True):
-                            st.session_state[message_key]["👍"] += 1
+            transcript()
         
-        # Input options area with tabs for different input types
-        input_tabs = st.tabs(["Image Upload", "Audio Recording", "File Upload"])
+        # Side-by-side panes for a running model comparison
+        if st.session_state.fanout_run:
+            fanout_panel()
         
-        # Image upload tab
-        with input_tabs[0]:
-            uploaded_file = st.file_uploader("Upload an image for analysis", type=["jpg", "jpeg", "png"])
-            if uploaded_file:
-                # Save the uploaded image to session state
-                st.session_state.uploaded_image = encode_image(uploaded_file)
-                
-                # Preview the image
-                st.image(uploaded_file, caption="Image ready for analysis", width=300)
-        
-        # Audio recording tab
-        with input_tabs[1]:
-            if "audio_data" not in st.session_state:
-                st.session_state.audio_data = None
-                st.session_state.audio_path = None
-                st.session_state.audio_recording_unavailable = False
-            
-            # Check if audio recording was previously determined to be unavailable
-            if not st.session_state.audio_recording_unavailable:
-                # Place buttons side by side without nested columns
-                st.write("Choose recording duration:")
-                b1, b2 = st.columns(2) # This is not nested - it's at the root level of the tab
-                
-                # Record 5-second audio
-                if b1.button("Record Audio (5 seconds)", use_container_width=True):
-                    try:
-                        from utils.audio import record_audio, encode_audio, cleanup_audio_file
-                        
-                        # Record audio for 5 seconds
-                        audio_bytes, temp_file_path = record_audio(duration=5)
-                        
-                        # Save to session state
-                        st.session_state.audio_data = encode_audio(audio_bytes)
-                        st.session_state.audio_path = temp_file_path
-                        
-                        # Show success message
-                        st.success("Audio recorded successfully!")
-                        
-                        # Add an audio player to preview the recording
-                        st.audio(temp_file_path)
-                    except Exception as e:
-                        error_message = str(e)
-                        if "microphone is not accessible" in error_message or "Invalid input device" in error_message:
-                            st.error("Microphone not available in this environment.")
-                            st.info("You can upload an audio file instead or use text input.")
-                            st.session_state.audio_recording_unavailable = True
-                        else:
-                            st.error(f"Failed to record audio: {error_message}")
-                
-                # Record 10-second audio
-                if b2.button("Record Audio (10 seconds)", use_container_width=True):
-                    try:
-                        from utils.audio import record_audio, encode_audio, cleanup_audio_file
-                        
-                        # Record audio for 10 seconds
-                        audio_bytes, temp_file_path = record_audio(duration=10)
-                        
-                        # Save to session state
-                        st.session_state.audio_data = encode_audio(audio_bytes)
-                        st.session_state.audio_path = temp_file_path
-                        
-                        # Show success message
-                        st.success("Audio recorded successfully!")
-                        
-                        # Add an audio player to preview the recording
-                        st.audio(temp_file_path)
-                    except Exception as e:
-                        error_message = str(e)
-                        if "microphone is not accessible" in error_message or "Invalid input device" in error_message:
-                            st.error("Microphone not available in this environment.")
-                            st.info("You can upload an audio file instead or use text input.")
-                            st.session_state.audio_recording_unavailable = True
-                        else:
-                            st.error(f"Failed to record audio: {error_message}")
-            else:
-                # Show alternative options when recording is unavailable
-                st.warning("Audio recording is not available in this environment.")
-                st.info("You can upload a pre-recorded audio file or use text input instead.")
-                st.session_state.audio_recording_unavailable = True
-            
-            # Upload audio file as alternative
-            uploaded_audio = st.file_uploader("Or upload audio file", type=["wav", "mp3", "ogg"], key="audio_upload")
-            if uploaded_audio:
-                try:
-                    # Read the file and encode it
-                    audio_bytes = uploaded_audio.getvalue()
-                    
-                    # Create temporary file
-                    temp_file = tempfile.NamedTemporaryFile(suffix="." + uploaded_audio.name.split(".")[-1], delete=False)
-                    temp_file_path = temp_file.name
-                    temp_file.write(audio_bytes)
-                    temp_file.close()
-                    
-                    # Save to session state
-                    from utils.audio import encode_audio
-                    st.session_state.audio_data = encode_audio(audio_bytes)
-                    st.session_state.audio_path = temp_file_path
-                    
-                    # Show success and preview
-                    st.success("Audio file uploaded successfully!")
-                    st.audio(temp_file_path)
-                except Exception as e:
-                    st.error(f"Failed to process audio file: {str(e)}")
-            
-            # Button to clear recorded/uploaded audio
-            if st.session_state.audio_data and st.button("Clear Audio"):
-                if st.session_state.audio_path:
-                    try:
-                        from utils.audio import cleanup_audio_file
-                        cleanup_audio_file(st.session_state.audio_path)
-                    except:
-                        pass
-                st.session_state.audio_data = None
-                st.session_state.audio_path = None
-                st.rerun()
-                
-        # File upload tab
-        with input_tabs[2]:
-            uploaded_doc = st.file_uploader("Upload a document", type=["txt", "pdf", "doc", "docx"], 
-                                          help="Upload a document for the AI to analyze")
-            if uploaded_doc:
-                # Read file content
-                if uploaded_doc.type == "text/plain":
-                    # Handle text files
-                    text_content = uploaded_doc.getvalue().decode("utf-8")
-                    st.text_area("Document Content", text_content, height=200)
-                    if st.button("Send Document to AI"):
-                        # Add document content to user message
-                        st.session_state.document_text = f"I'm sharing this document with you: \n\n{text_content}\n\nPlease analyze this content."
-                else:
-                    # For other file types, just show the filename
-                    st.info(f"File '{uploaded_doc.name}' uploaded. Send a message to the AI to analyze it.")
-        
-        # Emoji & GIF Picker in a small expander to be less prominent
-        with st.expander("📋 Emoji & GIF Menu", expanded=False):
-            render_emoji_gif_picker()
-        
-        # Chat input with custom container and improved sizing
-        st.markdown("""
-        <div class="chat-input-container">
-            <h4 style="margin-bottom: 10px; color: #4285f4;">Message</h4>
-        </div>
-        """, unsafe_allow_html=True)
-        
-        # Create message input with larger height
-        user_input = st.text_area(
-            "Message the AI...",
-            height=120,
-            key="message_input",
-            placeholder="Type your message here...",
-            label_visibility="collapsed"
-        )
-        
-        # Add cooldown mechanism to prevent double-sending
-        col1, col2 = st.columns([3, 1])
-        send_button_disabled = st.session_state.send_message_cooldown
-        
-        with col1:
-            if st.button("Send Message", disabled=send_button_disabled, use_container_width=True, type="primary"):
-                # Implement cooldown
-                import time
-                current_time = time.time()
-                
-                # Check if we're in cooldown (prevent rapid clicking)
-                cooldown_active = False
-                if hasattr(st.session_state, 'last_sent_time'):
-                    if st.session_state.last_sent_time and (current_time - st.session_state.last_sent_time) < 1.0:
-                        cooldown_active = True
-                
-                if not cooldown_active and user_input.strip():
-                    # Set cooldown flag
-                    st.session_state.send_message_cooldown = True
-                    st.session_state.last_sent_time = current_time
-                    
-                    # If document was uploaded and button clicked, use document text as message
-                    message_to_send = user_input
-                    if hasattr(st.session_state, 'document_text'):
-                        message_to_send = st.session_state.document_text
-                        # Clear it after use
-                        delattr(st.session_state, 'document_text')
-                    
-                    # Create message object
-                    user_message = {"role": "user", "content": message_to_send}
-                    
-                    # Add image to message if one is uploaded
-                    if st.session_state.uploaded_image:
-                        user_message["image"] = st.session_state.uploaded_image
-                        
-                    # Add audio to message if recorded
-                    if hasattr(st.session_state, 'audio_data') and st.session_state.audio_data:
-                        user_message["audio"] = st.session_state.audio_data
-                        # Clear audio data after use
-                        st.session_state.audio_data = None
-                        st.session_state.audio_path = None
-                    
-                    # Add user message to chat
-                    st.session_state.messages.append(user_message)
-                    
-                    # Get AI response based on selected model
-                    with st.spinner(f"Thinking... using {st.session_state.current_model}"):
-                        try:
-                            image_data = user_message.get("image")
-                            model_name = st.session_state.current_model.lower()
-                            
-                            # Extract model call sign from selected model if available
-                            model_call_sign = None
-                            if "(" in st.session_state.current_model and ")" in st.session_state.current_model:
-                                model_call_sign = st.session_state.current_model.split("(")[1].split(")")[0]
-                            
-                            # Gemini models
-                            if "gemini" in model_name:
-                                # Use extracted call sign or fallback to default
-                                gemini_version = model_call_sign if model_call_sign else "gemini-1.5-pro"
-                                
-                                # Get audio data if available
-                                audio_data = user_message.get("audio")
-                                
-                                ai_response = get_gemini_response(
-                                    user_input, 
-                                    st.session_state.messages,
-                                    image_data=image_data,
-                                    audio_data=audio_data,
-                                    temperature=st.session_state.temperature,
-                                    model_name=gemini_version
-                                )
-                            
-                            # Vertex AI models - direct routing to appropriate API based on model
-                            elif "vertex ai" in model_name:
-                                if "claude" in model_name.lower():
-                                    # Use the extracted call sign or default to Claude 3.5
-                                    claude_model = model_call_sign if model_call_sign else "claude-3-5-sonnet-20241022"
-                                    ai_response = get_anthropic_response(
-                                        user_input, 
-                                        st.session_state.messages,
-                                        model_name=claude_model
-                                    )
-                                elif "gpt" in model_name.lower():
-                                    # Use the extracted call sign or default to GPT-4o
-                                    gpt_model = model_call_sign if model_call_sign else "gpt-4o"
-                                    ai_response = get_openai_response(
-                                        user_input, 
-                                        st.session_state.messages,
-                                        model_name=gpt_model
-                                    )
-                                else:
-                                    # For any other Vertex AI models, try the vertex function but with warning
-                                    ai_response = "Note: This model may not be directly accessible through the current API configuration. " + \
-                                                "For best results with third-party models, please select them from their native provider section instead."
-                            
-                            # OpenAI models
-                            elif "openai" in model_name:
-                                # Use the extracted call sign or default to gpt-4o
-                                openai_model = model_call_sign if model_call_sign else "gpt-4o"
-                                ai_response = get_openai_response(
-                                    user_input, 
-                                    st.session_state.messages,
-                                    model_name=openai_model
-                                )
-                            
-                            # Anthropic models
-                            elif "anthropic" in model_name:
-                                # Use the extracted call sign or default to claude-3-5-sonnet-20241022
-                                anthropic_model = model_call_sign if model_call_sign else "claude-3-5-sonnet-20241022"
-                                ai_response = get_anthropic_response(
-                                    user_input, 
-                                    st.session_state.messages,
-                                    model_name=anthropic_model
-                                )
-                            
-                            # Perplexity models
-                            elif "perplexity" in model_name:
-                                # Use the extracted call sign or fallback to default
-                                perplexity_model = model_call_sign if model_call_sign else "pplx-70b-online"
-                                
-                                ai_response = get_perplexity_response(
-                                    user_input, 
-                                    st.session_state.messages,
-                                    temperature=st.session_state.temperature,
-                                    model_name=perplexity_model
-                                )
-                            
-                            # Fallback for unknown models
-                            else:
-                                ai_response = "Error: The selected model is not yet implemented."
-                                
-                            # Add AI response to chat
-                            st.session_state.messages.append({"role": "assistant", "content": ai_response})
-                            
-                            # Clear uploaded image after processing
-                            st.session_state.uploaded_image = None
-                            
-                            # Save conversation to database
-                            save_conversation(
-                                st.session_state.user,
-                                st.session_state.current_model,
-                                st.session_state.messages
-                            )
-                            
-                        except Exception as e:
-                            st.error(f"Error: {str(e)}")
-                            st.session_state.messages.append({"role": "assistant", "content": f"Sorry, I encountered an error: {str(e)}"})
-                            
-                            # Clear uploaded image if there was an error
-                            st.session_state.uploaded_image = None
-                    
-                    # Force a rerun to show the new messages
-                    st.rerun()
-
-        with col2:
-            # Clear button
-            if st.button("Clear", use_container_width=True):
-                # Reset the input field
-                st.session_state.user_message = ""
-                # Force a rerun to clear the text area
-                st.rerun()
+        # Attachments, the emoji menu and the message box each rerun on their own
+        attachments()
+        emoji_menu()
+        composer()
     
     with col2:
-        # Sidebar with enhanced Google AI Studio style settings
-        with st.container():
-            st.markdown("""
-            <div style="padding: 10px 0; border-bottom: 1px solid #333; margin-bottom: 15px;">
-                <h3 style="color: #4285f4; font-size: 1.3rem;">AI Studio Settings</h3>
-            </div>
-            """, unsafe_allow_html=True)
-            
-            # Voice command functions
-            def toggle_voice_commands(enable):
-                """Toggle voice commands on/off"""
-                if enable:
-                    if not st.session_state.voice_processor:
-                        try:
-                            # Import voice command processor
-                            from utils.voice_commands import VoiceCommandProcessor
-                            
-                            # Initialize processor with command callbacks
-                            processor = VoiceCommandProcessor()
-                            
-                            # Register command callbacks
-                            processor.register_callback("new_chat", lambda: st.session_state.update(messages=[]))
-                            processor.register_callback("select_model_gemini", lambda: st.session_state.update(current_model="Gemini"))
-                            processor.register_callback("select_model_claude", lambda: st.session_state.update(current_model="Anthropic (claude-3-5-sonnet-20241022)"))
-                            processor.register_callback("select_model_gpt", lambda: st.session_state.update(current_model="OpenAI (gpt-4o)"))
-                            processor.register_callback("set_theme_amazonqpurple", lambda: st.session_state.update(current_theme="Amazon Q Purple"))
-                            processor.register_callback("set_theme_light", lambda: st.session_state.update(current_theme="Light"))
-                            processor.register_callback("set_theme_dark", lambda: st.session_state.update(current_theme="Dark"))
-                            processor.register_callback("add_emoji_thumbsup", lambda: add_to_message_input("👍"))
-                            processor.register_callback("add_emoji_heart", lambda: add_to_message_input("❤️"))
-                            processor.register_callback("send_message", lambda: st.session_state.update(send_message=True)) # placeholder only
-                            
-                            # Start listening
-                            st.session_state.voice_processor = processor
-                            st.session_state.voice_processor.start_listening()
-                            st.session_state.is_listening = True
-                            st.success("Voice commands are now active. Try saying 'New chat', 'Select Model Gemini', 'Add Emoji Thumbs Up', etc.")
-                        except Exception as e:
-                            st.error(f"Could not initialize voice commands: {str(e)}")
-                            st.info("Ensure you have the required dependencies installed and microphone access is enabled.")
-                else:
-                    if st.session_state.voice_processor:
-                        # Stop listening
-                        st.session_state.voice_processor.stop_listening()
-                        st.session_state.voice_processor = None
-                        st.session_state.is_listening = False
-                        st.info("Voice commands disabled.")
-            
-            # Toggle voice commands
-            voice_commands_enabled = st.checkbox(
-                "Enable Voice Commands",
-                value=st.session_state.voice_commands_active,
-                help="Enable/disable voice command processing"
-            )
-            
-            # Apply toggle if changed
-            if voice_commands_enabled != st.session_state.voice_commands_active:
-                st.session_state.voice_commands_active = voice_commands_enabled
-                toggle_voice_commands(voice_commands_enabled)
-            
-            # Show current voice command status
-            status_text = "🟢 Listening..." if st.session_state.is_listening else "🔴 Not Listening"
-            status_color = "green" if st.session_state.is_listening else "red"
-            st.markdown(f"<p style='color:{status_color};'>{status_text}</p>", unsafe_allow_html=True)
-            
-            # Model selection
-            model_options = ["Gemini", "Vertex AI (claude-3-5-sonnet-20241022)", "Vertex AI (gpt-4o)", "OpenAI (gpt-4o)", "Anthropic (claude-3-5-sonnet-20241022)", "Perplexity (pplx-70b-online)"]
-            current_model_index = model_options.index(st.session_state.current_model)
-            selected_model = st.selectbox(
-                "Choose AI Model",
-                options=model_options,
-                index=current_model_index,
-                help="Select the AI model to use for generating responses"
-            )
-            
\ No newline at end of file
+        settings_panel()
@@ -0,0 +1,49 @@
+"""
+Shared fixtures for the test suite
+
+Provider calls go to the local stand-in server (utils.stub_server), and
+usage events go to a temporary ledger, so the suite needs no API keys,
+network access or database.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Settings read at import time must be in place before any utils module loads
+_tmp = tempfile.mkdtemp(prefix="ai-chat-tests-")
+os.environ["USAGE_LOG_PATH"] = os.path.join(_tmp, "usage_events.jsonl")
+os.environ.pop("POSTGRESQL_URL", None)
+os.environ.pop("DATABASE_URL", None)
+os.environ.pop("AI_MOCK_SERVER_URL", None)
+os.environ.setdefault("PROVIDER_BACKOFF_BASE", "0.01")
+os.environ.setdefault("PROVIDER_BACKOFF_MAX", "0.05")
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """A stand-in server with no latency or pacing, with AI_MOCK_SERVER_URL pointing at it."""
+    from utils.stub_server import start_stub_server, MockConfig
+    from utils import vertex_ai
+
+    server, url = start_stub_server(config=MockConfig(latency="fixed", latency_ms=0, tokens_per_second=0, seed=1))
+    monkeypatch.setenv("AI_MOCK_SERVER_URL", url)
+    # Vertex clients are cached per region with the base URL they were created for
+    vertex_ai._clients.clear()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def reset_breakers():
+    """Give every test closed circuit breakers and empty health stats."""
+    from utils import resilience
+
+    resilience._breakers.clear()
+    resilience._health.clear()
+    yield
@@ -0,0 +1,52 @@
+import io
+import math
+import struct
+import sys
+import wave
+
+from utils import audio_codec
+from utils.audio_codec import prepare_audio, build_gemini_audio_parts
+
+
+def recording(seconds=3, rate=16000):
+    samples = [int(8000 * math.sin(2 * math.pi * 440 * i / rate)) for i in range(seconds * rate)]
+    output = io.BytesIO()
+    with wave.open(output, "wb") as target:
+        target.setnchannels(1)
+        target.setsampwidth(2)
+        target.setframerate(rate)
+        target.writeframes(struct.pack(f"<{len(samples)}h", *samples))
+    return output.getvalue()
+
+
+def test_recordings_are_compressed_and_chunked():
+    raw = recording()
+    chunks = prepare_audio(raw, chunk_seconds=1)
+
+    assert len(chunks) == 3
+    assert {mime_type for _, mime_type in chunks} <= {"audio/ogg", "audio/flac"}
+    assert sum(len(chunk) for chunk, _ in chunks) < len(raw) / 2
+
+
+def test_wav_is_split_uncompressed_without_soundfile(monkeypatch, capsys):
+    monkeypatch.setitem(sys.modules, "soundfile", None)
+    monkeypatch.setattr(audio_codec, "_soundfile_missing_reported", False)
+    raw = recording()
+
+    for _ in range(2):
+        chunks = prepare_audio(raw, chunk_seconds=2)
+        assert [mime_type for _, mime_type in chunks] == ["audio/wav", "audio/wav"]
+    # The missing codec is reported, once
+    assert capsys.readouterr().err.count("soundfile unavailable") == 1
+
+
+def test_undecodable_audio_is_passed_through_and_reported(capsys):
+    mp3 = b"ID3" + bytes(200)
+    assert prepare_audio(mp3) == [(mp3, "audio/mp3")]
+    assert "Could not compress audio/mp3" in capsys.readouterr().err
+
+
+def test_small_recordings_are_sent_inline():
+    parts = build_gemini_audio_parts(recording(seconds=1), client=None)
+    assert len(parts) == 1
+    assert parts[0].inline_data.mime_type in ("audio/ogg", "audio/flac")
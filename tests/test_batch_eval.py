@@ -0,0 +1,75 @@
+import json
+
+from utils import cassettes
+from utils.batch_eval import run_batch, load_results, summarize, percentile
+
+MODELS = ["OpenAI (gpt-4o)", "Perplexity (pplx-70b-online)"]
+PROMPTS = [{"id": str(i), "prompt": f"prompt number {i}"} for i in range(4)]
+
+
+def test_results_are_written_for_every_pair(stub, tmp_path):
+    output = str(tmp_path / "results.jsonl")
+    results = run_batch(PROMPTS, MODELS, output, concurrency=2)
+
+    assert len(results) == len(PROMPTS) * len(MODELS)
+    assert all(r["status"] == "ok" for r in results)
+    assert len(load_results(output)) == len(results)
+    assert {r["id"] for r in results if "prompt number 3" in r["output"]} == {"3"}
+
+
+def test_rerun_resumes_after_an_interrupted_run(stub, tmp_path):
+    output = tmp_path / "results.jsonl"
+    run_batch(PROMPTS, MODELS, str(output), concurrency=2)
+
+    # Lose the last two results, the second one half written
+    lines = output.read_text().splitlines()
+    output.write_text("\n".join(lines[:-2]) + "\n" + lines[-1][:20])
+    before = sum(stub.state.request_counts.values())
+
+    results = run_batch(PROMPTS, MODELS, str(output), concurrency=2)
+
+    assert sum(stub.state.request_counts.values()) - before == 2
+    assert len(results) == len(PROMPTS) * len(MODELS)
+    assert all(r["status"] == "ok" for r in results)
+
+
+def test_errors_are_rerun_only_when_asked(stub, tmp_path):
+    output = str(tmp_path / "results.jsonl")
+    stub.state.config.error_5xx_rate = 1.0
+    results = run_batch(PROMPTS[:1], MODELS[1:], output)
+    assert results[0]["status"] == "error"
+
+    stub.state.config.error_5xx_rate = 0.0
+    assert run_batch(PROMPTS[:1], MODELS[1:], output)[0]["status"] == "error"
+    assert run_batch(PROMPTS[:1], MODELS[1:], output, retry_errors=True)[0]["status"] == "ok"
+
+
+def test_replay_from_a_cassette_needs_no_server(stub, tmp_path, monkeypatch):
+    monkeypatch.setattr(cassettes, "CASSETTE_PATH", str(tmp_path / "cassette.jsonl.gz"))
+    monkeypatch.setattr(cassettes, "CASSETTE_SPEED", 0)
+    monkeypatch.setattr(cassettes, "_replay_index", None)
+
+    monkeypatch.setattr(cassettes, "CASSETTE_MODE", "record")
+    recorded = run_batch(PROMPTS, MODELS, str(tmp_path / "recorded.jsonl"))
+
+    stub.shutdown()
+    monkeypatch.setattr(cassettes, "CASSETTE_MODE", "replay")
+    replayed = run_batch(PROMPTS, MODELS, str(tmp_path / "replayed.jsonl"))
+
+    def outputs(results):
+        return {(r["id"], r["model"]): r["output"] for r in results}
+    assert outputs(replayed) == outputs(recorded)
+    assert all(r["status"] == "ok" for r in replayed)
+
+
+def test_summary_percentiles():
+    results = [
+        {"model": "m", "status": "ok", "latency": float(i), "input_tokens": 10, "output_tokens": 5}
+        for i in range(1, 101)
+    ] + [{"model": "m", "status": "error", "latency": 0.1, "input_tokens": 0, "output_tokens": 0}]
+    summary = summarize(results)["m"]
+
+    assert summary["ok"] == 100 and summary["errors"] == 1
+    assert summary["p50_latency"] == 50.0 and summary["p99_latency"] == 99.0
+    assert percentile([], 0.5) is None
+    assert json.dumps(summary)
@@ -0,0 +1,87 @@
+import hashlib
+
+from utils import context
+from utils.context import build_context, count_message_tokens, get_context_tokens, get_prompt_budget, estimate_tokens
+
+
+def turn(role, text, **extra):
+    return dict({"role": role, "content": text}, **extra)
+
+
+def test_keeps_newest_messages_within_budget():
+    messages = [turn("user" if i % 2 == 0 else "assistant", "x" * 400) for i in range(20)]
+    selected = build_context(messages, "gpt-4o", token_budget=500)
+
+    assert selected[-1] is messages[-1]
+    assert sum(count_message_tokens(m) for m in selected) <= 500
+    # Newest first, contiguous, original order
+    assert selected == messages[len(messages) - len(selected):]
+
+
+def test_pinned_messages_always_kept():
+    system = turn("system", "be brief")
+    messages = [system] + [turn("user" if i % 2 == 0 else "assistant", "y" * 800) for i in range(10)]
+    selected = build_context(messages, "gpt-4o", token_budget=300)
+
+    assert selected[0] is system
+    assert selected[-1] is messages[-1]
+
+
+def test_does_not_open_with_an_assistant_turn():
+    messages = [turn("user", "a" * 400), turn("assistant", "b" * 400), turn("user", "c" * 40)]
+    budget = count_message_tokens(messages[1]) + count_message_tokens(messages[2])
+    selected = build_context(messages, "claude-3-5-sonnet", token_budget=budget)
+
+    assert selected == [messages[2]]
+
+
+def test_budget_respects_context_window():
+    assert get_prompt_budget("gpt-4", reserved_output_tokens=1024, token_budget=100000) == 8192 - 1024
+
+
+def test_count_is_cached_and_refreshed_after_same_length_edit():
+    message = turn("user", "abcd" * 10)
+    first = count_message_tokens(message)
+    assert message["token_count"] == first
+
+    # Same length, different text: the stale count must not be reused
+    message["content"] = "wxyz" * 10
+    message["token_count"] = 1
+    assert count_message_tokens(message) == first
+    assert estimate_tokens(message["content"]) == 10
+
+
+def test_old_history_is_dropped_in_whole_blocks():
+    messages = []
+    starts = []
+    for i in range(60):
+        messages.append(turn("user", f"{i} " + "u" * 800))
+        selected = build_context(messages, "gpt-4o", token_budget=16000)
+        starts.append(next(j for j, m in enumerate(messages) if m is selected[0]))
+        assert get_context_tokens(selected) <= 16000
+        messages.append(turn("assistant", "a" * 2400))
+
+    changes = sum(1 for a, b in zip(starts, starts[1:]) if a != b)
+    # The first message sent moves once per block, not on every turn
+    assert 0 < changes < len(starts) // 3
+    assert all(messages[start]["role"] == "user" for start in starts)
+
+
+def test_unchanged_messages_are_not_hashed_again(monkeypatch):
+    hashed = []
+
+    class CountingHashlib:
+        @staticmethod
+        def blake2b(**kwargs):
+            hashed.append(1)
+            return hashlib.blake2b(**kwargs)
+
+    monkeypatch.setattr(context, "hashlib", CountingHashlib)
+    messages = [turn("user", "q" * 400, image="aW1hZ2U=") for _ in range(10)]
+    for _ in range(5):
+        build_context(messages, "gpt-4o")
+    assert len(hashed) == 10
+
+    messages[3]["content"] = "edited"
+    build_context(messages, "gpt-4o")
+    assert len(hashed) == 11
@@ -0,0 +1,57 @@
+from utils.context import CHARS_PER_TOKEN
+from utils.drafts import DraftCheckpointer, draft_message, is_unfinished, continuation_history, CONTINUE_PROMPT
+
+
+def stream_into(checkpointer, pieces):
+    text = ""
+    for piece in pieces:
+        text += piece
+        checkpointer.update(text)
+    return text
+
+
+def test_checkpoints_every_n_tokens():
+    saved = []
+    checkpointer = DraftCheckpointer(saved.append, every_tokens=10, every_ms=10 ** 9)
+    # One token per piece
+    stream_into(checkpointer, ["x" * CHARS_PER_TOKEN] * 35)
+
+    assert checkpointer.checkpoints == 3
+    assert [len(text) // CHARS_PER_TOKEN for text in saved] == [10, 20, 30]
+
+
+def test_checkpoints_after_a_quiet_interval():
+    saved = []
+    checkpointer = DraftCheckpointer(saved.append, every_tokens=1000, every_ms=500)
+    assert not checkpointer.update("slow")
+
+    # Half a second later a single new token is enough
+    checkpointer.saved_at -= 0.6
+    assert checkpointer.update("slow start")
+    assert saved == ["slow start"]
+
+
+def test_nothing_new_is_not_saved_again():
+    saved = []
+    checkpointer = DraftCheckpointer(saved.append, every_tokens=1, every_ms=0)
+    assert checkpointer.update("done")
+    assert not checkpointer.update("done")
+    assert saved == ["done"]
+
+
+def test_drafts_and_cancelled_answers_can_be_continued():
+    assert is_unfinished(draft_message("half an answ"))
+    assert is_unfinished({"role": "assistant", "content": "stopped", "cancelled": True})
+    assert not is_unfinished({"role": "assistant", "content": "complete"})
+    assert not is_unfinished({"role": "user", "content": "hi", "draft": True})
+    assert not is_unfinished(None)
+
+
+def test_continuation_asks_for_the_rest_of_the_answer():
+    history = [{"role": "user", "content": "tell me a story"}, draft_message("Once upon")]
+    continued = continuation_history(history)
+
+    assert continued[:2] == [history[0], {"role": "assistant", "content": "Once upon"}]
+    assert continued[-1] == {"role": "user", "content": CONTINUE_PROMPT}
+    # The stored draft is left as it was
+    assert history[-1]["draft"]
@@ -0,0 +1,56 @@
+import time
+
+from utils.call_context import call_scope
+from utils.fanout import FanOutRun
+
+MODELS = ["OpenAI (gpt-4o)", "Anthropic (claude-3-5-sonnet-20241022)"]
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_every_model_answers(stub):
+    with call_scope(conversation_id="fanout-test", user="alice"):
+        run = FanOutRun("hello there", [{"role": "user", "content": "hello there"}], MODELS)
+
+    assert wait_until(run.is_done)
+    for option in MODELS:
+        result = run.results[option]
+        assert result["status"] == "done", result["response"]
+        assert "hello there" in result["response"]
+        assert result["prompt_tokens"] > 0
+
+
+def test_panes_fill_in_while_streaming(stub):
+    stub.state.config.responses = [" ".join(f"word{i}" for i in range(60))]
+    stub.state.config.tokens_per_second = 100
+
+    run = FanOutRun("go", [{"role": "user", "content": "go"}], MODELS[:1])
+    result = run.results[MODELS[0]]
+    assert wait_until(lambda: result["status"] == "running" and result["response"])
+    partial = result["response"]
+
+    assert wait_until(run.is_done)
+    assert result["status"] == "done"
+    assert len(partial) < len(result["response"])
+    assert result["response"].startswith(partial)
+
+
+def test_pick_cancels_the_others(stub):
+    stub.state.config.tokens_per_second = 20
+    stub.state.config.responses = [" ".join(f"word{i}" for i in range(200))]
+
+    run = FanOutRun("go", [{"role": "user", "content": "go"}], MODELS)
+    assert wait_until(lambda: all(r["response"] for r in run.results.values()))
+    run.pick(MODELS[0])
+
+    assert run.results[MODELS[1]]["status"] == "cancelled"
+    assert run.winner == MODELS[0]
+    run.cancel()
+    assert wait_until(run.is_done)
@@ -0,0 +1,76 @@
+import threading
+import uuid
+
+from utils import history_cache
+from utils.call_context import call_scope
+from utils.history_cache import format_history, invalidate_history
+
+
+def counting_convert():
+    calls = []
+
+    def convert(message):
+        calls.append(message["content"])
+        return {"text": message["content"]}
+    return convert, calls
+
+
+def history(count, prefix="m"):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"{prefix}{i}"} for i in range(count)]
+
+
+def test_only_new_messages_are_converted():
+    convert, calls = counting_convert()
+    messages = history(4)
+    with call_scope(conversation_id=str(uuid.uuid4()), user="alice"):
+        first = format_history("test", messages, convert)
+        messages.append({"role": "user", "content": "m4"})
+        second = format_history("test", messages, convert)
+
+    assert calls == ["m0", "m1", "m2", "m3", "m4"]
+    assert second[:4] == first and second[4] == {"text": "m4"}
+
+
+def test_rejected_messages_are_not_cached():
+    convert, calls = counting_convert()
+    messages = history(2) + [{"role": "user", "content": "picture", "image": "aGVsbG8="}]
+    with call_scope(conversation_id=str(uuid.uuid4()), user="alice"):
+        for _ in range(3):
+            format_history("test", messages, convert, cache_if=lambda msg: not msg.get("image"))
+
+    assert calls.count("picture") == 3
+    assert calls.count("m0") == 1
+
+
+def test_invalidated_conversation_is_not_refilled_by_a_call_in_flight():
+    conversation_id = str(uuid.uuid4())
+
+    def convert(message):
+        invalidate_history(conversation_id)
+        return message["content"]
+
+    with call_scope(conversation_id=conversation_id, user="alice"):
+        assert format_history("test", history(3), convert) == ["m0", "m1", "m2"]
+    assert (conversation_id, "test") not in history_cache._caches
+
+
+def test_concurrent_calls_while_entries_are_pruned():
+    conversation_id = str(uuid.uuid4())
+    errors = []
+
+    def worker(prefix):
+        try:
+            with call_scope(conversation_id=conversation_id, user="alice"):
+                for size in range(1, 60):
+                    # Each call sends a different history, so the others' entries get pruned
+                    messages = history(size % 7 + 1, prefix=f"{prefix}-{size}-")
+                    assert format_history("test", messages, lambda m: m["content"]) == [m["content"] for m in messages]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(name,)) for name in "abcd"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
@@ -0,0 +1,70 @@
+import base64
+import io
+import random
+
+from PIL import Image
+
+from utils import images
+from utils.images import prepare_image, PROVIDER_MAX_DIMENSIONS
+
+
+def encode(image, format, **options):
+    output = io.BytesIO()
+    image.save(output, format=format, **options)
+    return output.getvalue()
+
+
+def noisy(size, mode="RGB"):
+    # Random pixels compress badly, so re-encoding is worth it
+    return Image.frombytes(mode, size, random.Random(1).randbytes(size[0] * size[1] * len(mode)))
+
+
+def test_large_images_are_downsized_for_each_provider():
+    raw = encode(noisy((4000, 2000)), "PNG")
+
+    prepared = prepare_image(raw, "anthropic")
+    assert (prepared.width, prepared.height) == (1568, 784)
+    assert prepared.mime_type == "image/jpeg"
+    assert Image.open(io.BytesIO(prepared.data)).size == (1568, 784)
+
+    assert max(prepare_image(raw, "openai")[2:4]) == PROVIDER_MAX_DIMENSIONS["openai"]
+
+
+def test_transparency_is_kept_as_png():
+    raw = encode(noisy((3000, 100), mode="RGBA"), "PNG")
+    prepared = prepare_image(raw, "openai")
+
+    assert prepared.mime_type == "image/png"
+    assert Image.open(io.BytesIO(prepared.data)).mode == "RGBA"
+
+
+def test_large_png_photo_is_reencoded_as_jpeg():
+    raw = encode(noisy((800, 600)), "PNG")
+    prepared = prepare_image(raw, "gemini")
+
+    assert prepared.mime_type == "image/jpeg"
+    assert len(prepared.data) < len(raw)
+    assert (prepared.width, prepared.height) == (800, 600)
+
+
+def test_small_compact_images_are_sent_as_they_are():
+    jpeg = encode(Image.new("RGB", (200, 100), "red"), "JPEG")
+    prepared = prepare_image(base64.b64encode(jpeg).decode("utf-8"), "openai")
+    assert prepared.data == jpeg and prepared.mime_type == "image/jpeg"
+
+    # A flat PNG graphic would only grow as a JPEG
+    png = encode(Image.new("RGB", (200, 100), "blue"), "PNG", optimize=True)
+    prepared = prepare_image(png, "openai")
+    assert prepared.data == png and prepared.mime_type == "image/png"
+
+
+def test_results_are_memoized_by_content(monkeypatch):
+    raw = encode(noisy((300, 300)), "PNG")
+    calls = []
+    process = images._process
+    monkeypatch.setattr(images, "_process", lambda *args: calls.append(1) or process(*args))
+
+    first = prepare_image(raw, "vertex")
+    assert prepare_image(base64.b64encode(raw).decode("utf-8"), "vertex") is first
+    prepare_image(raw, "anthropic")
+    assert len(calls) == 2
@@ -0,0 +1,138 @@
+import threading
+
+import pytest
+
+from utils import key_pool, models
+from utils.call_context import call_scope
+from utils.key_pool import KeyPool, KeysExhaustedError, parse_keys, get_key_pool, current_pool_key
+from utils.models import get_model_response
+from utils.resilience import RateLimitError, with_resilience, get_provider_health, BREAKER_FAILURE_THRESHOLD
+
+
+def make_pool(value="key-a,key-b"):
+    return KeyPool("test", "TEST_API_KEY", parse_keys(value))
+
+
+def rate_limited_call(pool, retry_after=None):
+    with pytest.raises(RateLimitError) as raised:
+        with pool.checkout() as api_key:
+            raise RateLimitError("test", "slow down", 429, retry_after=retry_after)
+    return api_key, raised.value
+
+
+def test_keys_are_parsed_with_weights():
+    keys = parse_keys("key-a, key-b:2,,sk:colon:key")
+    assert [(k.key, k.weight) for k in keys] == [("key-a", 1.0), ("key-b", 2.0), ("sk:colon:key", 1.0)]
+
+
+def test_weights_must_be_positive():
+    for value in ("key-a:0,key-b", "key-a:-1"):
+        with pytest.raises(ValueError, match="must be positive"):
+            parse_keys(value)
+
+
+def test_load_follows_the_weights():
+    pool = make_pool("key-a,key-b:3")
+    for _ in range(8):
+        with pool.checkout():
+            pass
+    requests = {k.key: k.requests for k in pool.keys}
+    assert requests == {"key-a": 2, "key-b": 6}
+
+
+def test_key_is_visible_only_inside_the_checkout():
+    pool = make_pool()
+    with pool.checkout() as api_key:
+        assert current_pool_key("TEST_API_KEY") == api_key
+    assert current_pool_key("TEST_API_KEY") is None
+
+
+def test_rate_limited_key_is_quarantined_and_the_retry_moves_on():
+    pool = make_pool()
+    limited, error = rate_limited_call(pool, retry_after=30)
+
+    # Another key is free, so the retry should not wait out the Retry-After
+    assert error.retry_after is None
+    limited_key = next(k for k in pool.keys if k.key == limited)
+    assert 29 < limited_key.quarantined_for() <= 30
+    for _ in range(3):
+        with pool.checkout() as api_key:
+            assert api_key != limited
+
+
+def test_quarantine_doubles_and_ends(monkeypatch):
+    monkeypatch.setattr(key_pool, "BACKOFF_BASE_SECONDS", 10)
+    monkeypatch.setattr(key_pool, "BACKOFF_MAX_SECONDS", 100)
+    pool = make_pool()
+    first, _ = rate_limited_call(pool)
+    limited = next(k for k in pool.keys if k.key == first)
+    assert 9 < limited.quarantined_for() <= 10
+
+    # Both keys out: the caller has to wait for the sooner one
+    rate_limited_call(pool)
+    with pytest.raises(KeysExhaustedError) as exhausted:
+        with pool.checkout():
+            pass
+    assert 9 < exhausted.value.retry_after <= 10
+
+    limited.quarantined_until = 0
+    assert rate_limited_call(pool)[0] == first
+    assert 19 < limited.quarantined_for() <= 20
+
+    # A success after the quarantine clears the strikes
+    limited.quarantined_until = 0
+    with pool.checkout():
+        pass
+    assert limited.strikes == 0
+
+
+def test_single_key_is_left_to_the_retry_backoff():
+    pool = make_pool("key-a")
+    _, error = rate_limited_call(pool, retry_after=5)
+
+    # The Retry-After reaches the caller, and the key stays usable
+    assert error.retry_after == 5
+    assert pool.keys[0].quarantined_for() == 0
+    with pool.checkout() as api_key:
+        assert api_key == "key-a"
+
+
+def test_exhausted_pool_does_not_open_the_breaker():
+    pool = make_pool()
+    for _ in range(2):
+        rate_limited_call(pool, retry_after=600)
+
+    @with_resilience("test")
+    def call():
+        with pool.checkout():
+            pass
+
+    for _ in range(BREAKER_FAILURE_THRESHOLD + 1):
+        with pytest.raises(KeysExhaustedError):
+            call()
+    assert get_provider_health()["test"]["state"] == "closed"
+
+
+def test_concurrent_gemini_calls_use_their_own_keys(stub, monkeypatch):
+    monkeypatch.setenv("GEMINI_API_KEYS", "gemini-key-a,gemini-key-b")
+    monkeypatch.setattr(key_pool, "_pools", {})
+    monkeypatch.setattr(models, "_gemini_clients", {})
+    history = [{"role": "user", "content": "which key"}]
+    answers = []
+
+    def call(index):
+        with call_scope(conversation_id=f"key-pool-{index}", user="alice"):
+            answers.append(get_model_response("Gemini", "which key", history))
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(answers) == 8 and all("which key" in a for a in answers)
+    # Every request reached the server with the key checked out for it
+    checked_out = {k.key: k.requests for k in get_key_pool("gemini").keys}
+    assert stub.state.key_counts == checked_out
+    assert set(checked_out) == {"gemini-key-a", "gemini-key-b"}
+    assert len(models._gemini_clients) == 2
@@ -0,0 +1,73 @@
+import base64
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+
+from utils import media_cache
+from utils.call_context import call_scope
+from utils.media_cache import get_media_ref, forget_media_refs
+from utils.models import get_model_response
+
+VERTEX_GEMINI = "Vertex AI (gemini-2.5-pro-preview-03-25)"
+
+
+def image_b64(color="red"):
+    output = io.BytesIO()
+    Image.new("RGB", (64, 64), color).save(output, format="JPEG")
+    return base64.b64encode(output.getvalue()).decode("utf-8")
+
+
+@pytest.fixture
+def bucket(stub, monkeypatch):
+    monkeypatch.setattr(media_cache, "MEDIA_BUCKET", "test-media")
+    monkeypatch.setattr(media_cache, "MEDIA_UPLOAD_URL", os.environ["AI_MOCK_SERVER_URL"] + "/upload/storage/v1/b/{bucket}/o")
+    monkeypatch.setattr(media_cache, "_refs_by_hash", {})
+    return stub
+
+
+def test_image_is_uploaded_once_and_referenced(bucket):
+    first = {"role": "user", "content": "look", "image": image_b64()}
+    second = {"role": "user", "content": "again", "image": first["image"]}
+
+    ref = get_media_ref(first["image"], first)
+    assert ref["uri"] == f"gs://test-media/media/{ref['sha256']}"
+    assert first["media_ref"] is ref
+    # Same message, and another message with the same image, reuse the upload
+    assert get_media_ref(first["image"], first) is ref
+    assert get_media_ref(second["image"], second)["uri"] == ref["uri"]
+    assert bucket.state.upload_count == 1
+
+
+def test_expired_and_forgotten_references_are_uploaded_again(bucket):
+    message = {"role": "user", "content": "look", "image": image_b64("blue")}
+    ref = get_media_ref(message["image"], message)
+
+    ref["expires_at"] = time.time()
+    assert get_media_ref(message["image"], message)["expires_at"] > time.time() + 3600
+    assert bucket.state.upload_count == 2
+
+    forget_media_refs([message])
+    assert "media_ref" not in message
+    get_media_ref(message["image"], message)
+    assert bucket.state.upload_count == 3
+
+
+def test_vertex_turns_send_references_and_recover_from_a_removed_object(bucket):
+    history = [
+        {"role": "user", "content": "what is this", "image": image_b64("green")},
+        {"role": "assistant", "content": "a green square"},
+    ]
+    with call_scope(conversation_id="media-test", user="alice"):
+        assert "sure?" in get_model_response(VERTEX_GEMINI, "sure?", history)
+        assert "sure?" in get_model_response(VERTEX_GEMINI, "sure?", history)
+    assert bucket.state.upload_count == 1
+
+    # The bucket's lifecycle rule removed the object while the reference still looks fresh
+    bucket.state.objects.clear()
+    with call_scope(conversation_id="media-test", user="alice"):
+        assert "sure?" in get_model_response(VERTEX_GEMINI, "sure?", history)
+    assert bucket.state.upload_count == 2
+    assert ("test-media", f"media/{history[0]['media_ref']['sha256']}") in bucket.state.objects
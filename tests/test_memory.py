@@ -0,0 +1,116 @@
+import threading
+import uuid
+from concurrent.futures import wait
+
+import pytest
+
+from utils import memory
+from utils.call_context import call_scope, current_call, cancel_calls
+from utils.memory import new_memory_state, schedule_summary, collect_summary, apply_summary
+
+
+def long_history(turns=40, size=1200):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i} " + "w" * size}
+        for i in range(turns)
+    ]
+
+
+def wait_for(key):
+    wait([memory._pending[key]], timeout=5)
+
+
+def test_short_history_is_not_summarized():
+    state = new_memory_state()
+    assert not schedule_summary(str(uuid.uuid4()), long_history(turns=4, size=40), state, summarizer=lambda p: "s")
+
+
+def test_summary_replaces_older_turns_and_keeps_recent_ones():
+    key = str(uuid.uuid4())
+    messages = long_history()
+    state = new_memory_state()
+    prompts = []
+
+    assert schedule_summary(key, messages, state, summarizer=lambda p: prompts.append(p) or "the gist")
+    wait_for(key)
+    assert collect_summary(key, state)
+
+    cut = state["summarized_count"]
+    assert 0 < cut < len(messages)
+    assert messages[cut]["role"] == "user"
+    assert "0 www" in prompts[0]
+
+    history = apply_summary(messages, state)
+    assert history[0]["summary"] and history[0]["pinned"]
+    assert "the gist" in history[0]["content"]
+    assert history[1:] == messages[cut:]
+
+
+def test_one_job_per_conversation():
+    key = str(uuid.uuid4())
+    release = threading.Event()
+
+    def slow(prompt):
+        release.wait(5)
+        return "done"
+
+    state = new_memory_state()
+    assert schedule_summary(key, long_history(), state, summarizer=slow)
+    assert not schedule_summary(key, long_history(), state, summarizer=slow)
+    assert not collect_summary(key, state)
+    release.set()
+    wait_for(key)
+    assert collect_summary(key, state)
+
+
+def test_failed_summary_is_raised_from_collect():
+    key = str(uuid.uuid4())
+    state = new_memory_state()
+
+    def broken(prompt):
+        raise RuntimeError("summarizer down")
+
+    assert schedule_summary(key, long_history(), state, summarizer=broken)
+    wait_for(key)
+    with pytest.raises(RuntimeError, match="summarizer down"):
+        collect_summary(key, state)
+    assert state == new_memory_state()
+    # The failed job is dropped so the next turn can try again
+    assert schedule_summary(key, long_history(), state, summarizer=lambda p: "ok")
+
+
+def test_worker_runs_in_its_own_scope_for_the_same_user():
+    key = str(uuid.uuid4())
+    seen = {}
+
+    def capture(prompt):
+        context = current_call()
+        seen.update(user=context.user, conversation=context.conversation_id, cancelled=context.cancelled)
+        return "ok"
+
+    with call_scope(conversation_id=key, user="alice", timeout=0.001) as scope:
+        assert schedule_summary(key, long_history(), new_memory_state(), summarizer=capture)
+        scope.cancel("cleared")
+    wait_for(key)
+
+    # Metered for the caller, but not cut off by the turn that scheduled it
+    assert seen == {"user": "alice", "conversation": key, "cancelled": False}
+
+
+def test_summary_job_is_cancelled_with_the_conversation():
+    key = str(uuid.uuid4())
+    started = threading.Event()
+    outcome = {}
+
+    def waits_for_cancel(prompt):
+        started.set()
+        context = current_call()
+        outcome["cancelled"] = context.cancel_event.wait(5)
+        return None
+
+    with call_scope(conversation_id=key, user="bob"):
+        schedule_summary(key, long_history(), new_memory_state(), summarizer=waits_for_cancel)
+    assert started.wait(5)
+    assert cancel_calls(key, "cleared") == 1
+    wait_for(key)
+    assert outcome["cancelled"]
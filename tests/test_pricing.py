@@ -0,0 +1,27 @@
+import pytest
+
+from utils.call_context import call_scope, report_usage
+from utils.pricing import estimate_cost
+
+
+def test_anthropic_cache_writes_are_part_of_the_input():
+    # 1000 uncached at $3, 2000 read at $0.30 and 7000 written at $3.75 per million
+    cost = estimate_cost("claude-3-5-sonnet-20241022", 10_000, 0, cached_tokens=2000, cache_write_tokens=7000, provider="anthropic")
+    assert cost == pytest.approx((1000 * 3.00 + 2000 * 0.30 + 7000 * 3.75) / 1_000_000)
+
+
+def test_gemini_cache_writes_are_billed_on_top_of_the_input():
+    # The cache was created in a separate request: all 10000 prompt tokens
+    # were sent, 8000 of them read from the cache, and 8000 written before
+    cost = estimate_cost("gemini-1.5-pro", 10_000, 500, cached_tokens=8000, cache_write_tokens=8000, provider="gemini")
+    assert cost == pytest.approx((2000 * 1.25 + 8000 * 0.3125 + 8000 * 1.25 + 500 * 5.00) / 1_000_000)
+
+
+def test_reported_usage_is_priced_for_its_provider():
+    with call_scope(conversation_id="pricing", user="alice"):
+        record = report_usage("gemini", "gemini-1.5-pro", input_tokens=10_000, cached_tokens=8000, cache_write_tokens=8000)
+    assert record["cost"] == pytest.approx((2000 * 1.25 + 8000 * 0.3125 + 8000 * 1.25) / 1_000_000)
+
+
+def test_unknown_models_cost_nothing():
+    assert estimate_cost("mystery-model", 1000, 1000) == 0.0
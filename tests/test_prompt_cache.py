@@ -0,0 +1,131 @@
+import uuid
+
+import pytest
+
+from utils import prompt_cache, key_pool
+from utils.call_context import call_scope
+from utils.context import build_context
+from utils.models import get_model_response
+from utils.prompt_cache import get_cached_prefix, get_cache_min_tokens, record_cache_usage, get_cache_stats
+from utils.resilience import TransientProviderError
+
+VERTEX_GEMINI = "Vertex AI (gemini-2.5-pro-preview-03-25)"
+
+
+class ApiError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def long_conversation(turns=30):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "q" * 800})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "a" * 2400})
+    return messages
+
+
+def test_minimum_size_follows_the_model():
+    assert get_cache_min_tokens("gemini-2.5-flash-001") == 1024
+    assert get_cache_min_tokens("gemini-2.5-pro-preview-03-25") == 4096
+    assert get_cache_min_tokens("gemini-1.5-pro") == 4096
+
+
+def ask_twice(stub, model, conversation_id, before_turn=lambda turn: None):
+    messages = long_conversation()
+    cached = []
+    caches_created = []
+
+    for turn, question in enumerate(("first follow-up", "second follow-up")):
+        before_turn(turn)
+        messages.append({"role": "user", "content": question})
+        history = build_context(messages, "gemini-2.5-pro-preview-03-25")
+        with call_scope(conversation_id=conversation_id, user="alice") as scope:
+            answer = get_model_response(model, question, history)
+        cached.append(scope.usage[-1]["cached_tokens"])
+        caches_created.append(stub.state.request_counts.get("cached_contents", 0))
+        messages.append({"role": "assistant", "content": answer})
+    return cached, caches_created
+
+
+@pytest.mark.parametrize("model", [VERTEX_GEMINI, "Gemini"])
+def test_second_turn_of_a_long_conversation_reads_the_cache(stub, model):
+    conversation_id = str(uuid.uuid4())
+    cached, caches_created = ask_twice(stub, model, conversation_id)
+
+    # The first turn writes the cache, the second reads the same one
+    assert caches_created == [1, 1]
+    assert cached[1] > get_cache_min_tokens("gemini-2.5-pro-preview-03-25")
+    assert get_cache_stats(conversation_id)["hit_ratio"] > 0
+
+
+def test_gemini_caches_are_kept_per_api_key(stub, monkeypatch):
+    monkeypatch.setattr(key_pool, "_pools", {})
+
+    def switch_key(turn):
+        # Caches created under one key's project cannot be read with another
+        monkeypatch.setenv("GEMINI_API_KEYS", f"gemini-key-{turn}")
+        key_pool._pools.clear()
+
+    _, caches_created = ask_twice(stub, "Gemini", str(uuid.uuid4()), switch_key)
+    assert caches_created == [1, 2]
+    assert stub.state.key_counts == {"gemini-key-0": 1, "gemini-key-1": 1}
+
+
+def history_for_cache():
+    return long_conversation(turns=6) + [{"role": "user", "content": "now"}]
+
+
+def test_retryable_cache_errors_are_raised_without_marking_the_model():
+    def create_cache(count):
+        raise ApiError(503, "backend unavailable")
+
+    with pytest.raises(TransientProviderError):
+        get_cached_prefix(str(uuid.uuid4()), "gemini", "gemini-retry", history_for_cache(), create_cache)
+    assert ("gemini", "gemini-retry") not in prompt_cache._unsupported_models
+
+
+def test_only_unsupported_models_stop_trying():
+    def too_small(count):
+        raise ApiError(400, "Cached content is too small")
+
+    def unsupported(count):
+        raise ApiError(400, "Model gemini-x does not support createCachedContent")
+
+    assert get_cached_prefix(str(uuid.uuid4()), "gemini", "gemini-small", history_for_cache(), too_small) == (None, 0)
+    assert ("gemini", "gemini-small") not in prompt_cache._unsupported_models
+
+    assert get_cached_prefix(str(uuid.uuid4()), "gemini", "gemini-x", history_for_cache(), unsupported) == (None, 0)
+    assert ("gemini", "gemini-x") in prompt_cache._unsupported_models
+
+
+def test_per_conversation_state_is_bounded(monkeypatch):
+    monkeypatch.setattr(prompt_cache, "PROMPT_CACHE_MAX_CONVERSATIONS", 3)
+    for _ in range(5):
+        conversation_id = str(uuid.uuid4())
+        get_cached_prefix(conversation_id, "gemini", "gemini-lru", history_for_cache(), lambda count: object())
+        record_cache_usage({"conversation_id": conversation_id, "input_tokens": 10, "cached_tokens": 0, "cache_write_tokens": 0})
+
+    assert len(prompt_cache._prefix_caches) <= 3
+    assert len(prompt_cache._stats) <= 3
+    # The newest conversation is kept
+    assert get_cache_stats(conversation_id)["calls"] == 1
+
+
+def test_same_size_images_do_not_share_a_cache():
+    conversation_id = str(uuid.uuid4())
+    history = history_for_cache()
+    history[0] = dict(history[0], image="A" * 1000)
+    created = []
+
+    def create_cache(count):
+        created.append(count)
+        return object()
+
+    first, covered = get_cached_prefix(conversation_id, "gemini", "gemini-images", history, create_cache)
+    assert first is not None and covered
+    # Another image of exactly the same size must not reuse the cached prefix
+    history[0] = dict(history[0], image="B" * 1000)
+    second, _ = get_cached_prefix(conversation_id, "gemini", "gemini-images", history, create_cache)
+    assert second is not first and len(created) == 2
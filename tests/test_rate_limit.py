@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from utils.resilience import CallCancelledError, with_resilience, get_provider_health
+from utils.rate_limit import (
+    TokenBucket,
+    ProviderRateLimiter,
+    RateLimitTimeoutError,
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    rate_limited,
+)
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    # One token per second
+    assert bucket.wait_time(1) == pytest.approx(1.0, abs=0.05)
+    bucket.updated -= 2
+    assert bucket.wait_time(2) == 0
+
+
+def test_oversized_request_waits_for_a_full_bucket():
+    bucket = TokenBucket(per_minute=60)
+    bucket.take(30)
+    assert bucket.wait_time(1000) == pytest.approx(30.0, abs=0.1)
+    bucket.level = bucket.capacity
+    assert bucket.wait_time(1000) == 0
+
+
+def test_acquire_times_out_when_over_budget():
+    limiter = ProviderRateLimiter("p", rpm=1, tpm=100000)
+    limiter.acquire(10)
+    with pytest.raises(RateLimitTimeoutError):
+        limiter.acquire(10, deadline=time.monotonic() + 0.05)
+    assert limiter.stats()["timeouts"] == 1
+
+
+def test_acquire_stops_waiting_when_cancelled():
+    limiter = ProviderRateLimiter("p", rpm=1, tpm=100000)
+    limiter.acquire(10)
+    cancel = threading.Event()
+    threading.Timer(0.05, cancel.set).start()
+    with pytest.raises(CallCancelledError):
+        limiter.acquire(10, deadline=time.monotonic() + 5, cancel_event=cancel)
+
+
+def test_higher_priority_is_served_first():
+    # Two requests per second once drained
+    limiter = ProviderRateLimiter("p", rpm=120, tpm=1000000)
+    limiter.requests.level = 0
+    order = []
+
+    def call(name, priority):
+        limiter.acquire(1, priority=priority, deadline=time.monotonic() + 5)
+        order.append(name)
+
+    low = threading.Thread(target=call, args=("low", PRIORITY_LOW))
+    low.start()
+    # Let the low priority caller take the head of the queue first
+    time.sleep(0.05)
+    high = threading.Thread(target=call, args=("high", PRIORITY_HIGH))
+    high.start()
+    low.join()
+    high.join()
+    assert order == ["high", "low"]
+
+
+def test_queue_timeout_does_not_count_against_provider_health(monkeypatch):
+    monkeypatch.setenv("LIMITED_RPM", "1")
+
+    @with_resilience("limited")
+    @rate_limited("limited", max_wait=0.05)
+    def call(prompt, message_history):
+        return "ok"
+
+    assert call("hi", []) == "ok"
+    with pytest.raises(RateLimitTimeoutError):
+        call("hi", [])
+
+    health = get_provider_health()["limited"]
+    assert health["failures"] == 0 and health["last_error"] is None
+    assert health["state"] == "closed"
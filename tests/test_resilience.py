@@ -0,0 +1,152 @@
+import pytest
+
+from utils import resilience
+from utils.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    ProviderError,
+    RateLimitError,
+    TransientProviderError,
+    call_with_resilience,
+    error_from_response,
+    get_breaker,
+    get_provider_health,
+)
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = "error"
+
+
+def failing(errors, result="ok"):
+    """A provider function that raises the given errors in turn, then succeeds."""
+    errors = list(errors)
+
+    def call():
+        call.attempts += 1
+        if errors:
+            raise errors.pop(0)
+        return result
+    call.attempts = 0
+    return call
+
+
+def test_breaker_opens_after_threshold_and_recovers_through_one_trial(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(resilience.time, "time", lambda: clock[0])
+    breaker = CircuitBreaker(failure_threshold=2, recovery_seconds=10)
+
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    clock[0] += 10
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    # Only one trial call at a time
+    assert not breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.consecutive_failures == 0
+
+
+def test_transient_errors_are_retried():
+    call = failing([TransientProviderError("p1", "503", 503)])
+    assert call_with_resilience("p1", call) == "ok"
+    assert call.attempts == 2
+
+    health = get_provider_health()["p1"]
+    assert health["retries"] == 1 and health["failures"] == 1 and health["successes"] == 1
+
+
+def test_gives_up_after_max_attempts_and_opens_breaker(monkeypatch):
+    monkeypatch.setattr(resilience, "MAX_ATTEMPTS", 3)
+    get_breaker("p2").failure_threshold = 3
+    call = failing([TransientProviderError("p2", "503", 503)] * 5)
+
+    with pytest.raises(TransientProviderError):
+        call_with_resilience("p2", call)
+    assert call.attempts == 3
+    assert get_breaker("p2").state == "open"
+
+    with pytest.raises(CircuitOpenError):
+        call_with_resilience("p2", failing([]))
+    assert get_provider_health()["p2"]["rejected"] == 1
+
+
+def test_non_retryable_error_does_not_reset_failure_count():
+    breaker = get_breaker("p3")
+    breaker.record_failure()
+    breaker.record_failure()
+    call = failing([ProviderError("p3", "bad request", 400)])
+
+    with pytest.raises(ProviderError):
+        call_with_resilience("p3", call)
+    assert call.attempts == 1
+    assert breaker.consecutive_failures == 2
+
+
+def test_non_retryable_error_frees_the_half_open_trial():
+    breaker = get_breaker("p4")
+    breaker.state = "open"
+    breaker.opened_at = 0
+    breaker.consecutive_failures = 5
+
+    with pytest.raises(ProviderError):
+        call_with_resilience("p4", failing([ProviderError("p4", "bad request", 400)]))
+    assert breaker.state == "half_open"
+    assert breaker.consecutive_failures == 5
+    # The next call may still probe the provider
+    assert call_with_resilience("p4", failing([])) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_retry_after_longer_than_limit_is_not_waited_for(monkeypatch):
+    monkeypatch.setattr(resilience, "MAX_RETRY_AFTER_SECONDS", 1)
+    call = failing([RateLimitError("p5", "slow down", retry_after=60)])
+    with pytest.raises(RateLimitError):
+        call_with_resilience("p5", call)
+    assert call.attempts == 1
+
+
+def test_conflict_is_not_retryable():
+    assert not error_from_response("p", FakeResponse(409)).retryable
+    assert error_from_response("p", FakeResponse(503)).retryable
+    error = error_from_response("p", FakeResponse(429, {"retry-after": "2"}))
+    assert isinstance(error, RateLimitError) and error.retry_after == 2
+
+
+def test_stub_server_errors_are_retried_then_surfaced(stub):
+    from utils.models import get_perplexity_response
+
+    stub.state.config.error_5xx_rate = 1.0
+    with pytest.raises(TransientProviderError):
+        get_perplexity_response("hi", [{"role": "user", "content": "hi"}], model_name="pplx-70b-online")
+    assert stub.state.fault_counts["5xx"] == resilience.MAX_ATTEMPTS
+
+    stub.state.config.error_5xx_rate = 0.0
+    assert "hi" in get_perplexity_response("hi", [{"role": "user", "content": "hi"}], model_name="pplx-70b-online")
+    assert get_provider_health()["perplexity"]["state"] == "closed"
+
+
+@pytest.mark.parametrize("name", ["get_openai_response", "get_anthropic_response", "stream_openai_response", "stream_anthropic_response"])
+def test_sdk_clients_do_not_retry_on_their_own(stub, name):
+    from utils import models
+
+    stub.state.config.error_5xx_rate = 1.0
+    with pytest.raises(TransientProviderError):
+        result = getattr(models, name)("hi", [{"role": "user", "content": "hi"}])
+        if name.startswith("stream"):
+            list(result)
+    # One upstream request per with_resilience attempt, none hidden inside the SDK
+    assert stub.state.fault_counts["5xx"] == resilience.MAX_ATTEMPTS
+    assert get_provider_health()[name.split("_")[1]]["failures"] == resilience.MAX_ATTEMPTS
@@ -0,0 +1,78 @@
+import pytest
+
+from utils import routing
+from utils.call_context import call_scope
+from utils.models import stream_model_response, supports_streaming
+from utils.resilience import get_breaker
+from utils.routing import parse_slo, rank_candidates, record_call, get_model_stats, get_routing_stats
+
+
+@pytest.fixture(autouse=True)
+def fresh_routing(monkeypatch):
+    monkeypatch.setattr(routing, "_samples", {})
+    monkeypatch.setattr(routing, "_last_decisions", {})
+    monkeypatch.setattr(routing, "ROUTING_EXPLORE_RATE", 0.0)
+    monkeypatch.setitem(routing.CAPABILITY_TIERS, "test", ["OpenAI (gpt-4o)", "Anthropic (claude-3-5-sonnet-20241022)"])
+
+
+def record(option, count, latency=0.5, ttft=None, ok=True, cost=0.01):
+    for _ in range(count):
+        record_call(option, latency, ok, ttft=ttft, cost=cost)
+
+
+def test_parse_slo():
+    assert parse_slo("p95 ttft < 1.5s") == ("ttft", 0.95, 1.5)
+    assert parse_slo("p99 latency < 800ms") == ("latency", 0.99, 0.8)
+    with pytest.raises(ValueError):
+        parse_slo("fast please")
+
+
+def test_cheapest_model_meeting_the_slo_goes_first():
+    record("OpenAI (gpt-4o)", 10, ttft=0.3, cost=0.02)
+    record("Anthropic (claude-3-5-sonnet-20241022)", 10, ttft=0.4, cost=0.01)
+    assert rank_candidates("test", "p95 ttft < 1s")[0] == "Anthropic (claude-3-5-sonnet-20241022)"
+
+
+def test_fastest_goes_first_when_none_meet_the_slo():
+    record("OpenAI (gpt-4o)", 10, ttft=3.0, cost=0.001)
+    record("Anthropic (claude-3-5-sonnet-20241022)", 10, ttft=2.0, cost=0.05)
+    assert rank_candidates("test", "p95 ttft < 1s")[0] == "Anthropic (claude-3-5-sonnet-20241022)"
+
+
+def test_failing_models_and_open_breakers_go_last():
+    record("OpenAI (gpt-4o)", 10, ttft=0.1, ok=False)
+    assert rank_candidates("test")[-1] == "OpenAI (gpt-4o)"
+
+    routing._samples.clear()
+    breaker = get_breaker("anthropic")
+    breaker.state, breaker.opened_at = "open", 10 ** 12
+    assert rank_candidates("test")[-1] == "Anthropic (claude-3-5-sonnet-20241022)"
+
+
+def test_total_latency_is_not_taken_for_time_to_first_token():
+    # Answered in one piece: slow overall, but no first-token measurement
+    record("OpenAI (gpt-4o)", 10, latency=6.0, cost=0.001)
+    record("Anthropic (claude-3-5-sonnet-20241022)", 10, latency=1.0, ttft=0.2, cost=0.05)
+
+    stats = get_model_stats("OpenAI (gpt-4o)")
+    assert stats["ttft"] is None and stats["ttft_samples"] == 0
+    assert stats["latency"] == 6.0
+    # The TTFT SLO still counts as unmeasured for it, so the cheaper model stays first
+    assert rank_candidates("test", "p95 ttft < 1.5s")[0] == "OpenAI (gpt-4o)"
+    assert rank_candidates("test", "p95 latency < 2s")[0] == "Anthropic (claude-3-5-sonnet-20241022)"
+
+
+def test_auto_turns_stream_and_fail_over_before_the_first_chunk(stub, monkeypatch):
+    monkeypatch.setitem(routing.CAPABILITY_TIERS, "test", ["Nowhere (no-model)", "Perplexity (pplx-70b-online)"])
+    history = [{"role": "user", "content": "route me"}]
+    assert supports_streaming("Auto (test)")
+
+    with call_scope(conversation_id="routing-test", user="alice") as scope:
+        answer = "".join(stream_model_response("Auto (test)", "route me", history))
+
+    assert "route me" in answer
+    assert scope.route == "Perplexity (pplx-70b-online)"
+    last = get_routing_stats()["test"]["last"]
+    assert last["option"] == "Perplexity (pplx-70b-online)" and last["failovers"] == 1
+    stats = get_model_stats("Perplexity (pplx-70b-online)")
+    assert stats["ttft_samples"] == 1 and stats["ttft"] <= stats["latency"]
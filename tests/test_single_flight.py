@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+from utils.call_context import call_scope
+from utils.resilience import CallCancelledError
+from utils.single_flight import single_flight, get_single_flight_stats, _SharedStream
+
+
+def make_slow_call(delay=0.3):
+    calls = []
+
+    @single_flight("sf-test")
+    def call(prompt, message_history):
+        calls.append(prompt)
+        time.sleep(delay)
+        return f"answer to {prompt}"
+    return call, calls
+
+
+def run_in_scopes(fn, scopes, *args):
+    results = [None] * len(scopes)
+
+    def worker(index, conversation_id, user):
+        with call_scope(conversation_id=conversation_id, user=user):
+            try:
+                results[index] = fn(*args)
+            except Exception as e:
+                results[index] = e
+
+    threads = [threading.Thread(target=worker, args=(i,) + scope) for i, scope in enumerate(scopes)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_duplicates_in_one_conversation_share_the_call():
+    call, calls = make_slow_call()
+    shared_before = get_single_flight_stats()["shared"]
+
+    results = run_in_scopes(call, [("c1", "alice"), ("c1", "alice")], "hello", [])
+
+    assert results == ["answer to hello", "answer to hello"]
+    assert len(calls) == 1
+    assert get_single_flight_stats()["shared"] == shared_before + 1
+
+
+def test_other_users_and_conversations_are_not_merged():
+    call, calls = make_slow_call()
+    results = run_in_scopes(call, [("c1", "alice"), ("c1", "bob"), ("c2", "alice")], "hello", [])
+
+    assert results == ["answer to hello"] * 3
+    assert len(calls) == 3
+
+
+def test_follower_stops_at_its_own_deadline():
+    call, calls = make_slow_call(delay=1.0)
+    leader = threading.Thread(target=run_in_scopes, args=(call, [("c1", "alice")], "hello", []))
+    leader.start()
+    time.sleep(0.05)
+
+    start = time.monotonic()
+    with call_scope(conversation_id="c1", user="alice", timeout=0.2):
+        with pytest.raises(CallCancelledError):
+            call("hello", [])
+    assert time.monotonic() - start < 0.8
+    leader.join()
+    assert len(calls) == 1
+
+
+def test_streams_are_shared_chunk_by_chunk():
+    calls = []
+
+    @single_flight("sf-stream")
+    def stream(prompt, message_history):
+        calls.append(prompt)
+        for word in ("one", "two", "three"):
+            time.sleep(0.05)
+            yield word
+
+    results = run_in_scopes(lambda *a: list(stream(*a)), [("c1", "alice"), ("c1", "alice")], "count", [])
+    assert results == [["one", "two", "three"]] * 2
+    assert len(calls) == 1
+
+
+def test_reader_of_a_cancelled_stream_gets_an_error_not_a_short_answer():
+    release = threading.Event()
+
+    def upstream():
+        yield "first"
+        release.wait(5)
+        yield "second"
+        yield "third"
+
+    shared = _SharedStream("sf-cancel", "key", upstream())
+    shared.start()
+    reader = shared.read()
+    assert next(reader) == "first"
+    # The only reader leaves early, which cancels the upstream stream
+    reader.close()
+    assert shared.cancelled
+    release.set()
+
+    late = shared.read()
+    assert next(late) == "first"
+    with pytest.raises(CallCancelledError):
+        list(late)
@@ -0,0 +1,45 @@
+import time
+
+import pytest
+
+from utils import key_pool
+from utils.call_context import call_scope
+from utils.models import stream_model_response
+from utils.rate_limit import get_rate_limit_stats
+from utils.single_flight import get_single_flight_stats
+
+
+def wait_until(condition, timeout=5):
+    # The single-flight pump notices a departed reader at the next upstream chunk
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize("model, provider", [("OpenAI", "openai"), ("Anthropic", "anthropic"), ("Gemini", "gemini")])
+def test_stream_closed_midway_releases_its_slots_and_is_billed(stub, monkeypatch, model, provider):
+    for env_name in ("OPENAI_API_KEYS", "ANTHROPIC_API_KEYS", "GEMINI_API_KEYS"):
+        monkeypatch.setenv(env_name, "key-a,key-b")
+    monkeypatch.setattr(key_pool, "_pools", {})
+    prompt = "tell me a long story " * 20
+    history = [{"role": "user", "content": prompt}]
+
+    with call_scope(conversation_id="stream-close", user="alice") as scope:
+        stream = stream_model_response(model, prompt, history)
+        assert next(stream)
+        # The reader leaves, e.g. the Streamlit script was interrupted
+        stream.close()
+
+    pool = key_pool._pools[provider]
+    wait_until(lambda: all(k.in_flight == 0 for k in pool.keys))
+    assert sum(k.requests for k in pool.keys) == 1
+    assert get_single_flight_stats()["in_flight"] == 0
+    assert all(stats["queue_depth"] == 0 for stats in get_rate_limit_stats().values())
+
+    # The provider never sent its usage, so the part that was read is estimated
+    wait_until(lambda: scope.usage)
+    assert len(scope.usage) == 1
+    assert scope.usage[0]["provider"] == provider
+    assert scope.usage[0]["input_tokens"] > 100
+    assert 0 < scope.usage[0]["output_tokens"] < 100
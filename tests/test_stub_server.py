@@ -0,0 +1,140 @@
+import json
+import os
+import random
+import time
+
+import pytest
+import requests
+
+from utils.stub_server import MockConfig
+
+VERTEX_ROUTE = "/v1beta1/projects/p/locations/{region}/publishers/google/models/gemini-2.0-flash:generateContent"
+
+
+@pytest.fixture
+def url(stub):
+    return os.environ["AI_MOCK_SERVER_URL"]
+
+
+def configure(url, **values):
+    response = requests.post(f"{url}/__mock/config", json=values)
+    response.raise_for_status()
+    return response.json()
+
+
+def chat(url, text="hi there", **body):
+    return requests.post(f"{url}/v1/chat/completions", headers={"Authorization": "Bearer key-a"},
+                         json=dict({"model": "gpt-4o", "messages": [{"role": "user", "content": text}]}, **body), timeout=5)
+
+
+def test_rate_limited_requests_carry_a_retry_after(url, stub):
+    configure(url, error_429_rate=1)
+    response = chat(url)
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert response.json()["error"]["type"] == "rate_limit_exceeded"
+    anthropic = requests.post(f"{url}/v1/messages", json={"messages": []}, timeout=5)
+    assert anthropic.status_code == 429 and anthropic.json()["error"]["type"] == "rate_limit_error"
+    assert stub.state.fault_counts == {"429": 2}
+
+
+def test_server_errors_follow_the_configured_rate(url, stub):
+    configure(url, error_5xx_rate=0.5, seed=7)
+    statuses = [chat(url).status_code for _ in range(40)]
+
+    assert set(statuses) == {200, 503}
+    assert 10 <= statuses.count(503) <= 30
+    assert statuses.count(503) == stub.state.fault_counts["5xx"]
+    # The same seed replays the same faults
+    configure(url, seed=7)
+    assert [chat(url).status_code for _ in range(40)] == statuses
+
+
+def test_timeouts_drop_the_connection_without_an_answer(url):
+    configure(url, timeout_rate=1, timeout_seconds=0.2)
+    start = time.monotonic()
+    with pytest.raises(requests.ConnectionError):
+        chat(url)
+    assert time.monotonic() - start >= 0.2
+
+
+def test_streams_are_paced_at_the_token_rate(url):
+    configure(url, tokens_per_second=50)
+    start = time.monotonic()
+    response = chat(url, "one two three four five", stream=True, stream_options={"include_usage": True})
+    events = [json.loads(line[len("data: "):]) for line in response.iter_lines(decode_unicode=True)
+              if line.startswith("data: ") and line != "data: [DONE]"]
+    elapsed = time.monotonic() - start
+
+    pieces = [e["choices"][0]["delta"].get("content", "") for e in events if e["choices"]]
+    assert pieces[1:-1] == ["Echo: ", "one ", "two ", "three ", "four ", "five"]
+    # One token per word, fifty a second
+    assert elapsed >= 6 / 50
+    assert events[-1]["usage"]["completion_tokens"] > 0
+
+
+def test_scripted_responses_cycle_and_restart_on_reconfiguration(url):
+    configure(url, responses=["first", "second"])
+    answers = [chat(url).json()["choices"][0]["message"]["content"] for _ in range(3)]
+    assert answers == ["first", "second", "first"]
+
+    configure(url, latency_ms=0)
+    assert chat(url).json()["choices"][0]["message"]["content"] == "first"
+
+
+def test_config_and_stats_endpoints(url):
+    assert configure(url, latency_ms=5)["latency_ms"] == 5.0
+    assert requests.get(f"{url}/__mock/config").json()["latency_ms"] == 5.0
+    assert requests.post(f"{url}/__mock/config", json={"no_such_setting": 1}).status_code == 400
+
+    chat(url)
+    stats = requests.get(f"{url}/__mock/stats").json()
+    assert stats["requests"] == {"chat_completions": 1}
+    assert stats["faults"] == {}
+
+
+def test_regions_can_be_slowed_down_or_taken_down(url, stub):
+    configure(url, down_regions=["europe-west4"], region_latency_ms={"asia-northeast1": 200})
+    body = {"contents": [{"role": "user", "parts": [{"text": "hello"}]}]}
+
+    assert requests.post(url + VERTEX_ROUTE.format(region="europe-west4"), json=body).status_code == 503
+    start = time.monotonic()
+    answer = requests.post(url + VERTEX_ROUTE.format(region="asia-northeast1"), json=body)
+    assert time.monotonic() - start >= 0.2
+    assert answer.json()["candidates"][0]["content"]["parts"][0]["text"] == "Echo: hello"
+    assert requests.get(f"{url}/v1beta1/projects/p/locations/europe-west4").status_code == 503
+    # Down regions are not counted as injected faults
+    assert stub.state.fault_counts == {}
+
+
+def test_requests_are_counted_per_api_key(url, stub):
+    chat(url)
+    requests.post(f"{url}/v1/messages", headers={"x-api-key": "key-b"}, json={"messages": []})
+    requests.post(f"{url}/v1beta/models/gemini-1.5-pro:generateContent?key=key-c", json={"contents": []})
+    requests.post(f"{url}/v1beta/models/gemini-1.5-pro:generateContent", headers={"x-goog-api-key": "key-c"},
+                  json={"contents": []})
+    assert stub.state.key_counts == {"key-a": 1, "key-b": 1, "key-c": 2}
+
+
+def test_settings_are_read_from_the_environment(monkeypatch):
+    monkeypatch.setenv("MOCK_LATENCY_MS", "25")
+    monkeypatch.setenv("MOCK_ERROR_5XX_RATE", "0.1")
+    monkeypatch.setenv("MOCK_DOWN_REGIONS", '["us-central1"]')
+    config = MockConfig.from_env()
+
+    assert config.latency_ms == 25.0 and config.error_5xx_rate == 0.1
+    assert config.down_regions == ["us-central1"]
+    with pytest.raises(ValueError):
+        config.update({"latency_msec": 1})
+
+
+def test_first_byte_delay_follows_the_distribution():
+    rng = random.Random(1)
+    assert MockConfig(latency="fixed", latency_ms=300).first_byte_delay(rng) == 0.3
+    uniform = [MockConfig(latency="uniform", latency_ms=300).first_byte_delay(rng) for _ in range(200)]
+    assert 0 <= min(uniform) and max(uniform) <= 0.6
+    lognormal = sorted(MockConfig(latency_ms=300).first_byte_delay(rng) for _ in range(201))
+    # The configured latency is the median
+    assert 0.25 < lognormal[100] < 0.35
+    assert MockConfig(latency_ms=0).first_byte_delay(rng) == 0.0
@@ -0,0 +1,83 @@
+import json
+import os
+
+import pytest
+
+from utils import usage
+from utils.usage import record_usage_event, flush_usage, get_user_spend, check_budget, BudgetExceededError
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    # Events buffered by earlier tests go to the shared test ledger, not this one
+    flush_usage()
+    path = str(tmp_path / "usage_events.jsonl")
+    monkeypatch.setattr(usage, "USAGE_LOG_PATH", path)
+    monkeypatch.setattr(usage, "_spend", {})
+    monkeypatch.setattr(usage, "_log_path", None)
+    return path
+
+
+def spend(user, cost):
+    record_usage_event({"user": user, "conversation_id": "c", "provider": "openai", "model": "gpt-4o",
+                        "input_tokens": 10, "output_tokens": 5, "cached_tokens": 0, "cache_write_tokens": 0,
+                        "latency": 0.1, "cost": cost})
+
+
+def test_default_log_lives_in_the_data_directory():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(usage.__file__)))
+    assert usage.DATA_DIR == os.path.join(root, "data")
+
+
+def test_spend_is_read_from_the_log_and_then_kept_current(ledger):
+    spend("alice", 0.25)
+    spend("bob", 1.0)
+    flush_usage()
+
+    assert get_user_spend("alice") == pytest.approx(0.25)
+    spend("alice", 0.5)
+    assert get_user_spend("alice") == pytest.approx(0.75)
+    assert get_user_spend("bob") == pytest.approx(1.0)
+
+
+def test_only_appended_lines_are_read(ledger):
+    spend("alice", 0.25)
+    flush_usage()
+    assert get_user_spend("alice") == pytest.approx(0.25)
+
+    # Blank out what was already read: a rescan would lose alice's spend
+    with open(ledger, "r+") as f:
+        size = len(f.read())
+        f.seek(0)
+        f.write(" " * (size - 1) + "\n")
+    spend("bob", 1.0)
+    flush_usage()
+
+    usage._spend.clear()
+    assert get_user_spend("bob") == pytest.approx(1.0)
+    assert get_user_spend("alice") == pytest.approx(0.25)
+
+
+def test_half_written_line_is_read_once_complete(ledger):
+    event = dict(record_usage_event({"user": "carol", "provider": "openai", "model": "gpt-4o", "input_tokens": 1,
+                                     "output_tokens": 1, "cached_tokens": 0, "cache_write_tokens": 0, "cost": 2.0}))
+    usage._take_batch()
+    line = json.dumps(event) + "\n"
+    with open(ledger, "w") as f:
+        f.write(line[:15])
+    assert usage._jsonl_day_spend(event["at"][:10]) == {}
+
+    with open(ledger, "a") as f:
+        f.write(line[15:])
+    assert usage._jsonl_day_spend(event["at"][:10]) == {"carol": 2.0}
+
+
+def test_budget_is_enforced(ledger, monkeypatch):
+    monkeypatch.setattr(usage, "USER_BUDGETS", {"alice": 1.0})
+    spend("alice", 0.6)
+    check_budget("alice")
+    spend("alice", 0.6)
+    with pytest.raises(BudgetExceededError):
+        check_budget("alice")
+    # Users without a budget are never refused
+    check_budget("bob")
@@ -0,0 +1,95 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from utils import vertex_ai
+from utils.call_context import call_scope
+from utils.models import get_model_response, parse_model_option, MODEL_OPTIONS
+from utils.streaming import get_stream_stats
+from utils.vertex_ai import stream_vertex_live_response
+
+VERTEX_GEMINI = "Vertex AI (gemini-2.5-pro-preview-03-25)"
+
+
+class SlowCredentials:
+    """Credentials whose refresh takes a while and hands out a token valid for an hour."""
+    def __init__(self):
+        self.token = "old"
+        self.expiry = datetime.utcnow() + timedelta(seconds=10)
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        time.sleep(0.2)
+        self.token = "new"
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+
+def test_vertex_gemini_is_a_model_option():
+    assert VERTEX_GEMINI in MODEL_OPTIONS
+    assert parse_model_option(VERTEX_GEMINI) == ("vertex_gemini", "gemini-2.5-pro-preview-03-25")
+    assert parse_model_option("Gemini") == ("gemini", "gemini-1.5-pro")
+
+
+def test_vertex_gemini_answers_through_the_stub(stub):
+    history = [{"role": "user", "content": "hello vertex"}]
+    with call_scope(conversation_id="vertex-test", user="alice") as scope:
+        response = get_model_response(VERTEX_GEMINI, "hello vertex", history)
+
+    assert "hello vertex" in response
+    assert scope.usage and scope.usage[0]["provider"] == "vertex"
+
+
+def test_live_model_streams_chunk_by_chunk(stub):
+    stub.state.config.update({"responses": ["one two three four five"], "latency_ms": 200, "tokens_per_second": 20})
+    history = [{"role": "user", "content": "count to five"}]
+
+    with call_scope(conversation_id="vertex-live", user="alice") as scope:
+        stream = stream_vertex_live_response("count to five", history)
+        # Nothing is sent until the first chunk is asked for
+        time.sleep(0.3)
+        chunks = list(stream)
+
+    assert chunks == ["one ", "two ", "three ", "four ", "five"]
+    last = get_stream_stats()["vertex"]["last"]
+    assert last["chunks"] == 5 and not last["cancelled"]
+    # Time to first chunk covers the first byte delay, not the time before reading began
+    assert 0.2 <= last["ttfc"] < 0.3 + 0.2
+    assert 0.03 < last["mean_gap"] < 0.2
+    assert scope.usage[-1]["provider"] == "vertex"
+    assert scope.usage[-1]["output_tokens"] > 0
+
+
+def test_token_is_refreshed_once_outside_the_lock():
+    credentials = SlowCredentials()
+    threads = [threading.Thread(target=vertex_ai._refresh_if_needed, args=(credentials,)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+
+    # The lock is free while the refresh is on the network
+    time.sleep(0.05)
+    assert vertex_ai._auth_lock.acquire(timeout=0.05)
+    vertex_ai._auth_lock.release()
+
+    for thread in threads:
+        thread.join()
+    assert credentials.refreshes == 1
+    assert credentials.token == "new"
+
+
+def test_expired_token_waits_for_the_refresh():
+    credentials = SlowCredentials()
+    credentials.expiry = datetime.utcnow() - timedelta(seconds=1)
+    seen = []
+
+    def call():
+        vertex_ai._refresh_if_needed(credentials)
+        seen.append(credentials.token)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert credentials.refreshes == 1
+    assert seen == ["new", "new", "new"]
@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+from utils import vertex_regions
+from utils.call_context import call_scope
+from utils.models import get_model_response
+from utils.resilience import TransientProviderError, ProviderConfigError
+from utils.vertex_regions import call_in_regions, candidate_regions, probe_regions, get_region_stats
+
+VERTEX_GEMINI = "Vertex AI (gemini-2.5-pro-preview-03-25)"
+REGIONS = ["us-central1", "europe-west4", "asia-northeast1"]
+
+
+@pytest.fixture(autouse=True)
+def regions(monkeypatch):
+    monkeypatch.setattr(vertex_regions, "VERTEX_LOCATIONS", list(REGIONS))
+    monkeypatch.setattr(vertex_regions, "_regions", {
+        region: {"latency": None, "last_latency": None, "probe_ok": None, "probed_at": None,
+                 "calls": 0, "failures": 0, "down_until": 0.0, "last_error": None}
+        for region in REGIONS
+    })
+    monkeypatch.setattr(vertex_regions, "_chosen", REGIONS[0])
+    # No background probes unless a test runs one
+    monkeypatch.setattr(vertex_regions, "_probe_state", {"running": False, "last_started": time.monotonic(), "rounds": 0})
+
+
+def test_call_fails_over_to_the_next_region(stub):
+    stub.state.config.down_regions = ["us-central1"]
+    history = [{"role": "user", "content": "any region"}]
+
+    with call_scope(conversation_id="regions-test", user="alice"):
+        assert "any region" in get_model_response(VERTEX_GEMINI, "any region", history)
+    stats = get_region_stats()["regions"]
+    assert stats["us-central1"]["failures"] == 1 and not stats["us-central1"]["healthy"]
+    assert stats["europe-west4"]["calls"] == 1
+
+    # The failed region is skipped while it cools down
+    with call_scope(conversation_id="regions-test", user="alice"):
+        get_model_response(VERTEX_GEMINI, "any region", history)
+    stats = get_region_stats()["regions"]
+    assert stats["us-central1"]["calls"] == 1
+    assert stats["europe-west4"]["calls"] == 2
+
+
+def test_probes_send_calls_to_the_fastest_region(stub):
+    stub.state.config.region_latency_ms = {"us-central1": 200, "europe-west4": 5, "asia-northeast1": 100}
+    stub.state.config.down_regions = ["asia-northeast1"]
+    probe_regions()
+
+    assert candidate_regions() == ["europe-west4", "us-central1", "asia-northeast1"]
+    assert get_region_stats()["chosen"] == "europe-west4"
+    assert not get_region_stats()["regions"]["asia-northeast1"]["healthy"]
+
+
+def test_current_region_is_kept_over_jitter():
+    vertex_regions._regions["us-central1"]["latency"] = 0.105
+    vertex_regions._regions["europe-west4"]["latency"] = 0.100
+    assert candidate_regions()[0] == "us-central1"
+
+    vertex_regions._regions["europe-west4"]["latency"] = 0.050
+    assert candidate_regions()[0] == "europe-west4"
+
+
+def test_non_regional_errors_do_not_fail_over():
+    tried = []
+
+    def fn(region):
+        tried.append(region)
+        raise ProviderConfigError("vertex", "bad credentials")
+
+    with pytest.raises(ProviderConfigError):
+        call_in_regions(fn)
+    assert tried == ["us-central1"]
+    assert get_region_stats()["regions"]["us-central1"]["failures"] == 0
+
+
+def test_regions_known_to_be_down_get_one_last_try():
+    for region in REGIONS:
+        vertex_regions.record_region_result(region, TransientProviderError("vertex", "down", 503))
+    tried = []
+
+    def fn(region):
+        tried.append(region)
+        raise TransientProviderError("vertex", "still down", 503)
+
+    with pytest.raises(TransientProviderError):
+        call_in_regions(fn)
+    assert len(tried) == 1
@@ -0,0 +1,181 @@
+"""
+Audio compression and chunking before sending recordings to Gemini
+"""
+import io
+import os
+import sys
+import wave
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+
+# Length of each chunk for long recordings (seconds)
+AUDIO_CHUNK_SECONDS = int(os.environ.get("AUDIO_CHUNK_SECONDS", "60"))
+
+# Above this total size, chunks are uploaded as files instead of sent inline
+INLINE_AUDIO_LIMIT_BYTES = int(os.environ.get("INLINE_AUDIO_LIMIT_BYTES", str(15 * 1024 * 1024)))
+
+# Codecs to try in order: (soundfile format, subtype, MIME type)
+CODECS = [
+    ("OGG", "OPUS", "audio/ogg"),
+    ("FLAC", "PCM_16", "audio/flac"),
+]
+
+# Opus only supports these sample rates
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+
+# Errors soundfile raises for audio it cannot decode or a codec it lacks
+# (libsndfile errors are RuntimeErrors; bad arguments are ValueErrors)
+CODEC_ERRORS = (RuntimeError, ValueError)
+
+_soundfile_missing_reported = False
+
+
+def _load_soundfile():
+    """
+    Import soundfile, reporting once if it is missing.
+
+    Returns:
+        The soundfile module, or None if it is not installed
+    """
+    global _soundfile_missing_reported
+    try:
+        import soundfile
+    except (ImportError, OSError) as e:
+        # OSError: the package is installed but the libsndfile library is not
+        if not _soundfile_missing_reported:
+            _soundfile_missing_reported = True
+            print(f"soundfile unavailable, audio is sent uncompressed: {e}", file=sys.stderr)
+        return None
+    return soundfile
+
+
+def detect_audio_mime(audio_bytes: bytes) -> str:
+    """
+    Guess an audio MIME type from the file header.
+
+    Args:
+        audio_bytes: Raw audio file bytes
+
+    Returns:
+        The MIME type (defaults to audio/wav)
+    """
+    if audio_bytes[:4] == b"RIFF":
+        return "audio/wav"
+    if audio_bytes[:4] == b"fLaC":
+        return "audio/flac"
+    if audio_bytes[:4] == b"OggS":
+        return "audio/ogg"
+    if audio_bytes[:3] == b"ID3" or audio_bytes[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "audio/mp3"
+    return "audio/wav"
+
+
+def _split_wav(audio_bytes: bytes, chunk_seconds: int) -> List[bytes]:
+    """Split a WAV file into WAV chunks using only the standard library."""
+    with wave.open(io.BytesIO(audio_bytes), "rb") as source:
+        params = source.getparams()
+        frames_per_chunk = params.framerate * chunk_seconds
+        chunks = []
+        while True:
+            frames = source.readframes(frames_per_chunk)
+            if not frames:
+                break
+            output = io.BytesIO()
+            with wave.open(output, "wb") as target:
+                target.setnchannels(params.nchannels)
+                target.setsampwidth(params.sampwidth)
+                target.setframerate(params.framerate)
+                target.writeframes(frames)
+            chunks.append(output.getvalue())
+    return chunks or [audio_bytes]
+
+
+def _encode_with_soundfile(sf, audio_bytes: bytes, chunk_seconds: int) -> List[Tuple[bytes, str]]:
+    """Decode with soundfile and re-encode each chunk with the most compact codec available."""
+    data, sample_rate = sf.read(io.BytesIO(audio_bytes), dtype="int16")
+    frames_per_chunk = sample_rate * chunk_seconds
+    available = sf.available_formats()
+
+    for file_format, subtype, mime_type in CODECS:
+        if file_format not in available:
+            continue
+        if subtype == "OPUS" and sample_rate not in OPUS_SAMPLE_RATES:
+            continue
+        try:
+            chunks = []
+            for start in range(0, max(len(data), 1), frames_per_chunk):
+                output = io.BytesIO()
+                sf.write(output, data[start:start + frames_per_chunk], sample_rate, format=file_format, subtype=subtype)
+                chunks.append((output.getvalue(), mime_type))
+            return chunks
+        except CODEC_ERRORS:
+            # Older libsndfile builds lack Opus; try the next codec
+            continue
+    raise ValueError("No supported audio codec available")
+
+
+def prepare_audio(audio_data: Union[str, bytes], chunk_seconds: int = AUDIO_CHUNK_SECONDS) -> List[Tuple[bytes, str]]:
+    """
+    Compress a recording and split it into chunks.
+
+    Uses soundfile (Opus, falling back to FLAC). If it is not installed or
+    cannot decode the recording, the fallback is reported and WAV
+    recordings are split but sent uncompressed, while other formats are
+    passed through unchanged.
+
+    Args:
+        audio_data: Base64 encoded string or raw audio bytes
+        chunk_seconds: Maximum length of each chunk
+
+    Returns:
+        List of (chunk_bytes, mime_type)
+    """
+    audio_bytes = base64.b64decode(audio_data) if isinstance(audio_data, str) else audio_data
+    mime_type = detect_audio_mime(audio_bytes)
+
+    sf = _load_soundfile()
+    if sf is not None:
+        try:
+            return _encode_with_soundfile(sf, audio_bytes, chunk_seconds)
+        except CODEC_ERRORS as e:
+            print(f"Could not compress {mime_type} recording, sending it as is: {e}", file=sys.stderr)
+
+    if mime_type == "audio/wav":
+        try:
+            return [(chunk, "audio/wav") for chunk in _split_wav(audio_bytes, chunk_seconds)]
+        except wave.Error:
+            pass
+    return [(audio_bytes, mime_type)]
+
+
+def build_gemini_audio_parts(audio_data: Union[str, bytes], client) -> list:
+    """
+    Build Gemini content parts for a recording.
+
+    Small recordings are sent inline. Larger ones are uploaded through the
+    Files API (chunks in parallel) and referenced by file URI.
+
+    Args:
+        audio_data: Base64 encoded string or raw audio bytes
+        client: The google.genai Client making the request, so uploaded
+            files belong to the same API key
+
+    Returns:
+        List of google.genai Parts
+    """
+    from google.genai import types
+
+    chunks = prepare_audio(audio_data)
+    total_size = sum(len(chunk) for chunk, _ in chunks)
+
+    if total_size <= INLINE_AUDIO_LIMIT_BYTES:
+        return [types.Part.from_bytes(data=chunk, mime_type=mime_type) for chunk, mime_type in chunks]
+
+    def upload(chunk_and_mime):
+        chunk, mime_type = chunk_and_mime
+        uploaded = client.files.upload(file=io.BytesIO(chunk), config=types.UploadFileConfig(mime_type=mime_type))
+        return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type or mime_type)
+
+    with ThreadPoolExecutor(max_workers=min(4, len(chunks))) as pool:
+        return list(pool.map(upload, chunks))
@@ -38,6 +38,8 @@ def logout_user() -> None:
     """
     st.session_state.user = None
     st.session_state.messages = []
+    # The app starts the next transcript at its default window
+    st.session_state.pop("transcript_window", None)
     st.session_state.current_model = "Gemini"
     st.rerun()
 
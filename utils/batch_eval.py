@@ -0,0 +1,291 @@
+"""
+Headless batch evaluation over a prompt corpus
+
+Sends every prompt in a JSONL file to each selected model, with a bounded
+number of concurrent calls per provider, and appends one result line per
+(prompt, model) pair to a results file as soon as it completes. Re-running
+the same command resumes: pairs already in the results file are skipped.
+A summary with latency percentiles and token usage per model is printed
+and written next to the results.
+
+Prompt file lines look like:
+    {"id": "q1", "prompt": "Explain TCP slow start", "history": [], "temperature": 0.2}
+Only "prompt" is required; "id" defaults to the line number.
+
+Run it with:
+    python -m utils.batch_eval prompts.jsonl --models "OpenAI (gpt-4o)" "Anthropic (claude-3-5-sonnet-20241022)"
+Combine with AI_MOCK_SERVER_URL or AI_CASSETTE_MODE=replay to run offline.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Optional
+
+from utils.models import get_model_response, parse_model_option, MODEL_OPTIONS
+from utils.context import build_context, get_context_tokens, estimate_tokens
+from utils.call_context import call_scope
+
+# Concurrent calls per provider unless overridden with --concurrency
+DEFAULT_CONCURRENCY = int(os.environ.get("BATCH_EVAL_CONCURRENCY", "8"))
+
+
+def load_prompts(path: str) -> List[Dict[str, Any]]:
+    """
+    Read the prompt corpus.
+
+    Args:
+        path: JSONL file with one {"prompt": ...} object per line
+
+    Returns:
+        The prompt records, each with an "id"
+    """
+    prompts = []
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "prompt" not in record:
+                raise ValueError(f"{path}:{line_number}: missing \"prompt\"")
+            record.setdefault("id", str(line_number))
+            record["id"] = str(record["id"])
+            prompts.append(record)
+    return prompts
+
+
+def load_results(path: str) -> List[Dict[str, Any]]:
+    """
+    Read the results written so far.
+
+    Args:
+        path: Results JSONL file (may not exist yet)
+
+    Returns:
+        The result records; a truncated last line from an interrupted run is ignored
+    """
+    results = []
+    if not os.path.exists(path):
+        return results
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return results
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Nearest-rank percentile.
+
+    Args:
+        values: Sample values
+        fraction: Percentile as a fraction (0.95 for p95)
+
+    Returns:
+        The percentile, or None for no samples
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Per-model latency percentiles, error counts and token totals.
+
+    Args:
+        results: Result records
+
+    Returns:
+        Dict of model option to summary
+    """
+    by_model: Dict[str, List[Dict[str, Any]]] = {}
+    for result in results:
+        by_model.setdefault(result["model"], []).append(result)
+
+    summary = {}
+    for model, records in by_model.items():
+        ok = [r for r in records if r["status"] == "ok"]
+        latencies = [r["latency"] for r in ok]
+        output_tokens = sum(r["output_tokens"] for r in ok)
+        summary[model] = {
+            "prompts": len(records),
+            "ok": len(ok),
+            "errors": len(records) - len(ok),
+            "p50_latency": percentile(latencies, 0.50),
+            "p90_latency": percentile(latencies, 0.90),
+            "p95_latency": percentile(latencies, 0.95),
+            "p99_latency": percentile(latencies, 0.99),
+            "mean_latency": sum(latencies) / len(latencies) if latencies else None,
+            "input_tokens": sum(r["input_tokens"] for r in ok),
+            "output_tokens": output_tokens,
+            "cached_tokens": sum(r.get("cached_tokens", 0) for r in ok),
+            "output_tokens_per_second": output_tokens / sum(latencies) if latencies and sum(latencies) else None,
+        }
+    return summary
+
+
+def run_one(model_option: str, record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Send one prompt to one model.
+
+    Args:
+        model_option: UI model option (e.g. "OpenAI (gpt-4o)")
+        record: Prompt record
+
+    Returns:
+        The result record
+    """
+    provider, model_call_sign = parse_model_option(model_option)
+    history = list(record.get("history") or [])
+    history.append({"role": "user", "content": record["prompt"]})
+    context_messages = build_context(history, model_call_sign or model_option)
+
+    result = {
+        "id": record["id"],
+        "model": model_option,
+        "provider": provider,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    start = time.time()
+    with call_scope(conversation_id=f"batch:{record['id']}", user="batch_eval") as context:
+        try:
+            output = get_model_response(
+                model_option,
+                record["prompt"],
+                context_messages,
+                temperature=record.get("temperature", 0.7)
+            )
+            result.update(status="ok", output=output, error=None)
+        except Exception as e:
+            result.update(status="error", output=None, error=f"{type(e).__name__}: {e}")
+    result["latency"] = round(time.time() - start, 4)
+
+    # Prefer the usage the provider reported; fall back to estimates
+    if context.usage:
+        result["input_tokens"] = sum(u["input_tokens"] for u in context.usage)
+        result["output_tokens"] = sum(u["output_tokens"] for u in context.usage)
+        result["cached_tokens"] = sum(u["cached_tokens"] for u in context.usage)
+        result["usage_estimated"] = False
+    else:
+        result["input_tokens"] = get_context_tokens(context_messages)
+        result["output_tokens"] = estimate_tokens(result["output"] or "")
+        result["cached_tokens"] = 0
+        result["usage_estimated"] = True
+    return result
+
+
+def run_batch(prompts: List[Dict[str, Any]], model_options: List[str], output_path: str,
+              concurrency: int = DEFAULT_CONCURRENCY, retry_errors: bool = False, progress_every: int = 25) -> List[Dict[str, Any]]:
+    """
+    Run every prompt against every model, appending results as they complete.
+
+    Args:
+        prompts: Prompt records
+        model_options: Models to evaluate
+        output_path: Results JSONL file; existing results are kept and skipped
+        concurrency: Concurrent calls per provider
+        retry_errors: Run pairs whose previous result was an error again
+        progress_every: Print progress after this many results
+
+    Returns:
+        All result records (previous and new), latest result per pair
+    """
+    previous = load_results(output_path)
+    latest = {(r["id"], r["model"]): r for r in previous}
+    done = {key for key, r in latest.items() if r["status"] == "ok" or not retry_errors}
+
+    pending = [(model, record) for record in prompts for model in model_options if (record["id"], model) not in done]
+    print(f"{len(prompts)} prompts x {len(model_options)} models: {len(done)} done, {len(pending)} to run")
+
+    # One bounded pool per provider, so a slow provider does not starve the others
+    executors: Dict[str, ThreadPoolExecutor] = {}
+    write_lock = threading.Lock()
+    completed = 0
+    start = time.time()
+
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    with open(output_path, "a") as out:
+        futures = []
+        for model, record in pending:
+            provider = parse_model_option(model)[0] or model
+            if provider not in executors:
+                executors[provider] = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"batch-{provider}")
+            futures.append(executors[provider].submit(run_one, model, record))
+
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                with write_lock:
+                    # Each line is flushed immediately, so an interrupted run resumes from here
+                    out.write(json.dumps(result) + "\n")
+                    out.flush()
+                latest[(result["id"], result["model"])] = result
+                completed += 1
+                if completed % progress_every == 0 or completed == len(pending):
+                    elapsed = time.time() - start
+                    print(f"  {completed}/{len(pending)} done in {elapsed:.1f}s ({completed / elapsed:.1f}/s)")
+        except KeyboardInterrupt:
+            print("Interrupted; completed results are saved and will be skipped on the next run")
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    return list(latest.values())
+
+
+def print_summary(summary: Dict[str, Dict[str, Any]]) -> None:
+    def seconds(value):
+        return f"{value:7.2f}s" if value is not None else "      -"
+
+    print(f"{'model':45} {'ok':>5} {'err':>5} {'p50':>8} {'p95':>8} {'p99':>8} {'out tok/s':>10}")
+    for model, stats in sorted(summary.items()):
+        rate = f"{stats['output_tokens_per_second']:10.1f}" if stats["output_tokens_per_second"] else "         -"
+        print(f"{model[:45]:45} {stats['ok']:5d} {stats['errors']:5d} {seconds(stats['p50_latency'])} "
+              f"{seconds(stats['p95_latency'])} {seconds(stats['p99_latency'])} {rate}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run a prompt corpus through the configured models")
+    parser.add_argument("prompts", help="JSONL prompt file")
+    parser.add_argument("--models", nargs="+", default=MODEL_OPTIONS, help="Model options as shown in the UI (default: all)")
+    parser.add_argument("--output", help="Results JSONL file (default: <prompts>.results.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Concurrent calls per provider")
+    parser.add_argument("--retry-errors", action="store_true", help="Run pairs that previously failed again")
+    args = parser.parse_args(argv)
+
+    output_path = args.output or f"{os.path.splitext(args.prompts)[0]}.results.jsonl"
+    prompts = load_prompts(args.prompts)
+
+    try:
+        results = run_batch(prompts, args.models, output_path, concurrency=args.concurrency, retry_errors=args.retry_errors)
+    except KeyboardInterrupt:
+        return 130
+
+    # Summarize only the prompts and models of this run
+    prompt_ids = {record["id"] for record in prompts}
+    summary = summarize([r for r in results if r["id"] in prompt_ids and r["model"] in args.models])
+    summary_path = f"{os.path.splitext(output_path)[0]}.summary.json"
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    print_summary(summary)
+    print(f"Results: {output_path}\nSummary: {summary_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""
+Per-call context shared by the provider functions
+
+The app opens a call scope around each turn (conversation and user), and
+provider functions report the usage data returned by the APIs into it.
+The scope travels with the thread through a context variable, so the
+`get_*_response` signatures stay unchanged.
+
+Every scope also carries a cancellation token and a deadline
+(CALL_DEADLINE_SECONDS, 0 for none). Streams stop between chunks once
+the scope is cancelled, retries and rate limit waits give up, and SDK
+timeouts are capped at the time remaining.
+"""
+import os
+import time
+import threading
+import contextlib
+import contextvars
+from typing import Dict, Any, List, Optional
+
+from utils.resilience import CallCancelledError
+
+CALL_DEADLINE_SECONDS = float(os.environ.get("CALL_DEADLINE_SECONDS", "120"))
+
+_current: contextvars.ContextVar = contextvars.ContextVar("call_context", default=None)
+
+# Open scopes by conversation, so another script run can cancel them
+_active: Dict[str, List["CallContext"]] = {}
+_active_lock = threading.Lock()
+
+
+class CallContext:
+    """Who a provider call is made for, the usage it reported, and whether it should stop."""
+    def __init__(self, conversation_id: Optional[str] = None, user: Optional[str] = None, timeout: Optional[float] = None):
+        self.conversation_id = conversation_id
+        self.user = user
+        self.usage: List[Dict[str, Any]] = []
+        # Model option an "Auto" tier was routed to, if any
+        self.route: Optional[str] = None
+        self.cancel_event = threading.Event()
+        self.cancel_reason: Optional[str] = None
+        timeout = CALL_DEADLINE_SECONDS if timeout is None else timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        """Ask every call in this scope to stop."""
+        if not self.cancel_event.is_set():
+            self.cancel_reason = reason
+            self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the scope was cancelled or its deadline has passed."""
+        if self.cancel_event.is_set():
+            return True
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline exceeded")
+            return True
+        return False
+
+    def remaining(self) -> Optional[float]:
+        """Seconds until the deadline, or None without one."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+
+@contextlib.contextmanager
+def call_scope(conversation_id: Optional[str] = None, user: Optional[str] = None, timeout: Optional[float] = None):
+    """
+    Run provider calls inside the block on behalf of a conversation and user.
+
+    Args:
+        conversation_id: Stable identifier for the conversation
+        user: The user's username
+        timeout: Seconds before calls in the block are cut off (defaults to CALL_DEADLINE_SECONDS)
+
+    Yields:
+        The CallContext for the block
+    """
+    context = CallContext(conversation_id=conversation_id, user=user, timeout=timeout)
+    token = _current.set(context)
+    if conversation_id:
+        with _active_lock:
+            _active.setdefault(conversation_id, []).append(context)
+    try:
+        yield context
+    finally:
+        _current.reset(token)
+        if conversation_id:
+            with _active_lock:
+                scopes = _active.get(conversation_id, [])
+                if context in scopes:
+                    scopes.remove(context)
+                if not scopes:
+                    _active.pop(conversation_id, None)
+
+
+def cancel_calls(conversation_id: str, reason: str = "cancelled") -> int:
+    """
+    Cancel every open call scope of a conversation.
+
+    Args:
+        conversation_id: The conversation whose calls should stop
+        reason: Why, for the partial answer's marker and error messages
+
+    Returns:
+        Number of scopes cancelled
+    """
+    with _active_lock:
+        scopes = list(_active.get(conversation_id, []))
+    for context in scopes:
+        context.cancel(reason)
+    return len(scopes)
+
+
+def check_cancelled(provider: str = "call") -> None:
+    """
+    Raise if the running call's scope was cancelled or ran out of time.
+
+    Args:
+        provider: Provider name for the error
+
+    Raises:
+        CallCancelledError: If the call should stop
+    """
+    context = _current.get()
+    if context is not None and context.cancelled:
+        raise CallCancelledError(provider, f"Call {context.cancel_reason}", reason=context.cancel_reason)
+
+
+def remaining_time(default: Optional[float] = None) -> Optional[float]:
+    """
+    Time left for the running call, for SDK and HTTP timeouts.
+
+    Args:
+        default: Upper bound (and the result outside a scope or without a deadline)
+
+    Returns:
+        Seconds remaining, at least one, capped at default
+    """
+    context = _current.get()
+    remaining = context.remaining() if context is not None else None
+    if remaining is None:
+        return default
+    remaining = max(1.0, remaining)
+    return min(remaining, default) if default is not None else remaining
+
+
+def current_call() -> Optional[CallContext]:
+    """
+    Get the call context for the running provider call, if any.
+
+    Returns:
+        The active CallContext or None
+    """
+    return _current.get()
+
+
+def current_conversation_id() -> Optional[str]:
+    """
+    Get the conversation the running provider call belongs to.
+
+    Returns:
+        The conversation identifier or None
+    """
+    context = _current.get()
+    return context.conversation_id if context else None
+
+
+def report_usage(provider: str, model: str, input_tokens: int = 0, output_tokens: int = 0, cached_tokens: int = 0, cache_write_tokens: int = 0, latency: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Record the token usage a provider API returned for one call.
+
+    The record is priced from the price table and written to the usage store.
+
+    Args:
+        provider: Provider name
+        model: Model identifier
+        input_tokens: Prompt tokens billed, including cached ones
+        output_tokens: Generated tokens
+        cached_tokens: Prompt tokens served from the provider's prompt cache
+        cache_write_tokens: Prompt tokens written to the provider's prompt cache
+        latency: Seconds the API call took
+
+    Returns:
+        The usage record
+    """
+    from utils.prompt_cache import record_cache_usage
+    from utils.pricing import estimate_cost
+    from utils.usage import record_usage_event
+
+    context = _current.get()
+    record = {
+        "provider": provider,
+        "model": model,
+        "input_tokens": input_tokens or 0,
+        "output_tokens": output_tokens or 0,
+        "cached_tokens": cached_tokens or 0,
+        "cache_write_tokens": cache_write_tokens or 0,
+        "latency": latency,
+        "conversation_id": context.conversation_id if context else None,
+        "user": context.user if context else None,
+    }
+    record["cost"] = estimate_cost(
+        model,
+        record["input_tokens"],
+        record["output_tokens"],
+        record["cached_tokens"],
+        record["cache_write_tokens"],
+        provider=provider
+    )
+    if context is not None:
+        context.usage.append(record)
+    record_cache_usage(record)
+    record_usage_event(record)
+    return record
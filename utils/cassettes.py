@@ -0,0 +1,300 @@
+"""
+Record-and-replay cassettes for provider calls
+
+With AI_CASSETTE_MODE=record every call through a `get_*_response`
+function (and the streaming variants) is appended to a cassette file:
+the normalized request, the exact response text or error, the latency,
+the arrival time of each stream chunk and the usage the provider
+reported. With AI_CASSETTE_MODE=replay the same calls are answered from
+the cassette without touching the network, with the original timing
+scaled by AI_CASSETTE_SPEED (1 = original, 2 = twice as fast, 0 = instant).
+
+Cassettes are gzip-compressed JSONL when the path ends in .gz. Identical
+requests recorded several times are replayed in recording order.
+"""
+import os
+import json
+import gzip
+import time
+import inspect
+import hashlib
+import functools
+import threading
+import contextvars
+from collections import deque
+from typing import Dict, Any, Callable, Optional
+
+from utils import resilience
+from utils.resilience import ProviderError, ProviderConfigError
+
+CASSETTE_MODE = os.environ.get("AI_CASSETTE_MODE", "off").lower()
+CASSETTE_PATH = os.environ.get("AI_CASSETTE_PATH", "cassettes/cassette.jsonl.gz")
+CASSETTE_SPEED = float(os.environ.get("AI_CASSETTE_SPEED", "1"))
+
+_write_lock = threading.Lock()
+_replay_lock = threading.Lock()
+_replay_index: Optional[Dict[str, deque]] = None
+
+# Set while inside a cassette-wrapped call, so nested provider calls are not recorded twice
+_inside: contextvars.ContextVar = contextvars.ContextVar("inside_cassette", default=False)
+
+
+def _digest(data) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def _normalize(value: Any) -> Any:
+    """Make call arguments JSON-friendly; media is represented by its hash."""
+    if isinstance(value, dict):
+        normalized = {}
+        for key, item in value.items():
+            # Per-message caches (token counts, media refs) are not part of the request
+            if key in ("token_count", "token_count_sig", "media_ref"):
+                continue
+            if key in ("image", "audio") and item:
+                normalized[key] = _digest(item)
+            else:
+                normalized[key] = _normalize(item)
+        return normalized
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return repr(type(value).__name__)
+
+
+def request_key(name: str, fn: Callable, args: tuple, kwargs: Dict[str, Any]) -> str:
+    """
+    Stable key for a provider call.
+
+    Args:
+        name: Qualified function name
+        fn: The provider function (for argument names and defaults)
+        args, kwargs: The call's arguments
+
+    Returns:
+        Hex digest of the normalized request
+    """
+    bound = inspect.signature(fn).bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = {
+        key: _normalize(value)
+        for key, value in bound.arguments.items()
+        if key not in ("cancel_event",) and (key not in ("image_data", "audio_data") or value)
+    }
+    for key in ("image_data", "audio_data"):
+        if arguments.get(key):
+            arguments[key] = _digest(bound.arguments[key])
+    payload = json.dumps({"fn": name, "args": arguments}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _append(entry: Dict[str, Any]) -> None:
+    """Append one interaction to the cassette file."""
+    directory = os.path.dirname(CASSETTE_PATH)
+    with _write_lock:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Each append adds a gzip member; gzip readers treat them as one stream
+        with _open(CASSETTE_PATH, "a") as f:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+
+def _next_recording(key: str, name: str) -> Dict[str, Any]:
+    """Pop the next recorded interaction for a request key."""
+    global _replay_index
+    with _replay_lock:
+        if _replay_index is None:
+            _replay_index = {}
+            if os.path.exists(CASSETTE_PATH):
+                with _open(CASSETTE_PATH, "r") as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            _replay_index.setdefault(entry["key"], deque()).append(entry)
+        recordings = _replay_index.get(key)
+        if not recordings:
+            raise ProviderConfigError("cassette", f"No recorded interaction for {name} in {CASSETTE_PATH}")
+        return recordings.popleft()
+
+
+def _error_record(provider: str, error: Exception) -> Dict[str, Any]:
+    error = error if isinstance(error, ProviderError) else resilience.classify_error(provider, error)
+    return {
+        "type": type(error).__name__,
+        "provider": error.provider,
+        "message": str(error),
+        "status_code": error.status_code,
+        "retry_after": getattr(error, "retry_after", None),
+    }
+
+
+def _raise_recorded(record: Dict[str, Any]) -> None:
+    """Re-raise a recorded provider error as the same error type."""
+    error_class = getattr(resilience, record["type"], ProviderError)
+    if error_class is resilience.RateLimitError:
+        raise error_class(record["provider"], record["message"], record["status_code"], retry_after=record["retry_after"])
+    if error_class is resilience.CircuitOpenError:
+        raise error_class(record["provider"], record["message"])
+    raise error_class(record["provider"], record["message"], record["status_code"])
+
+
+def _wait_until(start: float, offset: float) -> None:
+    """Sleep until `offset` recorded seconds after start, scaled by CASSETTE_SPEED."""
+    if CASSETTE_SPEED <= 0:
+        return
+    remaining = start + offset / CASSETTE_SPEED - time.time()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def _replay_usage(entry: Dict[str, Any]) -> None:
+    from utils.call_context import report_usage
+    for usage in entry.get("usage", []):
+        report_usage(
+            usage["provider"],
+            usage["model"],
+            input_tokens=usage["input_tokens"],
+            output_tokens=usage["output_tokens"],
+            cached_tokens=usage["cached_tokens"],
+            cache_write_tokens=usage["cache_write_tokens"],
+            latency=usage["latency"]
+        )
+
+
+def _recorded_usage(context, start_index: int) -> list:
+    if context is None:
+        return []
+    return [
+        {k: v for k, v in usage.items() if k not in ("conversation_id", "user")}
+        for usage in context.usage[start_index:]
+    ]
+
+
+def cassette(provider: str) -> Callable:
+    """
+    Decorator that records or replays a provider function's interactions.
+
+    Place it directly below single_flight and above with_resilience. Being
+    above with_resilience, a recording holds the final outcome of the call
+    and replay bypasses retries and rate limits; being below single_flight,
+    duplicates of an in-flight call share the leader's recording or replay
+    instead of adding entries of their own.
+
+    Args:
+        provider: Provider name, stored with each recording
+
+    Returns:
+        The decorator
+    """
+    def decorator(fn: Callable) -> Callable:
+        name = f"{fn.__module__}.{fn.__name__}"
+
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def stream_wrapper(*args, **kwargs):
+                if CASSETTE_MODE not in ("record", "replay") or _inside.get():
+                    yield from fn(*args, **kwargs)
+                    return
+                key = request_key(name, fn, args, kwargs)
+
+                if CASSETTE_MODE == "replay":
+                    entry = _next_recording(key, name)
+                    start = time.time()
+                    for offset, text in entry["chunks"]:
+                        _wait_until(start, offset)
+                        yield text
+                    _replay_usage(entry)
+                    if entry.get("error"):
+                        _raise_recorded(entry["error"])
+                    return
+
+                from utils.call_context import current_call
+                context = current_call()
+                usage_start = len(context.usage) if context else 0
+                iterator = fn(*args, **kwargs)
+                start = time.time()
+                chunks = []
+                error = None
+                while True:
+                    # Mark only our own steps, not the consumer's code between chunks
+                    token = _inside.set(True)
+                    try:
+                        text = next(iterator)
+                    except StopIteration:
+                        break
+                    except Exception as e:
+                        error = e
+                        break
+                    finally:
+                        _inside.reset(token)
+                    chunks.append([round(time.time() - start, 4), text])
+                    try:
+                        yield text
+                    except GeneratorExit:
+                        # A cancelled stream is not a complete interaction; do not record it
+                        iterator.close()
+                        raise
+                _append({
+                    "key": key,
+                    "fn": name,
+                    "provider": provider,
+                    "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "latency": round(time.time() - start, 4),
+                    "chunks": chunks,
+                    "error": _error_record(provider, error) if error else None,
+                    "usage": _recorded_usage(context, usage_start),
+                })
+                if error:
+                    raise error
+            return stream_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if CASSETTE_MODE not in ("record", "replay") or _inside.get():
+                return fn(*args, **kwargs)
+            key = request_key(name, fn, args, kwargs)
+
+            if CASSETTE_MODE == "replay":
+                entry = _next_recording(key, name)
+                _wait_until(time.time(), entry["latency"])
+                _replay_usage(entry)
+                if entry.get("error"):
+                    _raise_recorded(entry["error"])
+                return entry["response"]
+
+            from utils.call_context import current_call
+            context = current_call()
+            usage_start = len(context.usage) if context else 0
+            token = _inside.set(True)
+            start = time.time()
+            response, error = None, None
+            try:
+                response = fn(*args, **kwargs)
+            except Exception as e:
+                error = e
+            finally:
+                _inside.reset(token)
+            _append({
+                "key": key,
+                "fn": name,
+                "provider": provider,
+                "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "latency": round(time.time() - start, 4),
+                "response": response,
+                "error": _error_record(provider, error) if error else None,
+                "usage": _recorded_usage(context, usage_start),
+            })
+            if error:
+                raise error
+            return response
+        return wrapper
+    return decorator
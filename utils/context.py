@@ -0,0 +1,265 @@
+"""
+Token-budgeted context assembly for chat history
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+
+# Rough characters-per-token ratio used when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+# Fixed per-message overhead (role markers, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Approximate token cost of attached media
+IMAGE_TOKENS = 800
+AUDIO_TOKENS_PER_KB = 2
+
+# Context window sizes by model prefix (longest matching prefix wins)
+MODEL_CONTEXT_WINDOWS = {
+    "gemini-2.5": 1048576,
+    "gemini-2.0": 1048576,
+    "gemini-1.5-pro": 2097152,
+    "gemini-1.5-flash": 1048576,
+    "gemini": 32768,
+    "gpt-4o": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5": 16385,
+    "claude-3": 200000,
+    "claude": 100000,
+    "sonar": 127072,
+    "pplx": 4096,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Upper bound on prompt tokens per turn, regardless of how large the window is
+DEFAULT_PROMPT_BUDGET = int(os.environ.get("CHAT_CONTEXT_TOKEN_BUDGET", "16000"))
+
+# Tokens kept free for the model's answer
+DEFAULT_RESERVED_OUTPUT_TOKENS = 1024
+
+# Old history is dropped in blocks of about this many tokens, so the oldest
+# message sent (and with it the cacheable prompt prefix) only moves once per block
+CONTEXT_TRIM_BLOCK_TOKENS = int(os.environ.get("CHAT_CONTEXT_TRIM_BLOCK_TOKENS", "4096"))
+
+# Messages whose signature is remembered, least recently used dropped first
+SIGNATURE_CACHE_MAX_MESSAGES = int(os.environ.get("CHAT_SIGNATURE_CACHE_MAX_MESSAGES", "4096"))
+
+# id(message) -> (content, image, audio, signature); the field values are held
+# so a hit (compared by identity) can only come from the very same strings
+_signatures: "OrderedDict[int, tuple]" = OrderedDict()
+_signatures_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a piece of text.
+
+    Args:
+        text: The text to measure
+
+    Returns:
+        Approximate token count
+    """
+    if not text:
+        return 0
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def message_signature(message: Dict[str, Any]) -> str:
+    """
+    Fingerprint of a message's content, image and audio.
+
+    Used to detect edits after a message's tokens were counted or its
+    prefix was cached. Fields are hashed once; later turns reuse the digest
+    while the message still holds the same content, image and audio objects.
+
+    Args:
+        message: A chat message dict
+
+    Returns:
+        Hex digest of the message's content and attachments
+    """
+    fields = tuple(message.get(field) for field in ("content", "image", "audio"))
+    with _signatures_lock:
+        entry = _signatures.get(id(message))
+        if entry is not None and all(held is current for held, current in zip(entry, fields)):
+            _signatures.move_to_end(id(message))
+            return entry[3]
+
+    digest = hashlib.blake2b(digest_size=8)
+    for value in fields:
+        digest.update((value or "").encode("utf-8"))
+        digest.update(b"\0")
+    signature = digest.hexdigest()
+
+    with _signatures_lock:
+        _signatures[id(message)] = fields + (signature,)
+        _signatures.move_to_end(id(message))
+        while len(_signatures) > SIGNATURE_CACHE_MAX_MESSAGES:
+            _signatures.popitem(last=False)
+    return signature
+
+
+def count_message_tokens(message: Dict[str, Any]) -> int:
+    """
+    Count the tokens in a message, caching the result on the message itself.
+
+    The count is stored under "token_count" so later turns (and reloaded
+    conversations) do not have to measure the same message again.
+
+    Args:
+        message: A chat message dict with "role" and "content"
+
+    Returns:
+        Approximate token count for the message
+    """
+    signature = message_signature(message)
+    cached = message.get("token_count")
+    if cached is not None and message.get("token_count_sig") == signature:
+        return cached
+
+    tokens = MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.get("content") or "")
+    if message.get("image"):
+        tokens += IMAGE_TOKENS
+    if message.get("audio"):
+        # Base64 inflates by 4/3, so convert back to raw kilobytes first
+        raw_kb = len(message["audio"]) * 3 // 4 // 1024
+        tokens += raw_kb * AUDIO_TOKENS_PER_KB
+
+    message["token_count"] = tokens
+    message["token_count_sig"] = signature
+    return tokens
+
+
+def get_context_window(model_name: str) -> int:
+    """
+    Look up the context window for a model.
+
+    Args:
+        model_name: Model identifier (e.g., "gpt-4o", "claude-3-5-sonnet-20241022")
+
+    Returns:
+        The model's context window in tokens
+    """
+    name = (model_name or "").lower()
+    best_prefix = ""
+    for prefix in MODEL_CONTEXT_WINDOWS:
+        if prefix in name and len(prefix) > len(best_prefix):
+            best_prefix = prefix
+    return MODEL_CONTEXT_WINDOWS.get(best_prefix, DEFAULT_CONTEXT_WINDOW)
+
+
+def get_prompt_budget(model_name: str, reserved_output_tokens: int = DEFAULT_RESERVED_OUTPUT_TOKENS, token_budget: Optional[int] = None) -> int:
+    """
+    Work out how many prompt tokens can be sent to a model.
+
+    Args:
+        model_name: Model identifier
+        reserved_output_tokens: Tokens kept free for the response
+        token_budget: Optional explicit cap, defaults to DEFAULT_PROMPT_BUDGET
+
+    Returns:
+        Maximum number of prompt tokens
+    """
+    cap = token_budget if token_budget is not None else DEFAULT_PROMPT_BUDGET
+    return max(0, min(get_context_window(model_name) - reserved_output_tokens, cap))
+
+
+def _is_pinned(message: Dict[str, Any]) -> bool:
+    """Pinned messages (system prompts, summaries) are always kept in the context."""
+    return bool(message.get("pinned")) or message.get("role") == "system"
+
+
+def _trim_start(messages: List[Dict[str, Any]], oldest_fitting: int, budget: int) -> int:
+    """
+    Round the first message to send up to the next block boundary.
+
+    Boundaries are counted in tokens from the start of the history, so they
+    stay put as the conversation grows: the oldest message sent stays the
+    same turn after turn, then jumps a whole block at once.
+    """
+    block = max(1, min(CONTEXT_TRIM_BLOCK_TOKENS, budget // 4))
+    tokens = 0
+    for i, message in enumerate(messages):
+        if i >= oldest_fitting and (i == 0 or tokens // block != previous // block):
+            return i
+        previous = tokens
+        if not _is_pinned(message):
+            tokens += count_message_tokens(message)
+    return len(messages) - 1
+
+
+def build_context(messages: List[Dict[str, Any]], model_name: str, reserved_output_tokens: int = DEFAULT_RESERVED_OUTPUT_TOKENS, token_budget: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Select the newest messages that fit the model's prompt budget.
+
+    Pinned messages and the latest message are always included. The remaining
+    budget is filled from newest to oldest and the original order is kept.
+    When older messages have to go, they are dropped in whole blocks (see
+    _trim_start) so the start of the prompt stays cacheable between turns.
+    The returned list holds the same message dicts, so anything cached on
+    them is shared with the caller's history.
+
+    Args:
+        messages: The full conversation history
+        model_name: Model identifier used to look up the context window
+        reserved_output_tokens: Tokens kept free for the response
+        token_budget: Optional explicit cap on prompt tokens
+
+    Returns:
+        The messages to send, oldest first
+    """
+    if not messages:
+        return []
+
+    budget = get_prompt_budget(model_name, reserved_output_tokens, token_budget)
+    last_index = len(messages) - 1
+
+    selected = {i for i, message in enumerate(messages) if _is_pinned(message)}
+    selected.add(last_index)
+    used = sum(count_message_tokens(messages[i]) for i in selected)
+
+    # Walk backwards from the newest message until the budget runs out
+    oldest_included = last_index
+    trimmed = False
+    for i in range(last_index - 1, -1, -1):
+        if i in selected:
+            continue
+        cost = count_message_tokens(messages[i])
+        if used + cost > budget:
+            trimmed = True
+            break
+        used += cost
+        selected.add(i)
+        oldest_included = i
+
+    if trimmed:
+        start = _trim_start(messages, oldest_included, budget)
+        for i in range(oldest_included, start):
+            if not _is_pinned(messages[i]):
+                selected.discard(i)
+        oldest_included = max(oldest_included, start)
+
+    # Providers such as Anthropic reject a history that opens with an assistant turn
+    while oldest_included < last_index and messages[oldest_included].get("role") == "assistant":
+        if not _is_pinned(messages[oldest_included]):
+            selected.discard(oldest_included)
+        oldest_included += 1
+
+    return [messages[i] for i in sorted(selected)]
+
+
+def get_context_tokens(messages: List[Dict[str, Any]]) -> int:
+    """
+    Total the cached token counts of a list of messages.
+
+    Args:
+        messages: Messages to measure
+
+    Returns:
+        Approximate token count
+    """
+    return sum(count_message_tokens(message) for message in messages)
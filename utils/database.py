@@ -54,6 +54,12 @@ def init_db() -> None:
                     ADD COLUMN IF NOT EXISTS last_updated TIMESTAMP;
                 """)
                 
+                # Rolling summary memory stored alongside the messages
+                cursor.execute("""
+                    ALTER TABLE conversations 
+                    ADD COLUMN IF NOT EXISTS memory JSONB;
+                """)
+                
                 # Update any NULL last_updated values to match timestamp
                 cursor.execute("""
                     UPDATE conversations 
@@ -85,7 +91,7 @@ def init_db() -> None:
         # Create data directory if it doesn't exist
         os.makedirs("data", exist_ok=True)
 
-def save_conversation(username: str, model: str, messages: List[Dict[str, str]]) -> None:
+def save_conversation(username: str, model: str, messages: List[Dict[str, str]], memory: Optional[Dict[str, Any]] = None) -> None:
     """
     Save the current conversation to the database.
     If chat_id exists in session state, update that conversation.
@@ -95,6 +101,7 @@ def save_conversation(username: str, model: str, messages: List[Dict[str, str]])
         username: The user's username
         model: The AI model used for the conversation
         messages: The list of message objects in the conversation
+        memory: Optional rolling summary memory for the conversation
     """
     # Current timestamp
     now = datetime.datetime.now()
@@ -112,21 +119,21 @@ def save_conversation(username: str, model: str, messages: List[Dict[str, str]])
                 cursor.execute(
                     """
                     UPDATE conversations 
-                    SET messages = %s, last_updated = %s
+                    SET messages = %s, last_updated = %s, memory = COALESCE(%s, memory)
                     WHERE id = %s AND user_id = %s
                     """,
-                    (json.dumps(messages), now, st.session_state.chat_id, username)
+                    (json.dumps(messages), now, json.dumps(memory) if memory else None, st.session_state.chat_id, username)
                 )
             else:
                 # Insert new conversation
                 cursor.execute(
                     """
                     INSERT INTO conversations 
-                    (user_id, model, timestamp, last_updated, messages) 
-                    VALUES (%s, %s, %s, %s, %s) 
+                    (user_id, model, timestamp, last_updated, messages, memory) 
+                    VALUES (%s, %s, %s, %s, %s, %s) 
                     RETURNING id
                     """,
-                    (username, model, now, now, json.dumps(messages))
+                    (username, model, now, now, json.dumps(messages), json.dumps(memory) if memory else None)
                 )
                 
                 # Get the new conversation ID and store it in session state
@@ -137,12 +144,12 @@ def save_conversation(username: str, model: str, messages: List[Dict[str, str]])
             conn.close()
         except Exception as e:
             # If PostgreSQL fails, fall back to JSON
-            _save_to_json(username, model, messages)
+            _save_to_json(username, model, messages, memory)
     else:
         # Save to JSON file
-        _save_to_json(username, model, messages)
+        _save_to_json(username, model, messages, memory)
 
-def _save_to_json(username: str, model: str, messages: List[Dict[str, str]]) -> None:
+def _save_to_json(username: str, model: str, messages: List[Dict[str, str]], memory: Optional[Dict[str, Any]] = None) -> None:
     """
     Save conversation to a JSON file.
     
@@ -150,6 +157,7 @@ def _save_to_json(username: str, model: str, messages: List[Dict[str, str]]) ->
         username: The user's username
         model: The AI model used
         messages: The list of messages
+        memory: Optional rolling summary memory
     """
     # Create a unique filename for this user
     filename = f"data/{username}_conversations.json"
@@ -172,6 +180,8 @@ def _save_to_json(username: str, model: str, messages: List[Dict[str, str]]) ->
                 if convo.get("id") == st.session_state.chat_id:
                     convo["messages"] = messages
                     convo["last_updated"] = timestamp
+                    if memory:
+                        convo["memory"] = memory
                     break
         else:
             # Create a new conversation object
@@ -182,7 +192,8 @@ def _save_to_json(username: str, model: str, messages: List[Dict[str, str]]) ->
                 "model": model,
                 "timestamp": timestamp,
                 "last_updated": timestamp,
-                "messages": messages
+                "messages": messages,
+                "memory": memory
             }
             
             # Add new conversation
@@ -218,7 +229,7 @@ def load_conversations(username: str) -> List[Dict[str, Any]]:
             # Query for user's conversations
             cursor.execute(
                 """
-                SELECT id, model, timestamp, last_updated, messages 
+                SELECT id, model, timestamp, last_updated, messages, memory 
                 FROM conversations 
                 WHERE user_id = %s 
                 ORDER BY last_updated DESC 
@@ -229,13 +240,14 @@ def load_conversations(username: str) -> List[Dict[str, Any]]:
             
             # Format results
             conversations = []
-            for chat_id, model, timestamp, last_updated, messages in cursor.fetchall():
+            for chat_id, model, timestamp, last_updated, messages, memory in cursor.fetchall():
                 conversations.append({
                     "id": chat_id,
                     "model": model,
                     "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
                     "last_updated": last_updated.strftime("%Y-%m-%d %H:%M:%S") if last_updated else timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-                    "messages": json.loads(messages)
+                    "messages": json.loads(messages),
+                    "memory": memory
                 })
             
             conn.close()
@@ -278,7 +290,7 @@ def _load_from_json(username: str) -> List[Dict[str, Any]]:
         # If reading fails, return empty list
         return []
 
-def get_most_recent_chat(username: str, model: str) -> Tuple[Optional[str], Optional[List[Dict[str, str]]]]:
+def get_most_recent_chat(username: str, model: str) -> Tuple[Optional[str], Optional[List[Dict[str, str]]], Optional[Dict[str, Any]]]:
     """
     Get the most recent chat for a specific user and model.
     
@@ -287,7 +299,7 @@ def get_most_recent_chat(username: str, model: str) -> Tuple[Optional[str], Opti
         model: The model to get the most recent chat for
         
     Returns:
-        A tuple with (chat_id, messages) or (None, None) if no chat exists
+        A tuple with (chat_id, messages, memory) or (None, None, None) if no chat exists
     """
     if st.session_state.db_type == "postgresql":
         try:
@@ -299,7 +311,7 @@ def get_most_recent_chat(username: str, model: str) -> Tuple[Optional[str], Opti
             # Query for the most recent chat with this model
             cursor.execute(
                 """
-                SELECT id, messages 
+                SELECT id, messages, memory 
                 FROM conversations 
                 WHERE user_id = %s AND model = %s 
                 ORDER BY last_updated DESC 
@@ -312,10 +324,12 @@ def get_most_recent_chat(username: str, model: str) -> Tuple[Optional[str], Opti
             conn.close()
             
             if result:
-                chat_id, messages = result
-                return chat_id, json.loads(messages)
+                chat_id, messages, memory = result
+                if isinstance(memory, str):
+                    memory = json.loads(memory)
+                return chat_id, json.loads(messages), memory
             else:
-                return None, None
+                return None, None, None
         except Exception as e:
             # If PostgreSQL fails, fall back to JSON
             return _get_most_recent_chat_json(username, model)
@@ -323,7 +337,7 @@ def get_most_recent_chat(username: str, model: str) -> Tuple[Optional[str], Opti
         # Use JSON file
         return _get_most_recent_chat_json(username, model)
 
-def _get_most_recent_chat_json(username: str, model: str) -> Tuple[Optional[str], Optional[List[Dict[str, str]]]]:
+def _get_most_recent_chat_json(username: str, model: str) -> Tuple[Optional[str], Optional[List[Dict[str, str]]], Optional[Dict[str, Any]]]:
     """
     Get the most recent chat from JSON for a specific user and model.
     
@@ -332,7 +346,7 @@ def _get_most_recent_chat_json(username: str, model: str) -> Tuple[Optional[str]
         model: The model to get the most recent chat for
         
     Returns:
-        A tuple with (chat_id, messages) or (None, None) if no chat exists
+        A tuple with (chat_id, messages, memory) or (None, None, None) if no chat exists
     """
     filename = f"data/{username}_conversations.json"
     
@@ -353,11 +367,11 @@ def _get_most_recent_chat_json(username: str, model: str) -> Tuple[Optional[str]
                 
                 # Return the most recent conversation
                 most_recent = model_conversations[0]
-                return most_recent.get("id"), most_recent.get("messages", [])
+                return most_recent.get("id"), most_recent.get("messages", []), most_recent.get("memory")
             else:
-                return None, None
+                return None, None, None
         else:
-            return None, None
+            return None, None, None
     except Exception as e:
         # If reading fails, return None
-        return None, None
+        return None, None, None
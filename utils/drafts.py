@@ -0,0 +1,100 @@
+"""
+Draft checkpoints for streaming answers
+
+While an answer streams in, the partial text is saved to the conversation
+store as a draft assistant message every DRAFT_CHECKPOINT_TOKENS tokens or
+DRAFT_CHECKPOINT_MS milliseconds, whichever comes first. If the session
+dies mid-generation the draft survives, and reopening the conversation
+shows it with the option to continue from where it stopped instead of
+paying for the whole answer again.
+"""
+import os
+import time
+from typing import Dict, Any, List, Callable, Optional
+
+from utils.context import estimate_tokens
+
+DRAFT_CHECKPOINT_TOKENS = int(os.environ.get("DRAFT_CHECKPOINT_TOKENS", "40"))
+DRAFT_CHECKPOINT_MS = float(os.environ.get("DRAFT_CHECKPOINT_MS", "1500"))
+
+# Sent as the user turn when asking a model to finish an interrupted answer
+CONTINUE_PROMPT = (
+    "Your previous answer was interrupted. Continue it exactly where it stopped, "
+    "without repeating anything you already wrote."
+)
+
+
+class DraftCheckpointer:
+    """Decides when a growing answer is due to be saved again, and saves it."""
+    def __init__(self, save: Callable[[str], None], every_tokens: int = DRAFT_CHECKPOINT_TOKENS, every_ms: float = DRAFT_CHECKPOINT_MS):
+        self.save = save
+        self.every_tokens = every_tokens
+        self.every_ms = every_ms
+        self.saved_length = 0
+        self.saved_at = time.monotonic()
+        self.checkpoints = 0
+
+    def update(self, text: str) -> bool:
+        """
+        Save the text if enough has arrived or enough time has passed since the last checkpoint.
+
+        Args:
+            text: The whole answer so far
+
+        Returns:
+            True if a checkpoint was written
+        """
+        if len(text) <= self.saved_length:
+            return False
+        now = time.monotonic()
+        new_tokens = estimate_tokens(text[self.saved_length:])
+        if new_tokens < self.every_tokens and (now - self.saved_at) * 1000 < self.every_ms:
+            return False
+        self.save(text)
+        self.saved_length = len(text)
+        self.saved_at = now
+        self.checkpoints += 1
+        return True
+
+
+def draft_message(text: str) -> Dict[str, Any]:
+    """
+    The stored form of an answer that is still being generated.
+
+    Args:
+        text: The answer so far
+
+    Returns:
+        An assistant message flagged as a draft
+    """
+    return {"role": "assistant", "content": text, "draft": True}
+
+
+def is_unfinished(message: Optional[Dict[str, Any]]) -> bool:
+    """
+    Check whether an assistant message was cut off (a leftover draft or a cancelled answer).
+
+    Args:
+        message: A chat message, or None
+
+    Returns:
+        True if the message can be continued
+    """
+    return bool(message) and message.get("role") == "assistant" and bool(message.get("draft") or message.get("cancelled"))
+
+
+def continuation_history(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    History for asking a model to continue the unfinished answer at its end.
+
+    Args:
+        history: Messages ending with the unfinished assistant answer
+
+    Returns:
+        The history plus a user turn asking for the rest
+    """
+    partial = history[-1]
+    return history[:-1] + [
+        {"role": "assistant", "content": partial["content"]},
+        {"role": "user", "content": CONTINUE_PROMPT},
+    ]
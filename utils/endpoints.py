@@ -0,0 +1,75 @@
+"""
+Provider endpoint selection
+
+Setting AI_MOCK_SERVER_URL (e.g. http://127.0.0.1:8765, see
+utils.stub_server) points every provider call at a local stand-in server
+instead of the real APIs. Missing API keys are then replaced by a
+placeholder and Vertex AI uses a static bearer token, so the app, batch
+runs and benchmarks work without keys or network access.
+"""
+import os
+from typing import Optional
+
+MOCK_API_KEY = "mock-key"
+MOCK_PROJECT = "mock-project"
+
+
+def mock_server_url() -> Optional[str]:
+    """
+    Get the stand-in server URL, if mock mode is on.
+
+    Returns:
+        The base URL without a trailing slash, or None
+    """
+    url = os.environ.get("AI_MOCK_SERVER_URL")
+    return url.rstrip("/") if url else None
+
+
+def get_api_key(env_name: str) -> Optional[str]:
+    """
+    Read a provider API key: the pooled key for the running call, the
+    environment variable, or a placeholder in mock mode.
+
+    Args:
+        env_name: Environment variable holding the key (e.g. "OPENAI_API_KEY")
+
+    Returns:
+        The API key, or None if unset outside mock mode
+    """
+    from utils.key_pool import current_pool_key
+
+    # A key checked out from the provider's pool takes precedence
+    api_key = current_pool_key(env_name) or os.environ.get(env_name)
+    if not api_key and mock_server_url():
+        return MOCK_API_KEY
+    return api_key
+
+
+def get_base_url(provider: str) -> Optional[str]:
+    """
+    Base URL to hand to a provider's client, or None for the real API.
+
+    Args:
+        provider: "openai", "anthropic", "perplexity", "gemini" or "vertex"
+
+    Returns:
+        The URL in the form that provider's client expects
+    """
+    url = mock_server_url()
+    if not url:
+        return None
+    if provider == "openai":
+        # The OpenAI client appends /chat/completions to a base that ends in /v1
+        return f"{url}/v1"
+    return url
+
+
+def get_perplexity_url() -> str:
+    """
+    Chat completions URL for Perplexity.
+
+    Returns:
+        The stand-in server's URL in mock mode, otherwise the real API
+    """
+    url = mock_server_url()
+    return f"{url}/chat/completions" if url else "https://api.perplexity.ai/chat/completions"
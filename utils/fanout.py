@@ -0,0 +1,151 @@
+"""
+Concurrent multi-model fan-out for side-by-side comparison
+"""
+import os
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Any, Optional
+
+from utils.context import build_context, get_context_tokens, estimate_tokens
+from utils.models import stream_model_response, parse_model_option
+from utils.call_context import call_scope, current_call
+
+# Process-wide cap on concurrent fan-out calls, shared by all sessions
+FANOUT_MAX_WORKERS = int(os.environ.get("FANOUT_MAX_WORKERS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix="fanout")
+
+
+class FanOutRun:
+    """
+    One prompt sent to several models at once.
+
+    Each model's answer is filled in chunk by chunk as it streams, so the
+    UI can poll `results` and render every pane as it grows.
+    """
+    def __init__(self, prompt: str, message_history: List[Dict[str, Any]], model_options: List[str], image_data=None, audio_data=None, temperature=0.7):
+        self.prompt = prompt
+        self.model_options = list(model_options)
+        self.started_at = time.time()
+        self.winner = None
+        self._lock = threading.Lock()
+        self._futures: Dict[str, Future] = {}
+        # Each model's call scope, so it can be cancelled on its own
+        self._scopes: Dict[str, Any] = {}
+        self.results: Dict[str, Dict[str, Any]] = {
+            option: {"status": "pending", "response": None, "latency": None, "prompt_tokens": 0, "output_tokens": 0}
+            for option in self.model_options
+        }
+
+        for option in self.model_options:
+            # Each model gets the history that fits its own budget
+            _, model_call_sign = parse_model_option(option)
+            context_messages = build_context(message_history, model_call_sign or option)
+            self.results[option]["prompt_tokens"] = get_context_tokens(context_messages)
+            # Carry the caller's call scope (conversation, user) onto the worker thread
+            self._futures[option] = _executor.submit(
+                contextvars.copy_context().run,
+                self._call_model, option, context_messages, image_data, audio_data, temperature
+            )
+
+    def _call_model(self, option: str, context_messages: List[Dict[str, Any]], image_data, audio_data, temperature) -> None:
+        """Run on a worker thread: call one model and record its result."""
+        with self._lock:
+            if self.results[option]["status"] == "cancelled":
+                return
+            self.results[option]["status"] = "running"
+
+        start = time.time()
+        parent = current_call()
+        with call_scope(
+            conversation_id=parent.conversation_id if parent else None,
+            user=parent.user if parent else None
+        ) as scope:
+            with self._lock:
+                self._scopes[option] = scope
+                if self.results[option]["status"] == "cancelled":
+                    scope.cancel()
+            chunks = []
+            try:
+                # Streamed, so a cancelled model stops between chunks
+                for chunk in stream_model_response(
+                    option,
+                    self.prompt,
+                    context_messages,
+                    image_data=image_data,
+                    audio_data=audio_data,
+                    temperature=temperature
+                ):
+                    chunks.append(chunk)
+                    with self._lock:
+                        if self.results[option]["status"] == "cancelled":
+                            return
+                        self.results[option]["response"] = "".join(chunks)
+                response = "".join(chunks)
+                status = "done"
+            except Exception as e:
+                response = f"Error: {str(e)}"
+                status = "error"
+
+        with self._lock:
+            # A result that arrives after cancellation is discarded
+            if self.results[option]["status"] == "cancelled":
+                return
+            self.results[option].update(
+                status=status,
+                response=response,
+                latency=time.time() - start,
+                output_tokens=estimate_tokens(response or ""),
+            )
+
+    def cancel(self, keep: Optional[str] = None) -> None:
+        """
+        Cancel every model that has not finished yet.
+
+        Args:
+            keep: Optional model option to leave running
+        """
+        with self._lock:
+            for option, future in self._futures.items():
+                if option == keep:
+                    continue
+                if self.results[option]["status"] in ("pending", "running"):
+                    future.cancel()
+                    self.results[option]["status"] = "cancelled"
+                    if option in self._scopes:
+                        self._scopes[option].cancel()
+
+    def pick(self, option: str) -> Optional[str]:
+        """
+        Choose a winning answer and cancel the remaining calls.
+
+        Args:
+            option: The model option whose answer should be kept
+
+        Returns:
+            The winning response text
+        """
+        self.winner = option
+        self.cancel(keep=option)
+        return self.results[option]["response"]
+
+    def is_done(self) -> bool:
+        """
+        Check whether every model has finished, failed or been cancelled.
+
+        Returns:
+            True if no calls are still pending or running
+        """
+        with self._lock:
+            return all(result["status"] not in ("pending", "running") for result in self.results.values())
+
+    def elapsed(self) -> float:
+        """
+        Seconds since the fan-out started.
+
+        Returns:
+            Elapsed wall-clock time
+        """
+        return time.time() - self.started_at
@@ -0,0 +1,130 @@
+"""
+Per-conversation cache of provider-formatted history
+
+Every provider call converts the chat history into its own message format
+(dicts for OpenAI/Anthropic/Perplexity/Gemini, types.Content for Vertex).
+The history only grows by a message or two per turn, so each conversation
+keeps the converted form of every message it has seen and only new or
+changed messages are converted again.
+
+A cached conversion is reused while the message is the same dict with the
+same role, content, attachments and media reference (compared by
+identity, so checking is cheap). Edited messages get new content and branched or reloaded
+histories are new dicts, so both are converted afresh; invalidate_history()
+drops a conversation's cache outright. Conversions that would pin large
+payloads (e.g. inline image bytes) can be left out of the cache.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Callable, Optional
+
+from utils.call_context import current_conversation_id
+
+# Conversations whose converted history is kept, least recently used dropped first
+HISTORY_CACHE_MAX_CONVERSATIONS = int(os.environ.get("HISTORY_CACHE_MAX_CONVERSATIONS", "256"))
+
+# (conversation_id, format) -> {id(message): (message, role, content, image, media_ref, converted)}
+_caches: "OrderedDict[tuple, Dict[int, tuple]]" = OrderedDict()
+_lock = threading.Lock()
+_stats = {"converted": 0, "reused": 0}
+
+
+def format_history(
+    format_name: str,
+    message_history: List[Dict[str, Any]],
+    convert: Callable[[Dict[str, Any]], Any],
+    cache_if: Optional[Callable[[Dict[str, Any]], bool]] = None
+) -> List[Any]:
+    """
+    Convert a history to a provider's format, reusing earlier conversions.
+
+    Args:
+        format_name: Name of the target format (one cache per format and conversation)
+        message_history: The history about to be sent
+        convert: Converts one message dict; its result must not be mutated by the caller
+        cache_if: Optional predicate; messages it rejects are converted on every
+            call and never cached
+
+    Returns:
+        The converted messages, in order
+    """
+    conversation_id = current_conversation_id()
+    if not conversation_id:
+        return [convert(message) for message in message_history]
+
+    key = (conversation_id, format_name)
+    with _lock:
+        entries = _caches.get(key)
+        if entries is None:
+            entries = _caches[key] = {}
+        _caches.move_to_end(key)
+        while len(_caches) > HISTORY_CACHE_MAX_CONVERSATIONS:
+            _caches.popitem(last=False)
+        # Another call in the same conversation may prune the entries meanwhile
+        found = [entries.get(id(message)) for message in message_history]
+
+    formatted = []
+    new_entries = {}
+    converted = 0
+    for message, entry in zip(message_history, found):
+        if (
+            entry is not None
+            and entry[0] is message
+            and entry[1] is message.get("role")
+            and entry[2] is message.get("content")
+            and entry[3] is message.get("image")
+            and entry[4] is message.get("media_ref")
+        ):
+            formatted.append(entry[5])
+            continue
+        value = convert(message)
+        converted += 1
+        if cache_if is None or cache_if(message):
+            # Holding the message keeps its id from being reused by another dict
+            new_entries[id(message)] = (
+                message,
+                message.get("role"),
+                message.get("content"),
+                message.get("image"),
+                message.get("media_ref"),
+                value,
+            )
+        formatted.append(value)
+
+    with _lock:
+        entries = _caches.get(key)
+        # Nothing is stored for a conversation invalidated or evicted meanwhile
+        if entries is not None:
+            entries.update(new_entries)
+            # Forget messages that dropped out of the history (trimmed, edited or branched away)
+            if len(entries) > 2 * len(message_history) + 8:
+                keep = {id(message) for message in message_history}
+                for message_id in [message_id for message_id in entries if message_id not in keep]:
+                    del entries[message_id]
+        _stats["converted"] += converted
+        _stats["reused"] += len(message_history) - converted
+    return formatted
+
+
+def invalidate_history(conversation_id: str) -> None:
+    """
+    Drop every cached conversion for a conversation.
+
+    Args:
+        conversation_id: The conversation whose history was replaced
+    """
+    with _lock:
+        for key in [key for key in _caches if key[0] == conversation_id]:
+            del _caches[key]
+
+
+def get_history_cache_stats() -> Dict[str, int]:
+    """
+    Counts of messages converted and reused across all conversations.
+
+    Returns:
+        Dict with "converted", "reused" and "conversations"
+    """
+    with _lock:
+        return dict(_stats, conversations=len({key[0] for key in _caches}))
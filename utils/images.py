@@ -0,0 +1,112 @@
+"""
+Image preprocessing before upload to model providers
+
+Images are decoded once, downsized to the largest resolution each provider
+actually uses, re-encoded with the right MIME type and memoized by content
+hash so repeated turns do not redo the work.
+"""
+import io
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Union
+
+# Longest edge (pixels) beyond which each provider downsamples anyway
+PROVIDER_MAX_DIMENSIONS = {
+    "gemini": 3072,
+    "vertex": 3072,
+    "openai": 2048,
+    "anthropic": 1568,
+    "perplexity": 2048,
+    # Used when storing uploads in session state and the conversation store
+    "storage": 3072,
+}
+DEFAULT_MAX_DIMENSION = 2048
+
+JPEG_QUALITY = 85
+
+# Prepared images kept in memory, keyed by (content hash, provider)
+CACHE_SIZE = 64
+
+_cache: "OrderedDict[tuple, PreparedImage]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class PreparedImage(NamedTuple):
+    """An image ready to send: raw bytes plus the metadata providers need."""
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    sha256: str
+
+    @property
+    def base64(self) -> str:
+        return base64.b64encode(self.data).decode("utf-8")
+
+
+def _has_alpha(image) -> bool:
+    """Check whether an image uses transparency."""
+    return image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def _process(raw: bytes, digest: str, max_dimension: int) -> PreparedImage:
+    """Decode, downsize and re-encode one image."""
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(raw))
+    original_format = (image.format or "").upper()
+    image = ImageOps.exif_transpose(image)
+
+    resized = max(image.size) > max_dimension
+    if resized:
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    # Keep small, already-compact uploads as they are
+    if not resized and original_format in ("JPEG", "WEBP", "GIF") and len(raw) < 512 * 1024:
+        return PreparedImage(raw, f"image/{original_format.lower()}", image.width, image.height, digest)
+
+    output = io.BytesIO()
+    if _has_alpha(image):
+        # Transparency needs a lossless format
+        image.save(output, format="PNG", optimize=True)
+        mime_type = "image/png"
+    else:
+        image.convert("RGB").save(output, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        mime_type = "image/jpeg"
+    data = output.getvalue()
+
+    # Re-encoding can inflate small PNG graphics; fall back to the original then
+    if not resized and len(data) >= len(raw) and original_format in ("PNG", "JPEG"):
+        return PreparedImage(raw, f"image/{original_format.lower()}", image.width, image.height, digest)
+    return PreparedImage(data, mime_type, image.width, image.height, digest)
+
+
+def prepare_image(image_data: Union[str, bytes], provider: str = "storage") -> PreparedImage:
+    """
+    Prepare an image for a provider, reusing earlier results for the same content.
+
+    Args:
+        image_data: Base64 encoded string or raw image bytes
+        provider: Provider name used to pick the maximum resolution
+
+    Returns:
+        The PreparedImage for that provider
+    """
+    raw = base64.b64decode(image_data) if isinstance(image_data, str) else image_data
+    digest = hashlib.sha256(raw).hexdigest()
+    key = (digest, provider)
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    prepared = _process(raw, digest, PROVIDER_MAX_DIMENSIONS.get(provider, DEFAULT_MAX_DIMENSION))
+
+    with _cache_lock:
+        _cache[key] = prepared
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return prepared
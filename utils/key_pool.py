@@ -0,0 +1,221 @@
+"""
+Pools of API keys per provider
+
+A provider can be given several keys, each optionally weighted:
+    OPENAI_API_KEYS=sk-first,sk-second:2
+Without a plural variable the single OPENAI_API_KEY is used as before.
+
+Each call checks out the least-loaded key relative to its weight (ties go
+to the key with the fewest requests per unit of weight), so load spreads
+across accounts. Every key has its own rate limiter. When a pool has
+several keys, one that is rejected with a rate limit or quota error is
+quarantined for its Retry-After (or the provider backoff delay, doubling
+on repeated hits) and rejoins the pool afterwards. A single key is never
+quarantined; the retry backoff alone decides when it is tried again.
+"""
+import os
+import time
+import threading
+import contextlib
+import contextvars
+from typing import Dict, Any, List, Optional
+
+from utils.resilience import RateLimitError, BACKOFF_BASE_SECONDS, BACKOFF_MAX_SECONDS
+from utils.rate_limit import key_fingerprint, API_KEY_ENV_VARS
+
+KEY_QUARANTINE_MAX_SECONDS = float(os.environ.get("KEY_QUARANTINE_MAX_SECONDS", "900"))
+
+
+class KeysExhaustedError(RateLimitError):
+    """Every key in a pool is quarantined; raised before any request is sent."""
+    provider_fault = False
+
+
+# Key checked out for the running call, by environment variable name
+_current_keys: contextvars.ContextVar = contextvars.ContextVar("pool_keys", default={})
+
+
+class PooledKey:
+    """One API key and its usage counters."""
+    def __init__(self, key: str, weight: float = 1.0):
+        self.key = key
+        self.weight = weight
+        self.fingerprint = key_fingerprint(key)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.strikes = 0
+        self.quarantined_until = 0.0
+
+    def quarantined_for(self, now: Optional[float] = None) -> float:
+        return max(0.0, self.quarantined_until - (now or time.time()))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "weight": self.weight,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+            "quarantined_for": self.quarantined_for(),
+        }
+
+
+def parse_keys(value: str) -> List[PooledKey]:
+    """
+    Parse a comma-separated key list with optional ":weight" suffixes.
+
+    Args:
+        value: e.g. "key-a,key-b:2"
+
+    Returns:
+        The pooled keys
+
+    Raises:
+        ValueError: If a weight is zero or negative
+    """
+    keys = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, weight = item.rpartition(":")
+        try:
+            weight = float(weight) if key else None
+        except ValueError:
+            # The colon was part of the key itself
+            weight = None
+        if weight is None:
+            keys.append(PooledKey(item))
+        elif weight > 0:
+            keys.append(PooledKey(key, weight))
+        else:
+            raise ValueError(f"API key weight must be positive, got {weight:g} for key {key_fingerprint(key)}")
+    return keys
+
+
+class KeyPool:
+    """The keys available for one provider."""
+    def __init__(self, provider: str, env_name: str, keys: List[PooledKey]):
+        self.provider = provider
+        self.env_name = env_name
+        self.keys = keys
+        self._lock = threading.Lock()
+
+    def _choose(self) -> PooledKey:
+        """Pick a key. Caller holds the lock."""
+        now = time.time()
+        available = [k for k in self.keys if k.quarantined_for(now) == 0]
+        if not available:
+            soonest = min(self.keys, key=lambda k: k.quarantined_until)
+            raise KeysExhaustedError(
+                self.provider,
+                f"All {len(self.keys)} {self.provider} API keys are rate limited",
+                retry_after=soonest.quarantined_for(now)
+            )
+        return min(available, key=lambda k: (k.in_flight / k.weight, k.requests / k.weight))
+
+    def has_available_key(self, exclude: Optional[PooledKey] = None) -> bool:
+        with self._lock:
+            now = time.time()
+            return any(k is not exclude and k.quarantined_for(now) == 0 for k in self.keys)
+
+    @contextlib.contextmanager
+    def checkout(self):
+        """
+        Use one key for the duration of a call.
+
+        The key is visible to get_api_key() inside the block. In a pool of
+        several keys a rate limit error quarantines the key; if other keys
+        are still available the error is re-raised without its Retry-After,
+        so the retry moves to another key straight away.
+
+        Yields:
+            The raw API key
+
+        Raises:
+            KeysExhaustedError: If every key is quarantined
+        """
+        with self._lock:
+            pooled = self._choose()
+            pooled.in_flight += 1
+            pooled.requests += 1
+        token = _current_keys.set(dict(_current_keys.get(), **{self.env_name: pooled.key}))
+        try:
+            yield pooled.key
+        except RateLimitError as e:
+            with self._lock:
+                pooled.rate_limited += 1
+                pooled.failures += 1
+                pooled.strikes += 1
+                if len(self.keys) > 1:
+                    backoff = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** (pooled.strikes - 1)))
+                    pooled.quarantined_until = time.time() + min(KEY_QUARANTINE_MAX_SECONDS, e.retry_after or backoff)
+            if len(self.keys) > 1 and self.has_available_key(exclude=pooled):
+                raise RateLimitError(e.provider, str(e), e.status_code, retry_after=None) from e
+            raise
+        except Exception:
+            with self._lock:
+                pooled.failures += 1
+            raise
+        else:
+            with self._lock:
+                pooled.strikes = 0
+        finally:
+            _current_keys.reset(token)
+            with self._lock:
+                pooled.in_flight -= 1
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {k.fingerprint: k.stats() for k in self.keys}
+
+
+_pools: Dict[str, Optional[KeyPool]] = {}
+_pools_lock = threading.Lock()
+
+
+def get_key_pool(provider: str) -> Optional[KeyPool]:
+    """
+    Get the key pool for a provider, built from its environment variables.
+
+    Args:
+        provider: Provider name ("openai", "anthropic", "gemini" or "perplexity")
+
+    Returns:
+        The KeyPool, or None if the provider has no API keys configured
+    """
+    with _pools_lock:
+        if provider not in _pools:
+            env_name = API_KEY_ENV_VARS.get(provider)
+            keys = []
+            if env_name:
+                keys = parse_keys(os.environ.get(f"{env_name}S", "")) or parse_keys(os.environ.get(env_name, ""))
+            _pools[provider] = KeyPool(provider, env_name, keys) if keys else None
+        return _pools[provider]
+
+
+def current_pool_key(env_name: str) -> Optional[str]:
+    """
+    The key checked out for the running call.
+
+    Args:
+        env_name: Environment variable name (e.g. "OPENAI_API_KEY")
+
+    Returns:
+        The raw key, or None outside a checkout
+    """
+    return _current_keys.get().get(env_name)
+
+
+def get_key_pool_stats() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """
+    Per-key usage counters for every provider with a pool.
+
+    Returns:
+        Dict of provider to {key fingerprint: counters}
+    """
+    with _pools_lock:
+        pools = {provider: pool for provider, pool in _pools.items() if pool}
+    return {provider: pool.stats() for provider, pool in pools.items()}
@@ -0,0 +1,147 @@
+"""
+Upload-once media references for Vertex AI
+
+Instead of re-sending every past image inline on each turn, media is
+uploaded once to Cloud Storage and the resulting gs:// URI is stored on the
+message under "media_ref". Later turns send only the reference. References
+expire after MEDIA_TTL_SECONDS (match this to the bucket's lifecycle rule)
+and are re-uploaded transparently.
+
+Media references are only used when VERTEX_MEDIA_BUCKET is set; otherwise
+callers fall back to inline bytes.
+"""
+import os
+import time
+import threading
+from typing import Dict, Any, Optional
+from urllib.parse import quote
+
+import requests
+
+from utils.images import prepare_image
+from utils.endpoints import mock_server_url
+
+# Bucket that holds uploaded media; unset disables media references
+MEDIA_BUCKET = os.environ.get("VERTEX_MEDIA_BUCKET")
+
+# Upload endpoint; defaults to utils.stub_server when AI_MOCK_SERVER_URL is set
+MEDIA_UPLOAD_URL = os.environ.get(
+    "VERTEX_MEDIA_UPLOAD_URL",
+    (mock_server_url() or "https://storage.googleapis.com") + "/upload/storage/v1/b/{bucket}/o"
+)
+
+# How long an uploaded object is trusted before it is uploaded again
+MEDIA_TTL_SECONDS = float(os.environ.get("VERTEX_MEDIA_TTL", str(24 * 3600)))
+
+# Re-upload slightly early so a reference never expires mid-request
+EXPIRY_MARGIN_SECONDS = 300
+
+# References by content hash, so the same image is uploaded once per process
+_refs_by_hash: Dict[str, Dict[str, Any]] = {}
+_refs_lock = threading.Lock()
+
+
+def media_refs_enabled() -> bool:
+    """
+    Check whether media references are configured.
+
+    Returns:
+        True if a media bucket is set
+    """
+    return bool(MEDIA_BUCKET)
+
+
+def _get_auth_headers() -> Dict[str, str]:
+    """Bearer token for Cloud Storage, or no auth when talking to a local stand-in."""
+    if mock_server_url() or MEDIA_UPLOAD_URL.startswith("http://127.0.0.1") or MEDIA_UPLOAD_URL.startswith("http://localhost"):
+        return {}
+
+    # Share the Vertex credentials (cloud-platform scope covers Cloud Storage)
+    from utils.vertex_ai import get_vertex_credentials
+
+    credentials = get_vertex_credentials()
+    return {"Authorization": f"Bearer {credentials.token}"}
+
+
+def upload_media(data: bytes, mime_type: str, sha256: str) -> str:
+    """
+    Upload media bytes to the media bucket.
+
+    Objects are named by content hash, so uploading the same bytes twice
+    simply overwrites the same object.
+
+    Args:
+        data: The bytes to upload
+        mime_type: MIME type of the data
+        sha256: Content hash used as the object name
+
+    Returns:
+        The gs:// URI of the uploaded object
+    """
+    object_name = f"media/{sha256}"
+    url = MEDIA_UPLOAD_URL.format(bucket=MEDIA_BUCKET)
+    headers = {"Content-Type": mime_type}
+    headers.update(_get_auth_headers())
+
+    response = requests.post(
+        f"{url}?uploadType=media&name={quote(object_name, safe='')}",
+        headers=headers,
+        data=data,
+        timeout=60
+    )
+    response.raise_for_status()
+    result = response.json()
+    return f"gs://{result.get('bucket', MEDIA_BUCKET)}/{result.get('name', object_name)}"
+
+
+def _is_fresh(ref: Optional[Dict[str, Any]]) -> bool:
+    return bool(ref) and ref.get("expires_at", 0) > time.time() + EXPIRY_MARGIN_SECONDS
+
+
+def get_media_ref(image_data: str, message: Optional[Dict[str, Any]] = None, force: bool = False) -> Dict[str, Any]:
+    """
+    Get a fresh media reference for an image, uploading it if needed.
+
+    Args:
+        image_data: Base64 encoded image
+        message: Optional message dict to store the reference on
+        force: Upload again even if a reference exists
+
+    Returns:
+        Dict with "uri", "mime_type", "sha256" and "expires_at"
+    """
+    if message is not None and not force and _is_fresh(message.get("media_ref")):
+        return message["media_ref"]
+
+    prepared = prepare_image(image_data, "vertex")
+
+    with _refs_lock:
+        ref = _refs_by_hash.get(prepared.sha256)
+    if force or not _is_fresh(ref):
+        ref = {
+            "uri": upload_media(prepared.data, prepared.mime_type, prepared.sha256),
+            "mime_type": prepared.mime_type,
+            "sha256": prepared.sha256,
+            "expires_at": time.time() + MEDIA_TTL_SECONDS,
+        }
+        with _refs_lock:
+            _refs_by_hash[prepared.sha256] = ref
+
+    if message is not None:
+        message["media_ref"] = ref
+    return ref
+
+
+def forget_media_refs(message_history: list) -> None:
+    """
+    Drop cached references so the next turn uploads again.
+
+    Used when the provider reports that a referenced object is missing.
+
+    Args:
+        message_history: Messages whose references should be dropped
+    """
+    with _refs_lock:
+        for message in message_history:
+            message.pop("media_ref", None)
+        _refs_by_hash.clear()
@@ -0,0 +1,208 @@
+"""
+Rolling summary memory for long conversations
+
+Older turns are condensed into a running summary by a cheap model on a
+background worker. The summary then stands in for those turns in later
+prompts, so prompt size stays roughly constant however long the chat gets.
+"""
+import os
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Any, Optional, Callable
+
+from utils.context import count_message_tokens, get_context_tokens
+
+# Unsummarized history above this size triggers a background summary
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get("CHAT_SUMMARY_TRIGGER_TOKENS", "6000"))
+
+# Newest turns kept verbatim after summarizing
+SUMMARY_KEEP_RECENT_TOKENS = int(os.environ.get("CHAT_SUMMARY_KEEP_RECENT_TOKENS", "2000"))
+
+# Cheap model used to write summaries
+SUMMARY_MODEL = os.environ.get("CHAT_SUMMARY_MODEL", "gemini-1.5-flash")
+
+SUMMARY_PROMPT = (
+    "Update the running summary of a conversation between a user and an AI assistant. "
+    "Keep names, facts, decisions, open questions and user preferences. "
+    "Write at most 300 words in plain prose.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New turns:\n{turns}\n\n"
+    "Updated summary:"
+)
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat-summary")
+_pending: Dict[str, Future] = {}
+_pending_lock = threading.Lock()
+
+
+def new_memory_state() -> Dict[str, Any]:
+    """
+    Create an empty memory state for a conversation.
+
+    Returns:
+        A dict with the running summary and how many messages it covers
+    """
+    return {"summary": "", "summarized_count": 0}
+
+
+def _default_summarizer(prompt: str) -> Optional[str]:
+    """Summarize with the cheap Gemini model. Provider errors propagate to the caller."""
+    from utils.models import get_gemini_response
+    from utils.rate_limit import request_priority, PRIORITY_LOW
+    from utils.call_context import current_call
+    from utils.usage import check_budget
+
+    # Summaries are billed to the user like any other call
+    context = current_call()
+    check_budget(context.user if context else None)
+
+    # Background summaries queue behind interactive turns
+    with request_priority(PRIORITY_LOW):
+        result = get_gemini_response(prompt, [], temperature=0.2, model_name=SUMMARY_MODEL)
+    return result.strip() if result else None
+
+
+def _find_cut_index(messages: List[Dict[str, Any]], start: int) -> int:
+    """
+    Find where to split history so the newest turns stay verbatim.
+
+    The cut lands on a user message so the kept history still opens with a user turn.
+    """
+    kept_tokens = 0
+    cut = len(messages)
+    for i in range(len(messages) - 1, start - 1, -1):
+        kept_tokens += count_message_tokens(messages[i])
+        if kept_tokens > SUMMARY_KEEP_RECENT_TOKENS:
+            break
+        cut = i
+    while cut < len(messages) and messages[cut].get("role") != "user":
+        cut += 1
+    return cut
+
+
+def _summarize_turns(previous_summary: str, turns: List[Dict[str, str]], cut: int, summarizer: Callable[[str], Optional[str]], conversation_id: Optional[str], user: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Run on the worker thread: fold the given turns into the running summary.
+
+    The call gets its own scope for the conversation and user, so it is
+    metered and budget-checked like an interactive call, can be cancelled
+    with the conversation, and does not inherit the deadline of the turn
+    that scheduled it. Errors are left on the job for collect_summary.
+    """
+    from utils.call_context import call_scope
+
+    transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    prompt = SUMMARY_PROMPT.format(summary=previous_summary or "(none)", turns=transcript)
+    with call_scope(conversation_id=conversation_id, user=user):
+        summary = summarizer(prompt)
+    if not summary:
+        return None
+    return {"summary": summary, "summarized_count": cut}
+
+
+def schedule_summary(key: str, messages: List[Dict[str, Any]], memory_state: Dict[str, Any], summarizer: Optional[Callable[[str], Optional[str]]] = None) -> bool:
+    """
+    Start summarizing older turns in the background if the history has grown too large.
+
+    Never blocks: the summary is picked up later by collect_summary.
+
+    Args:
+        key: Identifier for the conversation (one pending job per key)
+        messages: The full conversation history
+        memory_state: The conversation's memory state
+        summarizer: Optional callable taking a prompt and returning summary text
+
+    Returns:
+        True if a summary job was started
+    """
+    start = memory_state.get("summarized_count", 0)
+    if start > len(messages):
+        # History was cleared or replaced since the last summary
+        memory_state.update(new_memory_state())
+        start = 0
+
+    if get_context_tokens(messages[start:]) < SUMMARY_TRIGGER_TOKENS:
+        return False
+
+    cut = _find_cut_index(messages, start)
+    if cut <= start:
+        return False
+
+    from utils.call_context import current_call
+
+    with _pending_lock:
+        pending = _pending.get(key)
+        if pending is not None and not pending.done():
+            return False
+
+        # Snapshot the turns so the worker never touches the live message list
+        turns = [{"role": m.get("role", "user"), "content": m.get("content", "")} for m in messages[start:cut]]
+        # The worker runs in a copy of the caller's context (request priority and
+        # the like) under a scope for the same conversation and user
+        caller = current_call()
+        _pending[key] = _executor.submit(
+            contextvars.copy_context().run,
+            _summarize_turns,
+            memory_state.get("summary", ""),
+            turns,
+            cut,
+            summarizer or _default_summarizer,
+            caller.conversation_id if caller else key,
+            caller.user if caller else None,
+        )
+    return True
+
+
+def collect_summary(key: str, memory_state: Dict[str, Any]) -> bool:
+    """
+    Merge a finished background summary into the memory state.
+
+    Args:
+        key: Identifier for the conversation
+        memory_state: The conversation's memory state, updated in place
+
+    Returns:
+        True if the memory state changed
+
+    Raises:
+        Exception: Whatever the summary job failed with (the job is dropped,
+            and the next schedule_summary call starts a new one)
+    """
+    with _pending_lock:
+        pending = _pending.get(key)
+        if pending is None or not pending.done():
+            return False
+        del _pending[key]
+
+    result = pending.result()
+    if not result or result["summarized_count"] <= memory_state.get("summarized_count", 0):
+        return False
+    memory_state.update(result)
+    return True
+
+
+def apply_summary(messages: List[Dict[str, Any]], memory_state: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Replace summarized turns with a single pinned summary message.
+
+    Args:
+        messages: The full conversation history
+        memory_state: The conversation's memory state
+
+    Returns:
+        The history to build the prompt from
+    """
+    if not memory_state or not memory_state.get("summary"):
+        return messages
+    count = memory_state.get("summarized_count", 0)
+    if count <= 0 or count > len(messages):
+        return messages
+
+    summary_message = {
+        "role": "user",
+        "content": f"Summary of our earlier conversation:\n{memory_state['summary']}",
+        "pinned": True,
+        "summary": True,
+    }
+    return [summary_message] + messages[count:]
@@ -1,10 +1,142 @@
 import os
 import sys
+import time
 import requests
 import json
+import threading
 from typing import List, Dict, Any
+from utils.resilience import (
+    with_resilience,
+    classify_error,
+    error_from_response,
+    ProviderError,
+    ProviderConfigError,
+    CallCancelledError
+)
+from utils.rate_limit import rate_limited, key_fingerprint
+from utils.cassettes import cassette
+from utils.single_flight import single_flight
+from utils.endpoints import get_api_key, get_base_url, get_perplexity_url
+from utils.call_context import current_conversation_id, report_usage, current_call, remaining_time
+from utils.streaming import metered_stream
+from utils.history_cache import format_history
+from utils.context import estimate_tokens, get_context_tokens
+from utils.prompt_cache import (
+    get_cached_prefix,
+    order_for_prefix_cache,
+    apply_anthropic_cache_control,
+    GEMINI_CACHE_TTL_SECONDS
+)
+
+def _report_gemini_usage(provider: str, model_name: str, response, latency: float, cache_write_tokens: int = 0) -> None:
+    """Report the usage metadata of a Gemini response."""
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return
+    report_usage(
+        provider,
+        model_name,
+        input_tokens=getattr(usage, "prompt_token_count", 0),
+        output_tokens=getattr(usage, "candidates_token_count", 0),
+        cached_tokens=getattr(usage, "cached_content_token_count", 0),
+        cache_write_tokens=cache_write_tokens,
+        latency=latency
+    )
+
+# Gemini clients per (API key, endpoint). Each pooled key gets its own client
+# rather than swapping the key into a process-wide SDK configuration, which
+# concurrent calls on other keys would overwrite.
+_gemini_clients: Dict[tuple, Any] = {}
+_gemini_clients_lock = threading.Lock()
+
+def _gemini_client():
+    """
+    Get the Gemini client for the API key of the running call.
+    
+    Returns:
+        A google.genai Client bound to that key (and to the stand-in server in mock mode)
+    
+    Raises:
+        ProviderConfigError: If no Gemini API key is set
+    """
+    from google import genai
+    from google.genai import types
+    
+    # Get API key from environment variables (or the key checked out from the pool)
+    api_key = get_api_key("GEMINI_API_KEY")
+    if not api_key:
+        raise ProviderConfigError("gemini", "Error: Gemini API key not found. Please set the GEMINI_API_KEY environment variable.")
+    
+    base_url = get_base_url("gemini")
+    with _gemini_clients_lock:
+        client = _gemini_clients.get((api_key, base_url))
+        if client is None:
+            client = genai.Client(
+                api_key=api_key,
+                http_options=types.HttpOptions(base_url=base_url) if base_url else None
+            )
+            _gemini_clients[(api_key, base_url)] = client
+    return client
+
+def _gemini_message(message: Dict[str, Any]):
+    """Convert one chat message to the format expected by Gemini."""
+    from google.genai import types
+    
+    role = "user" if message["role"] == "user" else "model"
+    return types.Content(role=role, parts=[types.Part.from_text(text=message["content"])])
+
+def _gemini_http_options():
+    """Per-request HTTP options capping the call at the time left before its deadline."""
+    from google.genai import types
+    
+    timeout = remaining_time()
+    return types.HttpOptions(timeout=int(timeout * 1000)) if timeout else None
+
+def _gemini_chat_request(client, prompt: str, message_history: List[Dict[str, str]], temperature: float, model_name: str) -> tuple:
+    """
+    Contents and config for a chat turn holding the conversation so far.
+    
+    The stable prefix of long conversations is served from an explicit prompt cache.
+    
+    Returns:
+        Tuple of (contents, generation config, tokens written to a new prompt cache)
+    """
+    from google.genai import types
+    
+    formatted_history = format_history("gemini", message_history, _gemini_message)
+    cache_write_tokens = 0
+    
+    def create_cache(count):
+        nonlocal cache_write_tokens
+        cache = client.caches.create(
+            model=model_name,
+            config=types.CreateCachedContentConfig(
+                contents=formatted_history[:count],
+                ttl=f"{GEMINI_CACHE_TTL_SECONDS}s"
+            )
+        )
+        cache_write_tokens = cache.usage_metadata.total_token_count if cache.usage_metadata else 0
+        return cache
+    
+    # Cached contents belong to the project of the key that created them, so
+    # each pooled key keeps its own
+    cache_scope = f"gemini:{key_fingerprint(get_api_key('GEMINI_API_KEY'))}"
+    cache, covered = get_cached_prefix(current_conversation_id(), cache_scope, model_name, message_history, create_cache)
+    
+    contents = list(formatted_history[covered:])
+    contents.append(types.Content(role="user", parts=[types.Part.from_text(text=prompt)]))
+    config = types.GenerateContentConfig(
+        temperature=temperature,
+        cached_content=cache.name if cache else None,
+        http_options=_gemini_http_options()
+    )
+    return contents, config, cache_write_tokens
 
 # Gemini API 
+@single_flight("gemini")
+@cassette("gemini")
+@with_resilience("gemini")
+@rate_limited("gemini")
 def get_gemini_response(prompt: str, message_history: List[Dict[str, str]], image_data=None, audio_data=None, temperature=0.7, model_name="gemini-1.5-pro") -> str:
     """
     Get a response from the Gemini AI model.
@@ -26,61 +158,100 @@ def get_gemini_response(prompt: str, message_history: List[Dict[str, str]], imag
         from utils.vertex_ai import get_vertex_live_response
         return get_vertex_live_response(prompt, message_history, model_name=model_name)
     try:
-        import google.generativeai as genai
-        import base64
-        from PIL import Image
-        import io
-        
-        # Get API key from environment variables
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            return "Error: Gemini API key not found. Please set the GEMINI_API_KEY environment variable."
-        
-        # Configure the Gemini API
-        genai.configure(api_key=api_key)
-        
-        # Convert message history to the format expected by Gemini
-        formatted_history = []
-        for message in message_history:
-            # Include all messages in the history, don't exclude the last one
-            role = "user" if message["role"] == "user" else "model"
-            formatted_history.append({"role": role, "parts": [message["content"]]})
-        
-        # Use the provided model_name parameter
-        
-        # Create a Gemini model instance with generation config
-        model = genai.GenerativeModel(
-            model_name,
-            generation_config={"temperature": temperature}
-        )
+        from utils.images import prepare_image
+        from utils.audio_codec import build_gemini_audio_parts
+        
+        from google.genai import types
+        
+        client = _gemini_client()
         
-        # If there's an image, we need to handle it differently
-        if image_data:
-            # Convert base64 to image
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
+        # If there's an image or audio, we need to handle it differently
+        if image_data or audio_data:
+            # Create content parts with the text plus any media
+            parts = [types.Part.from_text(text=prompt)]
             
-            # Create content parts with both text and image
-            content = [
-                {"text": prompt},
-                {"inline_data": {"mime_type": "image/jpeg", "data": image_data}}
-            ]
+            if image_data:
+                # Downsized, re-encoded and memoized by content hash
+                image = prepare_image(image_data, "gemini")
+                parts.append(types.Part.from_bytes(data=image.data, mime_type=image.mime_type))
             
-            # Generate response with image input
-            response = model.generate_content(content)
+            if audio_data:
+                # Compressed and chunked; long clips are uploaded as files
+                parts.extend(build_gemini_audio_parts(audio_data, client))
+            
+            # Generate response with multimodal input
+            start = time.time()
+            response = client.models.generate_content(
+                model=model_name,
+                contents=[types.Content(role="user", parts=parts)],
+                config=types.GenerateContentConfig(temperature=temperature, http_options=_gemini_http_options())
+            )
+            _report_gemini_usage("gemini", model_name, response, time.time() - start)
             return response.text
         else:
-            # Start a chat session with history for text-only conversations
-            chat = model.start_chat(history=formatted_history)
+            # Send the user's message after the conversation so far
+            contents, config, cache_write_tokens = _gemini_chat_request(client, prompt, message_history, temperature, model_name)
             
-            # Send the user's message and get a response
-            response = chat.send_message(prompt)
+            start = time.time()
+            response = client.models.generate_content(model=model_name, contents=contents, config=config)
+            _report_gemini_usage("gemini", model_name, response, time.time() - start, cache_write_tokens)
             return response.text
             
     except Exception as e:
-        return f"Error with Gemini API: {str(e)}"
+        raise classify_error("gemini", e) from e
+
+@single_flight("gemini")
+@cassette("gemini")
+@with_resilience("gemini")
+@rate_limited("gemini")
+def stream_gemini_response(prompt: str, message_history: List[Dict[str, str]], temperature=0.7, model_name="gemini-1.5-pro"):
+    """
+    Stream a text response from the Gemini AI model, chunk by chunk.
+    
+    Closing the generator stops reading and releases the upstream connection.
+    
+    Args:
+        prompt: The user's input prompt
+        message_history: Previous message history
+        temperature: Temperature for response generation (creativity)
+        model_name: The specific Gemini model to use
+        
+    Yields:
+        Response text chunks as they arrive
+    """
+    try:
+        client = _gemini_client()
+        contents, config, cache_write_tokens = _gemini_chat_request(client, prompt, message_history, temperature, model_name)
+        
+        start = time.time()
+        response = client.models.generate_content_stream(model=model_name, contents=contents, config=config)
+        last = {}
+        
+        def text_chunks():
+            try:
+                for chunk in response:
+                    # Usage metadata comes with the final chunk
+                    if chunk.usage_metadata:
+                        last["chunk"] = chunk
+                    # Chunks without text parts (e.g. the final finish reason) have no text
+                    if chunk.text:
+                        yield chunk.text
+            finally:
+                response.close()
+        
+        yield from metered_stream("gemini", model_name, text_chunks(), input_tokens=estimate_tokens(prompt) + get_context_tokens(message_history))
+        _report_gemini_usage("gemini", model_name, last.get("chunk"), time.time() - start, cache_write_tokens)
+    
+    except GeneratorExit:
+        raise
+    except Exception as e:
+        raise classify_error("gemini", e) from e
 
 # Google Vertex AI (Alternative implementation without requiring vertex-ai packages)
+@single_flight("gemini")
+@cassette("gemini")
+@with_resilience("gemini")
+@rate_limited("gemini")
 def get_vertex_ai_response(prompt: str, message_history: List[Dict[str, str]], project_id=None, location=None, model_type=None, model_name=None) -> str:
     """
     Get a response similar to Vertex AI using Gemini API with advanced parameters.
@@ -98,66 +269,98 @@ def get_vertex_ai_response(prompt: str, message_history: List[Dict[str, str]], p
         The AI response text
     """
     try:
-        import google.generativeai as genai
-        
-        # Get API key from environment variables
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            return "Error: Gemini API key not found. Please set the GEMINI_API_KEY environment variable."
+        from google.genai import types
         
-        # Configure the Gemini API
-        genai.configure(api_key=api_key)
+        client = _gemini_client()
         
-        # Convert message history to the format expected by Gemini
-        formatted_history = []
-        for message in message_history:
-            # Include all messages in the history, don't exclude the last one
-            role = "user" if message["role"] == "user" else "model"
-            formatted_history.append({"role": role, "parts": [message["content"]]})
+        # Convert message history to the format expected by Gemini (only new messages are converted)
+        formatted_history = format_history("gemini", message_history, _gemini_message)
         
-        # Create a Gemini model instance with advanced settings
+        # Generation settings
         # Using more advanced settings to mimic Vertex AI capabilities
         # Use the specified model_name if provided, otherwise fallback to gemini-1.5-pro
         model_version = model_name if model_name else "gemini-1.5-pro"
-        model = genai.GenerativeModel(
-            model_version,
-            generation_config={
-                "temperature": 0.4,  # Lower temperature for more factual responses
-                "top_p": 0.8,
-                "top_k": 40,
-                "max_output_tokens": 2048,
-            },
+        config = types.GenerateContentConfig(
+            temperature=0.4,  # Lower temperature for more factual responses
+            top_p=0.8,
+            top_k=40,
+            max_output_tokens=2048,
             safety_settings=[
-                {
-                    "category": "HARM_CATEGORY_HARASSMENT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                },
-                {
-                    "category": "HARM_CATEGORY_HATE_SPEECH",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                },
-                {
-                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                },
-                {
-                    "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                }
-            ]
+                types.SafetySetting(category=category, threshold="BLOCK_MEDIUM_AND_ABOVE")
+                for category in (
+                    "HARM_CATEGORY_HARASSMENT",
+                    "HARM_CATEGORY_HATE_SPEECH",
+                    "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                    "HARM_CATEGORY_DANGEROUS_CONTENT",
+                )
+            ],
+            http_options=_gemini_http_options()
         )
         
-        # Start a chat session with history
-        chat = model.start_chat(history=formatted_history)
-        
-        # Send the user's message and get a response
-        response = chat.send_message(prompt)
+        # Send the user's message after the history
+        contents = list(formatted_history) + [types.Content(role="user", parts=[types.Part.from_text(text=prompt)])]
+        start = time.time()
+        response = client.models.generate_content(model=model_version, contents=contents, config=config)
+        _report_gemini_usage("gemini", model_version, response, time.time() - start)
         
         return response.text
     except Exception as e:
-        return f"Error with Vertex AI alternative: {str(e)}"
+        raise classify_error("gemini", e) from e
+
+def _openai_client():
+    """Create an OpenAI client for the current API key and endpoint."""
+    from openai import OpenAI
+    
+    # Get API key from environment variables
+    api_key = get_api_key("OPENAI_API_KEY")
+    if not api_key:
+        raise ProviderConfigError("openai", "Error: OpenAI API key not found. Please set the OPENAI_API_KEY environment variable.")
+    
+    # with_resilience is the only retry layer, so every attempt shows in health and breaker stats
+    return OpenAI(api_key=api_key, base_url=get_base_url("openai"), max_retries=0)
+
+def _openai_request(message_history: List[Dict[str, str]], model_name: str) -> Dict[str, Any]:
+    """Chat completion arguments shared by the plain and streaming calls."""
+    # Format the conversation history for OpenAI (only new messages are converted)
+    formatted_messages = format_history(
+        "openai",
+        message_history,
+        lambda message: {"role": message["role"], "content": message["content"]}
+    )
+    
+    # Keep the prompt prefix byte-stable so OpenAI's automatic prefix cache can hit
+    formatted_messages = order_for_prefix_cache(formatted_messages)
+    conversation_id = current_conversation_id()
+    
+    return {
+        "model": model_name,  # Use the provided model_name
+        "messages": formatted_messages,
+        "max_tokens": 800,
+        # Routes requests from one conversation to the same cache
+        "extra_body": {"prompt_cache_key": conversation_id} if conversation_id else None,
+        # Never outlive the caller's deadline
+        "timeout": remaining_time(),
+    }
+
+def _report_openai_usage(model_name: str, usage, latency: float) -> None:
+    """Report the usage block of an OpenAI response."""
+    if not usage:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    report_usage(
+        "openai",
+        model_name,
+        input_tokens=usage.prompt_tokens,
+        output_tokens=usage.completion_tokens,
+        cached_tokens=getattr(details, "cached_tokens", 0) if details else 0,
+        latency=latency
+    )
 
 # OpenAI API
+@single_flight("openai")
+@cassette("openai")
+@with_resilience("openai")
+@rate_limited("openai")
 def get_openai_response(prompt: str, message_history: List[Dict[str, str]], model_name="gpt-4o") -> str:
     """
     Get a response from the OpenAI GPT model.
@@ -171,39 +374,120 @@ def get_openai_response(prompt: str, message_history: List[Dict[str, str]], mode
         The AI response text
     """
     try:
-        from openai import OpenAI
-        
         # the newest OpenAI model is "gpt-4o" which was released May 13, 2024
         # do not change this unless explicitly requested by the user
         
-        # Get API key from environment variables
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            return "Error: OpenAI API key not found. Please set the OPENAI_API_KEY environment variable."
-        
         # Initialize OpenAI client
-        client = OpenAI(api_key=api_key)
-        
-        # Format the conversation history for OpenAI
-        formatted_messages = []
-        for message in message_history:
-            formatted_messages.append({
-                "role": message["role"],
-                "content": message["content"]
-            })
+        client = _openai_client()
         
         # Call the OpenAI API with the specified model
-        response = client.chat.completions.create(
-            model=model_name,  # Use the provided model_name
-            messages=formatted_messages,
-            max_tokens=800
-        )
+        start = time.time()
+        response = client.chat.completions.create(**_openai_request(message_history, model_name))
+        _report_openai_usage(model_name, response.usage, time.time() - start)
         
         return response.choices[0].message.content
     except Exception as e:
-        return f"Error with OpenAI API: {str(e)}"
+        raise classify_error("openai", e) from e
+
+@single_flight("openai")
+@cassette("openai")
+@with_resilience("openai")
+@rate_limited("openai")
+def stream_openai_response(prompt: str, message_history: List[Dict[str, str]], model_name="gpt-4o"):
+    """
+    Stream a response from the OpenAI GPT model, chunk by chunk.
+    
+    Closing the generator closes the HTTP response, which stops generation upstream.
+    
+    Args:
+        prompt: The user's input prompt
+        message_history: Previous message history
+        model_name: Specific model identifier to use (e.g., "gpt-4o")
+        
+    Yields:
+        Response text chunks as they arrive
+    """
+    try:
+        client = _openai_client()
+        
+        start = time.time()
+        stream = client.chat.completions.create(
+            stream=True,
+            # Usage arrives on a final chunk without choices
+            stream_options={"include_usage": True},
+            **_openai_request(message_history, model_name)
+        )
+        usage = {}
+        
+        def text_chunks():
+            try:
+                for chunk in stream:
+                    if chunk.usage:
+                        usage["usage"] = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                stream.close()
+        
+        yield from metered_stream("openai", model_name, text_chunks(), input_tokens=estimate_tokens(prompt) + get_context_tokens(message_history))
+        _report_openai_usage(model_name, usage.get("usage"), time.time() - start)
+    
+    except GeneratorExit:
+        raise
+    except Exception as e:
+        raise classify_error("openai", e) from e
+
+def _user_assistant_message(message: Dict[str, Any]) -> Dict[str, str]:
+    """Convert one chat message to a user/assistant {"role", "content"} dict."""
+    role = "user" if message["role"] == "user" else "assistant"
+    return {"role": role, "content": message["content"]}
+
+def _anthropic_client():
+    """Create an Anthropic client for the current API key and endpoint."""
+    from anthropic import Anthropic
+    
+    # Get API key from environment variables
+    api_key = get_api_key("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise ProviderConfigError("anthropic", "Error: Anthropic API key not found. Please set the ANTHROPIC_API_KEY environment variable.")
+    
+    # with_resilience is the only retry layer, so every attempt shows in health and breaker stats
+    return Anthropic(api_key=api_key, base_url=get_base_url("anthropic"), max_retries=0)
+
+def _anthropic_request(message_history: List[Dict[str, str]], model_name: str) -> Dict[str, Any]:
+    """Messages API arguments shared by the plain and streaming calls."""
+    # Format message history for Anthropic (only new messages are converted)
+    formatted_messages = format_history("anthropic", message_history, _user_assistant_message)
+    
+    return {
+        "model": model_name,  # Use the provided model_name
+        # Cache everything before the newest turn
+        "messages": apply_anthropic_cache_control(formatted_messages),
+        "max_tokens": 1000,
+        # Never outlive the caller's deadline
+        "timeout": remaining_time(),
+    }
+
+def _report_anthropic_usage(model_name: str, usage, latency: float) -> None:
+    """Report the usage block of an Anthropic response."""
+    # Anthropic reports cache reads and writes separately from input_tokens
+    cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    report_usage(
+        "anthropic",
+        model_name,
+        input_tokens=usage.input_tokens + cache_read + cache_write,
+        output_tokens=usage.output_tokens,
+        cached_tokens=cache_read,
+        cache_write_tokens=cache_write,
+        latency=latency
+    )
 
 # Anthropic API
+@single_flight("anthropic")
+@cassette("anthropic")
+@with_resilience("anthropic")
+@rate_limited("anthropic")
 def get_anthropic_response(prompt: str, message_history: List[Dict[str, str]], model_name="claude-3-5-sonnet-20241022") -> str:
     """
     Get a response from the Anthropic Claude model.
@@ -217,39 +501,80 @@ def get_anthropic_response(prompt: str, message_history: List[Dict[str, str]], m
         The AI response text
     """
     try:
-        from anthropic import Anthropic
-        
         # the newest Anthropic model is "claude-3-5-sonnet-20241022" which was released October 22, 2024
         
-        # Get API key from environment variables
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
-        if not api_key:
-            return "Error: Anthropic API key not found. Please set the ANTHROPIC_API_KEY environment variable."
-        
         # Initialize Anthropic client
-        client = Anthropic(api_key=api_key)
-        
-        # Format message history for Anthropic
-        formatted_messages = []
-        for message in message_history:
-            role = "user" if message["role"] == "user" else "assistant"
-            formatted_messages.append({
-                "role": role,
-                "content": message["content"]
-            })
+        client = _anthropic_client()
         
         # Call the Anthropic API with the specified model
-        response = client.messages.create(
-            model=model_name,  # Use the provided model_name
-            messages=formatted_messages,
-            max_tokens=1000
-        )
+        start = time.time()
+        response = client.messages.create(**_anthropic_request(message_history, model_name))
+        _report_anthropic_usage(model_name, response.usage, time.time() - start)
         
         return response.content[0].text
     except Exception as e:
-        return f"Error with Anthropic API: {str(e)}"
+        raise classify_error("anthropic", e) from e
+
+@single_flight("anthropic")
+@cassette("anthropic")
+@with_resilience("anthropic")
+@rate_limited("anthropic")
+def stream_anthropic_response(prompt: str, message_history: List[Dict[str, str]], model_name="claude-3-5-sonnet-20241022"):
+    """
+    Stream a response from the Anthropic Claude model, chunk by chunk.
+    
+    Closing the generator closes the HTTP response, which stops generation upstream.
+    
+    Args:
+        prompt: The user's input prompt
+        message_history: Previous message history
+        model_name: Specific model identifier to use (e.g., "claude-3-5-sonnet-20241022")
+        
+    Yields:
+        Response text chunks as they arrive
+    """
+    try:
+        client = _anthropic_client()
+        
+        start = time.time()
+        with client.messages.stream(**_anthropic_request(message_history, model_name)) as stream:
+            yield from metered_stream("anthropic", model_name, stream.text_stream, input_tokens=estimate_tokens(prompt) + get_context_tokens(message_history))
+            usage = stream.get_final_message().usage
+        _report_anthropic_usage(model_name, usage, time.time() - start)
+    
+    except GeneratorExit:
+        raise
+    except Exception as e:
+        raise classify_error("anthropic", e) from e
+
+def _perplexity_headers() -> Dict[str, str]:
+    """Request headers carrying the Perplexity API key."""
+    # Get API key from environment variables
+    api_key = get_api_key("PERPLEXITY_API_KEY")
+    if not api_key:
+        raise ProviderConfigError("perplexity", "Error: Perplexity API key not found. Please set the PERPLEXITY_API_KEY environment variable.")
+    
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+
+def _perplexity_messages(message_history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Format the conversation for Perplexity, behind a system message."""
+    # Add a system message for better performance
+    system = {
+        "role": "system",
+        "content": "You are a helpful, accurate AI assistant. Provide detailed and informative responses."
+    }
+    
+    # Add chat history (only new messages are converted)
+    return [system] + format_history("perplexity", message_history, _user_assistant_message)
 
 # Perplexity API
+@single_flight("perplexity")
+@cassette("perplexity")
+@with_resilience("perplexity")
+@rate_limited("perplexity")
 def get_perplexity_response(prompt: str, message_history: List[Dict[str, str]], temperature=0.2, model_name=None) -> str:
     """
     Get a response from the Perplexity API.
@@ -264,33 +589,9 @@ def get_perplexity_response(prompt: str, message_history: List[Dict[str, str]],
         The AI response text
     """
     try:
-        # Get API key from environment variables
-        api_key = os.environ.get("PERPLEXITY_API_KEY")
-        if not api_key:
-            return "Error: Perplexity API key not found. Please set the PERPLEXITY_API_KEY environment variable."
-        
         # Prepare headers
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        # Format all messages for Perplexity
-        formatted_messages = []
-        
-        # Add a system message for better performance
-        formatted_messages.append({
-            "role": "system",
-            "content": "You are a helpful, accurate AI assistant. Provide detailed and informative responses."
-        })
-        
-        # Add chat history
-        for message in message_history:
-            role = "user" if message["role"] == "user" else "assistant"
-            formatted_messages.append({
-                "role": role,
-                "content": message["content"]
-            })
+        headers = _perplexity_headers()
+        formatted_messages = _perplexity_messages(message_history)
         
         # Use the specified model if provided, otherwise use fallback mechanism
         if model_name:
@@ -302,31 +603,403 @@ def get_perplexity_response(prompt: str, message_history: List[Dict[str, str]],
         # Try each model in sequence until one works
         last_error = None
         for model in models_to_try:
-            try:
-                # Prepare request data with model name and parameters
-                data = {
-                    "model": model,  # Try each model in sequence
-                    "messages": formatted_messages,
-                    "max_tokens": 1000,
-                    "temperature": temperature,
-                    "top_p": 0.9,
-                    "stream": False
-                }
-                
-                # Make request to Perplexity API
-                response = requests.post(
-                    "https://api.perplexity.ai/chat/completions",
-                    headers=headers,
-                    json=data
+            # Prepare request data with model name and parameters
+            data = {
+                "model": model,  # Try each model in sequence
+                "messages": formatted_messages,
+                "max_tokens": 1000,
+                "temperature": temperature,
+                "top_p": 0.9,
+                "stream": False
+            }
+            
+            # Make request to Perplexity API
+            start = time.time()
+            response = requests.post(
+                get_perplexity_url(),
+                headers=headers,
+                json=data,
+                timeout=remaining_time(60)
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                usage = result.get("usage") or {}
+                report_usage(
+                    "perplexity",
+                    model,
+                    input_tokens=usage.get("prompt_tokens", 0),
+                    output_tokens=usage.get("completion_tokens", 0),
+                    latency=time.time() - start
                 )
-                
-                if response.status_code == 200:
-                    return response.json()["choices"][0]["message"]["content"]
-                last_error = f"Error from Perplexity API with model {model}: {response.text}"
-            except Exception as e:
-                last_error = f"Error with Perplexity API using model {model}: {str(e)}"
+                return result["choices"][0]["message"]["content"]
+            
+            # Rate limits and outages affect every model, so let the resilience layer handle them
+            error = error_from_response("perplexity", response)
+            if error.retryable:
+                raise error
+            last_error = f"Error from Perplexity API with model {model}: {response.text}"
         
         # If we get here, all models failed
-        return f"All Perplexity models failed. Last error: {last_error}"
+        raise ProviderError("perplexity", f"All Perplexity models failed. Last error: {last_error}")
+    except Exception as e:
+        raise classify_error("perplexity", e) from e
+
+@single_flight("perplexity")
+@cassette("perplexity")
+@with_resilience("perplexity")
+@rate_limited("perplexity")
+def stream_perplexity_response(prompt: str, message_history: List[Dict[str, str]], temperature=0.2, model_name="pplx-70b-online"):
+    """
+    Stream a response from the Perplexity API, chunk by chunk.
+    
+    Closing the generator closes the HTTP connection.
+    
+    Args:
+        prompt: The user's input prompt
+        message_history: Previous message history
+        temperature: Temperature value (0.0 to 1.0) that controls randomness
+        model_name: Specific model identifier to use
+        
+    Yields:
+        Response text chunks as they arrive
+    """
+    try:
+        data = {
+            "model": model_name,
+            "messages": _perplexity_messages(message_history),
+            "max_tokens": 1000,
+            "temperature": temperature,
+            "top_p": 0.9,
+            "stream": True
+        }
+        
+        start = time.time()
+        response = requests.post(
+            get_perplexity_url(),
+            headers=_perplexity_headers(),
+            json=data,
+            timeout=remaining_time(60),
+            stream=True
+        )
+        if response.status_code != 200:
+            raise error_from_response("perplexity", response)
+        usage = {}
+        
+        def text_chunks():
+            # Server-sent events, one JSON chunk per "data:" line
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        break
+                    chunk = json.loads(payload)
+                    if chunk.get("usage"):
+                        usage.update(chunk["usage"])
+                    choices = chunk.get("choices") or []
+                    if choices and (choices[0].get("delta") or {}).get("content"):
+                        yield choices[0]["delta"]["content"]
+            finally:
+                response.close()
+        
+        yield from metered_stream("perplexity", model_name, text_chunks(), input_tokens=estimate_tokens(prompt) + get_context_tokens(message_history))
+        if usage:
+            report_usage(
+                "perplexity",
+                model_name,
+                input_tokens=usage.get("prompt_tokens", 0),
+                output_tokens=usage.get("completion_tokens", 0),
+                latency=time.time() - start
+            )
+    
+    except GeneratorExit:
+        raise
     except Exception as e:
-        return f"General error with Perplexity API: {str(e)}"
+        raise classify_error("perplexity", e) from e
+
+# Model options offered in the UI, as "Provider (model call sign)"
+MODEL_OPTIONS = [
+    "Gemini",
+    "Vertex AI (gemini-2.5-pro-preview-03-25)",
+    "Vertex AI (claude-3-5-sonnet-20241022)",
+    "Vertex AI (gpt-4o)",
+    "OpenAI (gpt-4o)",
+    "Anthropic (claude-3-5-sonnet-20241022)",
+    "Perplexity (pplx-70b-online)",
+    "Auto (fast chat)",
+    "Auto (smart chat)",
+    "Auto (vision)",
+]
+
+def parse_model_option(model_option: str) -> tuple:
+    """
+    Split a UI model option into its provider and model call sign.
+    
+    Args:
+        model_option: The selected option (e.g., "OpenAI (gpt-4o)")
+        
+    Returns:
+        Tuple of (provider, model_call_sign), where provider is one of
+        "gemini", "vertex_gemini", "vertex_claude", "vertex_gpt", "vertex", "openai",
+        "anthropic", "perplexity", "auto" (call sign is the capability
+        tier) or None for unknown options
+    """
+    model_name = model_option.lower()
+    
+    # Extract model call sign from selected model if available
+    model_call_sign = None
+    if "(" in model_option and ")" in model_option:
+        model_call_sign = model_option.split("(")[1].split(")")[0]
+    
+    # "Auto (<tier>)" picks a model of that capability tier per call
+    if model_name.startswith("auto"):
+        return "auto", model_call_sign or "smart chat"
+    
+    if "vertex ai" in model_name:
+        if "gemini" in model_name:
+            return "vertex_gemini", model_call_sign or "gemini-2.5-pro-preview-03-25"
+        if "claude" in model_name:
+            return "vertex_claude", model_call_sign or "claude-3-5-sonnet-20241022"
+        if "gpt" in model_name:
+            return "vertex_gpt", model_call_sign or "gpt-4o"
+        return "vertex", model_call_sign
+    if "gemini" in model_name:
+        return "gemini", model_call_sign or "gemini-1.5-pro"
+    if "openai" in model_name:
+        return "openai", model_call_sign or "gpt-4o"
+    if "anthropic" in model_name:
+        return "anthropic", model_call_sign or "claude-3-5-sonnet-20241022"
+    if "perplexity" in model_name:
+        return "perplexity", model_call_sign or "pplx-70b-online"
+    return None, model_call_sign
+
+def get_model_response(model_option: str, prompt: str, message_history: List[Dict[str, str]], image_data=None, audio_data=None, temperature=0.7) -> str:
+    """
+    Get a response from whichever provider a UI model option points at.
+    
+    Args:
+        model_option: The selected option (e.g., "Anthropic (claude-3-5-sonnet-20241022)")
+        prompt: The user's input prompt
+        message_history: Message history to send (already trimmed to the model's budget)
+        image_data: Optional base64 encoded image data
+        audio_data: Optional base64 encoded audio data
+        temperature: Temperature for response generation
+        
+    Returns:
+        The AI response text
+        
+    Raises:
+        ProviderError: If the provider call fails
+    """
+    from utils.routing import get_routed_response, record_model_call
+    from utils.usage import check_budget
+    
+    provider, model_call_sign = parse_model_option(model_option)
+    
+    # Refuse before spending anything once the user is over budget
+    context = current_call()
+    check_budget(context.user if context else None)
+    
+    # Capability tiers are routed to a concrete model by live statistics
+    if provider == "auto":
+        return get_routed_response(
+            model_call_sign,
+            prompt,
+            message_history,
+            image_data=image_data,
+            audio_data=audio_data,
+            temperature=temperature
+        )
+    
+    # Feed every call's latency, errors and cost into the routing statistics
+    usage_start = len(context.usage) if context else 0
+    start = time.time()
+    try:
+        response = _call_provider(provider, model_call_sign, model_option, prompt, message_history, image_data, audio_data, temperature)
+    except CallCancelledError:
+        # Stopped by the caller; says nothing about the model
+        raise
+    except ProviderError:
+        record_model_call(model_option, model_call_sign, message_history, None, time.time() - start, ok=False)
+        raise
+    record_model_call(
+        model_option,
+        model_call_sign,
+        message_history,
+        response,
+        time.time() - start,
+        ok=True,
+        usage=context.usage[usage_start:] if context else None
+    )
+    return response
+
+def _call_provider(provider, model_call_sign, model_option, prompt, message_history, image_data, audio_data, temperature) -> str:
+    """Dispatch a parsed model option to its provider function."""
+    # Gemini models
+    if provider == "gemini":
+        return get_gemini_response(
+            prompt,
+            message_history,
+            image_data=image_data,
+            audio_data=audio_data,
+            temperature=temperature,
+            model_name=model_call_sign
+        )
+    
+    # Vertex AI models - direct routing to appropriate API based on model
+    if provider == "vertex_gemini":
+        from utils.vertex_ai import get_vertex_gemini_response
+        return get_vertex_gemini_response(
+            prompt,
+            message_history,
+            temperature=temperature,
+            model_name=model_call_sign,
+            image_data=image_data
+        )
+    if provider == "vertex_claude":
+        return get_anthropic_response(prompt, message_history, model_name=model_call_sign)
+    if provider == "vertex_gpt":
+        return get_openai_response(prompt, message_history, model_name=model_call_sign)
+    if provider == "vertex":
+        # For any other Vertex AI models, warn instead of calling
+        return "Note: This model may not be directly accessible through the current API configuration. " + \
+               "For best results with third-party models, please select them from their native provider section instead."
+    
+    # OpenAI models
+    if provider == "openai":
+        return get_openai_response(prompt, message_history, model_name=model_call_sign)
+    
+    # Anthropic models
+    if provider == "anthropic":
+        return get_anthropic_response(prompt, message_history, model_name=model_call_sign)
+    
+    # Perplexity models
+    if provider == "perplexity":
+        return get_perplexity_response(
+            prompt,
+            message_history,
+            temperature=temperature,
+            model_name=model_call_sign
+        )
+    
+    # Fallback for unknown models
+    raise ProviderConfigError(model_option, "Error: The selected model is not yet implemented.")
+
+def supports_streaming(model_option: str) -> bool:
+    """
+    Check whether a UI model option streams its response chunk by chunk.
+    
+    Args:
+        model_option: The selected option
+        
+    Returns:
+        True if stream_model_response yields chunks as they arrive
+    """
+    provider, _ = parse_model_option(model_option)
+    return provider in ("auto", "gemini", "vertex_claude", "vertex_gpt", "openai", "anthropic", "perplexity")
+
+def _stream_provider(provider, model_call_sign, prompt, message_history, temperature):
+    """Dispatch a parsed model option to its streaming provider function."""
+    if provider == "gemini":
+        if "live" in model_call_sign:
+            from utils.vertex_ai import stream_vertex_live_response
+            return stream_vertex_live_response(prompt, message_history, model_name=model_call_sign, temperature=temperature)
+        return stream_gemini_response(prompt, message_history, temperature=temperature, model_name=model_call_sign)
+    if provider in ("openai", "vertex_gpt"):
+        return stream_openai_response(prompt, message_history, model_name=model_call_sign)
+    if provider in ("anthropic", "vertex_claude"):
+        return stream_anthropic_response(prompt, message_history, model_name=model_call_sign)
+    return stream_perplexity_response(prompt, message_history, temperature=temperature, model_name=model_call_sign)
+
+def stream_model_response(model_option: str, prompt: str, message_history: List[Dict[str, str]], image_data=None, audio_data=None, temperature=0.7, cancel_event=None):
+    """
+    Stream a response from whichever provider a UI model option points at.
+    
+    Models that cannot stream (and multimodal turns) yield their whole
+    answer as a single chunk. The stream stops between chunks once
+    cancel_event is set or the call scope is cancelled or out of time;
+    the upstream connection is closed and CallCancelledError is raised,
+    so the caller keeps whatever chunks it already has.
+    
+    Args:
+        model_option: The selected option
+        prompt: The user's input prompt
+        message_history: Message history to send (already trimmed to the model's budget)
+        image_data: Optional base64 encoded image data
+        audio_data: Optional base64 encoded audio data
+        temperature: Temperature for response generation
+        cancel_event: Optional threading.Event that stops the stream when set
+            (defaults to the call scope's cancellation token)
+        
+    Yields:
+        Response text chunks
+        
+    Raises:
+        CallCancelledError: If the stream was cancelled or hit its deadline
+        ProviderError: If the provider call fails
+    """
+    if not supports_streaming(model_option) or image_data or audio_data:
+        yield get_model_response(
+            model_option,
+            prompt,
+            message_history,
+            image_data=image_data,
+            audio_data=audio_data,
+            temperature=temperature
+        )
+        return
+    
+    from utils.routing import record_model_call, stream_routed_response
+    from utils.call_context import check_cancelled
+    from utils.usage import check_budget
+    
+    provider, model_call_sign = parse_model_option(model_option)
+    if provider == "auto":
+        # Each candidate streams (and is measured) through this function in turn
+        yield from stream_routed_response(model_call_sign, prompt, message_history, temperature=temperature, cancel_event=cancel_event)
+        return
+    context = current_call()
+    check_budget(context.user if context else None)
+    if cancel_event is None and context is not None:
+        cancel_event = context.cancel_event
+    
+    def stopped() -> bool:
+        return (cancel_event is not None and cancel_event.is_set()) or (context is not None and context.cancelled)
+    
+    usage_start = len(context.usage) if context else 0
+    start = time.time()
+    ttft = None
+    chunks = []
+    stream = _stream_provider(provider, model_call_sign, prompt, message_history, temperature)
+    try:
+        for chunk in stream:
+            if stopped():
+                break
+            if ttft is None:
+                ttft = time.time() - start
+            chunks.append(chunk)
+            yield chunk
+    except CallCancelledError:
+        raise
+    except ProviderError:
+        record_model_call(model_option, model_call_sign, message_history, None, time.time() - start, ok=False)
+        raise
+    finally:
+        # Releases the upstream connection when cancelled or abandoned mid-stream
+        stream.close()
+    
+    if stopped():
+        check_cancelled(provider)
+        raise CallCancelledError(provider, "Stream cancelled")
+    record_model_call(
+        model_option,
+        model_call_sign,
+        message_history,
+        "".join(chunks),
+        time.time() - start,
+        ok=True,
+        usage=context.usage[usage_start:] if context else None,
+        ttft=ttft
+    )
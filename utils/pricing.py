@@ -0,0 +1,88 @@
+"""
+Model price table
+
+List prices in USD per million tokens, used to estimate what calls cost.
+Override or extend the table with a JSON file in MODEL_PRICES_FILE:
+    {"gpt-4o": {"input": 2.5, "output": 10, "cached": 1.25}}
+"""
+import os
+import json
+from typing import Dict, Optional
+
+MODEL_PRICES: Dict[str, Dict[str, float]] = {
+    # input / output / cached input (cache reads); cache_write where billed separately
+    "gpt-4o": {"input": 2.50, "output": 10.00, "cached": 1.25},
+    "gpt-4o-mini": {"input": 0.15, "output": 0.60, "cached": 0.075},
+    "claude-3-5-sonnet-20241022": {"input": 3.00, "output": 15.00, "cached": 0.30, "cache_write": 3.75},
+    "claude-3-5-haiku-20241022": {"input": 0.80, "output": 4.00, "cached": 0.08, "cache_write": 1.00},
+    "gemini-1.5-pro": {"input": 1.25, "output": 5.00, "cached": 0.3125},
+    "gemini-1.5-flash": {"input": 0.075, "output": 0.30, "cached": 0.01875},
+    "gemini-2.0-flash": {"input": 0.10, "output": 0.40, "cached": 0.025},
+    "gemini-2.0-flash-live-preview-04-09": {"input": 0.10, "output": 0.40, "cached": 0.025},
+    "gemini-2.5-pro-preview-03-25": {"input": 1.25, "output": 10.00, "cached": 0.31},
+    "pplx-70b-online": {"input": 1.00, "output": 1.00},
+    "pplx-7b-online": {"input": 0.20, "output": 0.20},
+}
+
+# Providers whose reported input total includes the tokens written to the
+# prompt cache. Gemini creates its caches in a separate request, so the
+# tokens written are billed on top of the call's input.
+CACHE_WRITES_IN_INPUT = {"anthropic"}
+
+_prices_file = os.environ.get("MODEL_PRICES_FILE")
+if _prices_file and os.path.exists(_prices_file):
+    with open(_prices_file, "r") as f:
+        MODEL_PRICES.update(json.load(f))
+
+
+def get_model_price(model: str) -> Optional[Dict[str, float]]:
+    """
+    Look up a model's prices.
+
+    Args:
+        model: Model identifier (e.g. "gpt-4o")
+
+    Returns:
+        Dict with "input", "output" and optionally "cached"/"cache_write", or None if unknown
+    """
+    if not model:
+        return None
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    # Dated or suffixed variants share their base model's price
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_PRICES[name]
+    return None
+
+
+def estimate_cost(model: str, input_tokens: int = 0, output_tokens: int = 0, cached_tokens: int = 0, cache_write_tokens: int = 0, provider: Optional[str] = None) -> float:
+    """
+    Estimate the cost of one call.
+
+    Args:
+        model: Model identifier
+        input_tokens: Prompt tokens, including cached tokens (and cache-write
+            tokens for providers in CACHE_WRITES_IN_INPUT)
+        output_tokens: Generated tokens
+        cached_tokens: Prompt tokens read from the provider's cache
+        cache_write_tokens: Prompt tokens written to the provider's cache
+        provider: Provider that reported the usage
+
+    Returns:
+        Cost in USD (0.0 for models missing from the price table)
+    """
+    price = get_model_price(model)
+    if not price:
+        return 0.0
+    uncached = input_tokens - cached_tokens
+    if provider in CACHE_WRITES_IN_INPUT:
+        uncached -= cache_write_tokens
+    uncached = max(0, uncached)
+    cost = (
+        uncached * price["input"]
+        + cached_tokens * price.get("cached", price["input"])
+        + cache_write_tokens * price.get("cache_write", price["input"])
+        + output_tokens * price["output"]
+    )
+    return cost / 1_000_000
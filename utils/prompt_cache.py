@@ -0,0 +1,262 @@
+"""
+Provider-side prompt-prefix caching
+
+Marks the stable prefix of a conversation (everything before the newest
+turn) for each provider's prompt cache, and tracks cache reads and writes
+per conversation so hit rates and latency savings can be measured.
+
+- Anthropic: a cache_control breakpoint at the end of the stable prefix
+- Gemini / Vertex: explicit cached content covering the stable prefix,
+  reused while that prefix is unchanged
+- OpenAI: automatic prefix caching, helped by keeping the prefix byte-stable
+  (pinned/system messages first) and a per-conversation prompt_cache_key
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Callable
+
+from utils.resilience import classify_error
+
+# Smallest prefix each model accepts for explicit caching (longest matching
+# prefix wins); GEMINI_CACHE_MIN_TOKENS overrides them all
+GEMINI_CACHE_MIN_TOKENS_BY_MODEL = {
+    "gemini-2.5-flash": 1024,
+    "gemini-2.5-pro": 4096,
+    "gemini": 4096,
+}
+GEMINI_CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CACHE_MIN_TOKENS", "0")) or None
+GEMINI_CACHE_TTL_SECONDS = int(os.environ.get("GEMINI_CACHE_TTL_SECONDS", "600"))
+
+# Conversations with cache statistics and prefix caches kept, least recently used dropped first
+PROMPT_CACHE_MAX_CONVERSATIONS = int(os.environ.get("PROMPT_CACHE_MAX_CONVERSATIONS", "256"))
+
+_stats: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_stats_lock = threading.Lock()
+
+# (conversation_id, provider, model) -> cached prefix entry
+_prefix_caches: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+_unsupported_models = set()
+_prefix_lock = threading.Lock()
+
+
+def _new_stats() -> Dict[str, Any]:
+    return {
+        "calls": 0,
+        "input_tokens": 0,
+        "cached_tokens": 0,
+        "cache_write_tokens": 0,
+        "cached_calls": 0,
+        "cached_latency_total": 0.0,
+        "uncached_calls": 0,
+        "uncached_latency_total": 0.0,
+    }
+
+
+def record_cache_usage(record: Dict[str, Any]) -> None:
+    """
+    Add one call's usage record to its conversation's cache statistics.
+
+    Args:
+        record: Usage record from report_usage
+    """
+    conversation_id = record.get("conversation_id")
+    if not conversation_id:
+        return
+    with _stats_lock:
+        stats = _stats.get(conversation_id)
+        if stats is None:
+            stats = _stats[conversation_id] = _new_stats()
+        _stats.move_to_end(conversation_id)
+        while len(_stats) > PROMPT_CACHE_MAX_CONVERSATIONS:
+            _stats.popitem(last=False)
+        stats["calls"] += 1
+        stats["input_tokens"] += record["input_tokens"]
+        stats["cached_tokens"] += record["cached_tokens"]
+        stats["cache_write_tokens"] += record["cache_write_tokens"]
+        if record.get("latency") is not None:
+            if record["cached_tokens"]:
+                stats["cached_calls"] += 1
+                stats["cached_latency_total"] += record["latency"]
+            else:
+                stats["uncached_calls"] += 1
+                stats["uncached_latency_total"] += record["latency"]
+
+
+def get_cache_stats(conversation_id: str) -> Dict[str, Any]:
+    """
+    Cache statistics for one conversation.
+
+    Args:
+        conversation_id: The conversation identifier
+
+    Returns:
+        Token totals, hit ratio and average latency with and without cache hits
+    """
+    with _stats_lock:
+        stats = dict(_stats.get(conversation_id) or _new_stats())
+    stats["hit_ratio"] = stats["cached_tokens"] / stats["input_tokens"] if stats["input_tokens"] else 0.0
+    stats["avg_cached_latency"] = stats["cached_latency_total"] / stats["cached_calls"] if stats["cached_calls"] else None
+    stats["avg_uncached_latency"] = stats["uncached_latency_total"] / stats["uncached_calls"] if stats["uncached_calls"] else None
+    if stats["avg_cached_latency"] is not None and stats["avg_uncached_latency"] is not None:
+        stats["latency_saving"] = stats["avg_uncached_latency"] - stats["avg_cached_latency"]
+    else:
+        stats["latency_saving"] = None
+    return stats
+
+
+def order_for_prefix_cache(formatted_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Put system messages first so the start of the prompt stays byte-identical across turns.
+
+    Args:
+        formatted_messages: OpenAI-style {"role", "content"} messages
+
+    Returns:
+        The reordered messages
+    """
+    system = [m for m in formatted_messages if m["role"] == "system"]
+    rest = [m for m in formatted_messages if m["role"] != "system"]
+    return system + rest
+
+
+def apply_anthropic_cache_control(formatted_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Mark the end of the stable prefix with an Anthropic cache_control breakpoint.
+
+    The breakpoint goes on the message before the newest turn, so the next
+    request reads everything up to it from the cache.
+
+    Args:
+        formatted_messages: Anthropic-style {"role", "content"} messages
+
+    Returns:
+        The messages, with the breakpoint message converted to content blocks
+    """
+    if len(formatted_messages) < 2:
+        return formatted_messages
+    index = len(formatted_messages) - 2
+    message = formatted_messages[index]
+    content = message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = [dict(block) for block in content]
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    marked = list(formatted_messages)
+    marked[index] = {"role": message["role"], "content": content}
+    return marked
+
+
+def _fingerprint(messages: List[Dict[str, Any]]) -> str:
+    """Hash the parts of the messages that end up in the prompt, attachments included."""
+    from utils.context import message_signature
+
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update((message.get("role") or "").encode("utf-8"))
+        digest.update(b"\x00")
+        # Content, image and audio, hashed once per message by context.py
+        digest.update(message_signature(message).encode("utf-8"))
+        digest.update(b"\x01")
+    return digest.hexdigest()
+
+
+def get_cache_min_tokens(model: str) -> int:
+    """
+    Smallest prefix worth (and allowed) to cache explicitly for a model.
+
+    Args:
+        model: Model identifier
+
+    Returns:
+        Minimum prefix size in tokens
+    """
+    if GEMINI_CACHE_MIN_TOKENS:
+        return GEMINI_CACHE_MIN_TOKENS
+    name = (model or "").lower()
+    best_prefix = max((prefix for prefix in GEMINI_CACHE_MIN_TOKENS_BY_MODEL if prefix in name), key=len, default="gemini")
+    return GEMINI_CACHE_MIN_TOKENS_BY_MODEL[best_prefix]
+
+
+def _is_unsupported(error) -> bool:
+    """Whether a cache creation error means the model cannot use explicit caching at all."""
+    message = str(error).lower()
+    if error.status_code == 404:
+        return True
+    return error.status_code == 400 and ("not supported" in message or "does not support" in message)
+
+
+def get_cached_prefix(conversation_id: Optional[str], provider: str, model: str, message_history: List[Dict[str, Any]], create_cache: Callable[[int], Any]) -> tuple:
+    """
+    Find or create an explicit prompt cache for the stable prefix of a conversation.
+
+    The newest message is never cached. An existing cache is reused while
+    the messages it covers are unchanged; a new, longer one is created
+    once the uncached tail alone reaches the model's minimum cache size.
+    build_context drops old history in whole blocks, so the covered
+    messages stay unchanged from one turn to the next.
+
+    Args:
+        conversation_id: The conversation identifier (no caching without one)
+        provider: Provider name ("gemini" or "vertex"), with a ":<scope>" suffix
+            when caches are only usable from one region or API key
+        model: Model identifier
+        message_history: The history about to be sent
+        create_cache: Callable taking the number of prefix messages to cache
+            and returning a provider cache handle
+
+    Returns:
+        Tuple of (cache handle or None, number of messages the cache covers)
+
+    Raises:
+        ProviderError: If creating the cache failed with a retryable error
+    """
+    from utils.context import get_context_tokens
+
+    if not conversation_id or (provider, model) in _unsupported_models or len(message_history) < 2:
+        return None, 0
+
+    key = (conversation_id, provider, model)
+    now = time.time()
+    with _prefix_lock:
+        entry = _prefix_caches.get(key)
+        if entry is not None:
+            _prefix_caches.move_to_end(key)
+
+    covered = 0
+    if entry and entry["expires_at"] > now + 30 and entry["count"] < len(message_history):
+        if _fingerprint(message_history[:entry["count"]]) == entry["fingerprint"]:
+            covered = entry["count"]
+
+    prefix_count = len(message_history) - 1
+    uncached_tokens = get_context_tokens(message_history[covered:prefix_count])
+    if uncached_tokens < get_cache_min_tokens(model):
+        return (entry["handle"], covered) if covered else (None, 0)
+
+    try:
+        handle = create_cache(prefix_count)
+    except Exception as e:
+        error = classify_error(provider.split(":")[0], e)
+        if error.retryable:
+            raise error from e
+        print(f"Prompt cache unavailable for {provider}/{model}: {e}")
+        if _is_unsupported(error):
+            # Models without explicit caching support: remember and stop trying
+            with _prefix_lock:
+                _unsupported_models.add((provider, model))
+        return (entry["handle"], covered) if covered else (None, 0)
+
+    with _prefix_lock:
+        _prefix_caches[key] = {
+            "handle": handle,
+            "count": prefix_count,
+            "fingerprint": _fingerprint(message_history[:prefix_count]),
+            "expires_at": now + GEMINI_CACHE_TTL_SECONDS,
+        }
+        _prefix_caches.move_to_end(key)
+        while len(_prefix_caches) > PROMPT_CACHE_MAX_CONVERSATIONS:
+            _prefix_caches.popitem(last=False)
+    return handle, prefix_count
@@ -0,0 +1,324 @@
+"""
+Client-side rate limiting for model provider API keys
+
+One limiter per provider and API key is shared by every Streamlit session
+in the process. Each limiter holds two token buckets (requests per minute
+and tokens per minute). Calls that would exceed either bucket wait in a
+priority queue until capacity frees up or their deadline passes, instead
+of being sent upstream and rejected with a 429.
+"""
+import os
+import time
+import heapq
+import hashlib
+import threading
+import itertools
+import inspect
+import functools
+import contextlib
+import contextvars
+from typing import Dict, Any, Optional, Callable
+
+from utils.context import get_context_tokens, estimate_tokens
+from utils.resilience import ProviderError, CallCancelledError
+
+# Lower numbers are served first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+# Default longest wait in the queue before giving up
+DEFAULT_MAX_WAIT_SECONDS = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "30"))
+
+# How often a cancellable caller in the queue checks for cancellation
+CANCEL_POLL_SECONDS = 0.25
+
+# Conservative defaults; override with e.g. OPENAI_RPM / OPENAI_TPM
+DEFAULT_LIMITS = {
+    "openai": {"rpm": 500, "tpm": 30000},
+    "anthropic": {"rpm": 50, "tpm": 40000},
+    "gemini": {"rpm": 60, "tpm": 1000000},
+    "perplexity": {"rpm": 50, "tpm": 100000},
+    "vertex": {"rpm": 60, "tpm": 1000000},
+}
+
+API_KEY_ENV_VARS = {
+    "openai": "OPENAI_API_KEY",
+    "anthropic": "ANTHROPIC_API_KEY",
+    "gemini": "GEMINI_API_KEY",
+    "perplexity": "PERPLEXITY_API_KEY",
+}
+
+# Output tokens assumed per call when estimating TPM usage
+ESTIMATED_OUTPUT_TOKENS = 800
+
+_priority: contextvars.ContextVar = contextvars.ContextVar("rate_limit_priority", default=PRIORITY_NORMAL)
+
+
+class RateLimitTimeoutError(ProviderError):
+    """A call waited in the client-side queue past its deadline."""
+    provider_fault = False
+
+
+class TokenBucket:
+    """
+    Classic token bucket refilled continuously at capacity per minute.
+    Not thread-safe on its own; the owning limiter holds the lock.
+    """
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` can be taken (0 if available now)."""
+        self._refill()
+        # A single request larger than the bucket is allowed once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+
+class ProviderRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limiter for one provider key,
+    with a priority queue of waiting callers.
+    """
+    def __init__(self, provider: str, rpm: float, tpm: float):
+        self.provider = provider
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self.total_waits = 0
+        self.total_wait_seconds = 0.0
+        self.last_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def acquire(self, tokens: int, priority: int = PRIORITY_NORMAL, deadline: Optional[float] = None, cancel_event: Optional[threading.Event] = None) -> float:
+        """
+        Block until the call fits both buckets.
+
+        Args:
+            tokens: Estimated tokens (prompt + output) for the call
+            priority: Queue priority, lower is served first
+            deadline: Absolute time.monotonic() after which to give up
+            cancel_event: Optional event that takes the caller out of the queue when set
+
+        Returns:
+            Seconds spent waiting
+
+        Raises:
+            RateLimitTimeoutError: If the deadline passes first
+            CallCancelledError: If cancel_event is set first
+        """
+        start = time.monotonic()
+        entry = (priority, next(self._sequence))
+
+        with self._condition:
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    wait = None
+                    if self._queue[0] == entry:
+                        wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                        if wait == 0:
+                            self.requests.take(1)
+                            self.tokens.take(tokens)
+                            break
+
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise CallCancelledError(self.provider, "Cancelled while waiting for rate limit capacity")
+
+                    now = time.monotonic()
+                    if deadline is not None and now >= deadline:
+                        self.timeouts += 1
+                        raise RateLimitTimeoutError(
+                            self.provider,
+                            f"Timed out after {now - start:.1f}s waiting for rate limit capacity"
+                        )
+
+                    # Callers behind the head just wait to be notified
+                    if deadline is not None:
+                        wait = min(wait, deadline - now) if wait is not None else deadline - now
+                    if cancel_event is not None:
+                        # Wake up regularly to notice cancellation
+                        wait = min(wait, CANCEL_POLL_SECONDS) if wait is not None else CANCEL_POLL_SECONDS
+                    self._condition.wait(timeout=wait)
+            finally:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+
+        waited = time.monotonic() - start
+        self.last_wait_seconds = waited
+        if waited > 0.001:
+            self.total_waits += 1
+            self.total_wait_seconds += waited
+        return waited
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth, wait times and remaining bucket capacity."""
+        with self._condition:
+            self.requests._refill()
+            self.tokens._refill()
+            return {
+                "queue_depth": len(self._queue),
+                "last_wait": self.last_wait_seconds,
+                "avg_wait": self.total_wait_seconds / self.total_waits if self.total_waits else 0.0,
+                "waits": self.total_waits,
+                "timeouts": self.timeouts,
+                "requests_available": int(self.requests.level),
+                "tokens_available": int(self.tokens.level),
+            }
+
+
+_limiters: Dict[tuple, ProviderRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _get_limit(provider: str, kind: str) -> float:
+    """Read a provider's RPM/TPM limit from the environment or the defaults."""
+    value = os.environ.get(f"{provider.upper()}_{kind.upper()}")
+    if value:
+        return float(value)
+    return DEFAULT_LIMITS.get(provider, {"rpm": 60, "tpm": 100000})[kind]
+
+
+def key_fingerprint(api_key: Optional[str]) -> str:
+    """
+    Short, non-reversible identifier for an API key.
+
+    Args:
+        api_key: The raw key (may be None)
+
+    Returns:
+        An 8-character fingerprint, or "default"
+    """
+    if not api_key:
+        return "default"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+
+def get_limiter(provider: str, api_key: Optional[str] = None) -> ProviderRateLimiter:
+    """
+    Get (or create) the limiter for a provider and API key.
+
+    Args:
+        provider: Provider name
+        api_key: The API key in use; defaults to the provider's environment variable
+
+    Returns:
+        The shared ProviderRateLimiter
+    """
+    if api_key is None and provider in API_KEY_ENV_VARS:
+        api_key = os.environ.get(API_KEY_ENV_VARS[provider])
+    key = (provider, key_fingerprint(api_key))
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = ProviderRateLimiter(provider, _get_limit(provider, "rpm"), _get_limit(provider, "tpm"))
+        return _limiters[key]
+
+
+def get_rate_limit_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Snapshot of every limiter's queue and wait statistics.
+
+    Returns:
+        Dict of "provider:key-fingerprint" to stats
+    """
+    with _limiters_lock:
+        items = list(_limiters.items())
+    return {f"{provider}:{fingerprint}": limiter.stats() for (provider, fingerprint), limiter in items}
+
+
+@contextlib.contextmanager
+def request_priority(priority: int):
+    """
+    Run provider calls inside the block at the given queue priority.
+
+    Args:
+        priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _estimate_call_tokens(args: tuple, kwargs: Dict[str, Any]) -> int:
+    """Estimate prompt plus output tokens from a provider function's (prompt, message_history) arguments."""
+    prompt = kwargs.get("prompt", args[0] if args else "")
+    history = kwargs.get("message_history", args[1] if len(args) > 1 else [])
+    return estimate_tokens(prompt or "") + get_context_tokens(history or []) + ESTIMATED_OUTPUT_TOKENS
+
+
+def _acquire(limiter: ProviderRateLimiter, args: tuple, kwargs: Dict[str, Any], max_wait: float) -> None:
+    """Wait for capacity, giving up at max_wait, the call's deadline or its cancellation."""
+    from utils.call_context import current_call, remaining_time
+
+    context = current_call()
+    limiter.acquire(
+        _estimate_call_tokens(args, kwargs),
+        priority=_priority.get(),
+        deadline=time.monotonic() + remaining_time(max_wait),
+        cancel_event=context.cancel_event if context else None
+    )
+
+
+def rate_limited(provider: str, max_wait: float = DEFAULT_MAX_WAIT_SECONDS) -> Callable:
+    """
+    Decorator that waits for rate limit capacity before calling a provider function.
+
+    When the provider has a key pool, a key is checked out first and the
+    call waits on that key's limiter.
+
+    Args:
+        provider: Provider name
+        max_wait: Longest time a call may wait in the queue
+
+    Returns:
+        The decorator
+    """
+    def decorator(fn: Callable) -> Callable:
+        from utils.key_pool import get_key_pool
+
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def stream_wrapper(*args, **kwargs):
+                pool = get_key_pool(provider)
+                if pool is None:
+                    # Capacity is taken when iteration starts, not when the generator is created
+                    _acquire(get_limiter(provider), args, kwargs, max_wait)
+                    yield from fn(*args, **kwargs)
+                    return
+                with pool.checkout() as api_key:
+                    _acquire(get_limiter(provider, api_key), args, kwargs, max_wait)
+                    yield from fn(*args, **kwargs)
+            return stream_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            pool = get_key_pool(provider)
+            if pool is None:
+                _acquire(get_limiter(provider), args, kwargs, max_wait)
+                return fn(*args, **kwargs)
+            # Each key in a provider's pool has its own limiter
+            with pool.checkout() as api_key:
+                _acquire(get_limiter(provider, api_key), args, kwargs, max_wait)
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,468 @@
+"""
+Resilience layer for model provider calls
+
+Provides typed provider errors, bounded retries with jittered exponential
+backoff (honouring Retry-After), per-provider circuit breakers and health
+statistics for the UI.
+"""
+import os
+import time
+import random
+import threading
+import inspect
+import functools
+from typing import Dict, Any, Optional, Callable
+
+# Retry policy
+MAX_ATTEMPTS = int(os.environ.get("PROVIDER_MAX_ATTEMPTS", "3"))
+BACKOFF_BASE_SECONDS = float(os.environ.get("PROVIDER_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX_SECONDS = float(os.environ.get("PROVIDER_BACKOFF_MAX", "8"))
+
+# Longest Retry-After we are willing to wait inside a user's turn
+MAX_RETRY_AFTER_SECONDS = float(os.environ.get("PROVIDER_MAX_RETRY_AFTER", "20"))
+
+# Circuit breaker policy
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("PROVIDER_BREAKER_THRESHOLD", "5"))
+BREAKER_RECOVERY_SECONDS = float(os.environ.get("PROVIDER_BREAKER_RECOVERY", "30"))
+
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504, 529}
+
+
+class ProviderError(Exception):
+    """Base class for errors raised by model provider calls."""
+    retryable = False
+    # False for errors raised on our side before the provider was reached,
+    # which say nothing about the provider's health
+    provider_fault = True
+
+    def __init__(self, provider: str, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.provider = provider
+        self.status_code = status_code
+
+
+class ProviderConfigError(ProviderError):
+    """Missing API key, credentials or an unknown model. Never retried."""
+
+
+class TransientProviderError(ProviderError):
+    """Timeouts, connection failures and 5xx responses."""
+    retryable = True
+
+
+class RateLimitError(TransientProviderError):
+    """The provider returned 429 or reported quota exhaustion."""
+
+    def __init__(self, provider: str, message: str, status_code: Optional[int] = 429, retry_after: Optional[float] = None):
+        super().__init__(provider, message, status_code)
+        self.retry_after = retry_after
+
+
+class CallCancelledError(ProviderError):
+    """The caller cancelled the call or its deadline passed. Never retried."""
+    provider_fault = False
+
+    def __init__(self, provider: str, message: str, reason: Optional[str] = None):
+        super().__init__(provider, message)
+        self.reason = reason or "cancelled"
+
+
+class CircuitOpenError(ProviderError):
+    """The provider's circuit breaker is open, so the call was not attempted."""
+
+
+def _get_status_code(exc: Exception) -> Optional[int]:
+    """Pull an HTTP status code out of an SDK exception, if it has one."""
+    for attr in ("status_code", "code", "http_status"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def _get_retry_after(exc: Exception) -> Optional[float]:
+    """Read a Retry-After hint (seconds) from an SDK exception's response headers."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        # HTTP-date values are rare for these APIs; fall back to backoff
+        return None
+    return None
+
+
+def classify_error(provider: str, exc: Exception) -> ProviderError:
+    """
+    Convert any exception from a provider SDK into a typed ProviderError.
+
+    Args:
+        provider: Provider name (e.g., "openai")
+        exc: The exception raised by the SDK or HTTP client
+
+    Returns:
+        A ProviderError subclass describing the failure
+    """
+    if isinstance(exc, ProviderError):
+        return exc
+
+    status_code = _get_status_code(exc)
+    message = f"Error with {provider} API: {str(exc)}"
+    lowered = str(exc).lower()
+
+    if status_code == 429 or "rate limit" in lowered or "resource exhausted" in lowered or "quota" in lowered:
+        return RateLimitError(provider, message, status_code or 429, retry_after=_get_retry_after(exc))
+    if status_code in RETRYABLE_STATUS_CODES:
+        return TransientProviderError(provider, message, status_code)
+    if status_code in (401, 403):
+        return ProviderConfigError(provider, message, status_code)
+
+    name = type(exc).__name__.lower()
+    if "timeout" in name or "connection" in name or "unavailable" in name or isinstance(exc, (TimeoutError, ConnectionError)):
+        return TransientProviderError(provider, message, status_code)
+    return ProviderError(provider, message, status_code)
+
+
+def error_from_response(provider: str, response) -> ProviderError:
+    """
+    Build a typed ProviderError from a failed `requests` response.
+
+    Args:
+        provider: Provider name
+        response: The non-2xx requests.Response
+
+    Returns:
+        A ProviderError subclass describing the failure
+    """
+    message = f"Error from {provider} API ({response.status_code}): {response.text}"
+    if response.status_code == 429:
+        retry_after = response.headers.get("retry-after")
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        return RateLimitError(provider, message, 429, retry_after=retry_after)
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        return TransientProviderError(provider, message, response.status_code)
+    if response.status_code in (401, 403):
+        return ProviderConfigError(provider, message, response.status_code)
+    return ProviderError(provider, message, response.status_code)
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open circuit breaker for one provider.
+
+    After BREAKER_FAILURE_THRESHOLD consecutive retryable failures the
+    breaker opens and calls fail fast. After BREAKER_RECOVERY_SECONDS a
+    single trial call is let through (half-open); its outcome closes or
+    re-opens the breaker.
+    """
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, recovery_seconds: float = BREAKER_RECOVERY_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Return True if a call may be attempted now."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.time() - self.opened_at < self.recovery_seconds:
+                    return False
+                self.state = "half_open"
+                self._trial_in_flight = False
+            # Half-open: let exactly one trial call through
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        """Close the breaker after a successful call."""
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        """Count a retryable failure, opening the breaker when the threshold is hit."""
+        with self._lock:
+            self.consecutive_failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.time()
+
+    def release(self) -> None:
+        """Release a half-open trial slot without recording an outcome."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def retry_in(self) -> float:
+        """Seconds until an open breaker will allow a trial call."""
+        if self.state != "open" or self.opened_at is None:
+            return 0.0
+        return max(0.0, self.recovery_seconds - (time.time() - self.opened_at))
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_health: Dict[str, Dict[str, Any]] = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    """
+    Get (or create) the circuit breaker for a provider.
+
+    Args:
+        provider: Provider name
+
+    Returns:
+        The provider's CircuitBreaker
+    """
+    with _registry_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker()
+            _health[provider] = {
+                "calls": 0,
+                "successes": 0,
+                "failures": 0,
+                "retries": 0,
+                "rejected": 0,
+                "last_error": None,
+                "last_latency": None,
+                "avg_latency": None,
+            }
+        return _breakers[provider]
+
+
+def _record(provider: str, **updates) -> None:
+    """Apply counter increments and field updates to a provider's health stats."""
+    with _registry_lock:
+        stats = _health[provider]
+        for key, value in updates.items():
+            if key in ("calls", "successes", "failures", "retries", "rejected"):
+                stats[key] += value
+            elif key == "latency":
+                stats["last_latency"] = value
+                # Exponentially weighted average smooths out single slow calls
+                previous = stats["avg_latency"]
+                stats["avg_latency"] = value if previous is None else 0.8 * previous + 0.2 * value
+            else:
+                stats[key] = value
+
+
+def get_provider_health() -> Dict[str, Dict[str, Any]]:
+    """
+    Snapshot of health statistics for every provider called so far.
+
+    Returns:
+        Dict of provider name to stats, including breaker state
+    """
+    with _registry_lock:
+        snapshot = {}
+        for provider, stats in _health.items():
+            breaker = _breakers[provider]
+            snapshot[provider] = dict(stats, state=breaker.state, retry_in=breaker.retry_in())
+        return snapshot
+
+
+def _backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than a Retry-After hint."""
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def _wait_before_retry(delay: float) -> bool:
+    """
+    Sleep before a retry unless the running call is cancelled first.
+
+    Returns:
+        False if the call was cancelled or the delay would overrun its deadline
+    """
+    from utils.call_context import current_call
+
+    context = current_call()
+    if context is None:
+        time.sleep(delay)
+        return True
+    remaining = context.remaining()
+    if remaining is not None and delay >= remaining:
+        return False
+    return not context.cancel_event.wait(delay)
+
+
+def call_with_resilience(provider: str, fn: Callable, *args, **kwargs):
+    """
+    Call a provider function with retries and circuit breaking.
+
+    Args:
+        provider: Provider name used for the breaker and health stats
+        fn: The provider function to call
+        *args, **kwargs: Passed through to fn
+
+    Returns:
+        Whatever fn returns
+
+    Raises:
+        CircuitOpenError: If the provider's breaker is open
+        ProviderError: If the call fails and cannot (or can no longer) be retried
+    """
+    from utils.call_context import check_cancelled
+
+    breaker = get_breaker(provider)
+
+    for attempt in range(MAX_ATTEMPTS):
+        check_cancelled(provider)
+        if not breaker.allow():
+            _record(provider, rejected=1)
+            raise CircuitOpenError(
+                provider,
+                f"{provider} is temporarily unavailable (circuit open, retry in {breaker.retry_in():.0f}s)"
+            )
+
+        _record(provider, calls=1)
+        start = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            error = classify_error(provider, e)
+
+            # Errors from a nested provider call were already handled by its own wrapper;
+            # a cancelled call or a client-side queue timeout says nothing about provider health
+            if error.provider != provider or not error.provider_fault:
+                breaker.release()
+                raise error
+
+            _record(provider, failures=1, last_error=str(error))
+            if not error.retryable:
+                # Config and request errors say nothing about provider health:
+                # free the trial slot but leave the failure count alone
+                breaker.release()
+                raise error from e
+
+            breaker.record_failure()
+            retry_after = getattr(error, "retry_after", None)
+            if attempt + 1 >= MAX_ATTEMPTS or (retry_after is not None and retry_after > MAX_RETRY_AFTER_SECONDS):
+                raise error from e
+
+            if not _wait_before_retry(_backoff_delay(attempt, retry_after)):
+                # Cancelled while waiting, or out of time for another attempt
+                check_cancelled(provider)
+                raise error from e
+            _record(provider, retries=1)
+            continue
+
+        breaker.record_success()
+        _record(provider, successes=1, latency=time.time() - start)
+        return result
+
+
+def stream_with_resilience(provider: str, fn: Callable, *args, **kwargs):
+    """
+    Iterate a streaming provider function with retries and circuit breaking.
+
+    Failures before the first chunk are retried like call_with_resilience.
+    Once a chunk has been yielded the caller has already seen output, so
+    later failures are raised without retrying.
+
+    Args:
+        provider: Provider name used for the breaker and health stats
+        fn: Generator function producing response chunks
+        *args, **kwargs: Passed through to fn
+
+    Yields:
+        The chunks produced by fn
+    """
+    from utils.call_context import check_cancelled
+
+    breaker = get_breaker(provider)
+
+    for attempt in range(MAX_ATTEMPTS):
+        check_cancelled(provider)
+        if not breaker.allow():
+            _record(provider, rejected=1)
+            raise CircuitOpenError(
+                provider,
+                f"{provider} is temporarily unavailable (circuit open, retry in {breaker.retry_in():.0f}s)"
+            )
+
+        _record(provider, calls=1)
+        start = time.time()
+        started = False
+        try:
+            for chunk in fn(*args, **kwargs):
+                started = True
+                yield chunk
+        except GeneratorExit:
+            # The consumer stopped reading (cancelled); not a provider failure
+            breaker.release()
+            raise
+        except Exception as e:
+            error = classify_error(provider, e)
+
+            if error.provider != provider or not error.provider_fault:
+                breaker.release()
+                raise error
+
+            _record(provider, failures=1, last_error=str(error))
+            if not error.retryable:
+                breaker.release()
+                raise error from e
+
+            breaker.record_failure()
+            retry_after = getattr(error, "retry_after", None)
+            if started or attempt + 1 >= MAX_ATTEMPTS or (retry_after is not None and retry_after > MAX_RETRY_AFTER_SECONDS):
+                raise error from e
+
+            if not _wait_before_retry(_backoff_delay(attempt, retry_after)):
+                # Cancelled while waiting, or out of time for another attempt
+                check_cancelled(provider)
+                raise error from e
+            _record(provider, retries=1)
+            continue
+
+        breaker.record_success()
+        _record(provider, successes=1, latency=time.time() - start)
+        return
+
+
+def with_resilience(provider: str) -> Callable:
+    """
+    Decorator that routes a provider function through call_with_resilience.
+
+    Generator functions are routed through stream_with_resilience instead.
+
+    Args:
+        provider: Provider name
+
+    Returns:
+        The decorator
+    """
+    def decorator(fn: Callable) -> Callable:
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def stream_wrapper(*args, **kwargs):
+                yield from stream_with_resilience(provider, fn, *args, **kwargs)
+            return stream_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return call_with_resilience(provider, fn, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,369 @@
+"""
+Latency-aware model routing
+
+"Auto (<tier>)" model options name a capability tier instead of a model.
+Each tier lists equivalent model options; the router picks one per call
+from rolling statistics of real calls (time to first token, error rate
+and cost) and fails over to the next candidate when a call fails.
+
+Policy, in order:
+1. Skip models whose provider circuit breaker is open, and models whose
+   recent error rate exceeds ROUTING_MAX_ERROR_RATE.
+2. Among the rest, models meeting the SLO (ROUTING_SLO, e.g.
+   "p95 ttft < 1.5s") are preferred, cheapest first. Models with too
+   few recent samples of the SLO's metric count as meeting it, so they
+   get measured.
+3. If none meet the SLO, the fastest by the SLO's percentile goes first.
+A small share of calls (ROUTING_EXPLORE_RATE) goes to a random healthy
+candidate so statistics stay fresh for every model.
+
+Time to first token is only sampled from streamed calls; a call answered
+in one piece records its total latency alone. "Auto" turns are streamed
+(stream_routed_response) wherever the chosen models can stream.
+"""
+import os
+import re
+import json
+import time
+import random
+import threading
+from collections import deque
+from typing import Dict, Any, List, Optional, Tuple
+
+from utils.resilience import ProviderError, CallCancelledError, get_provider_health
+from utils.pricing import estimate_cost
+
+# Capability tiers and their equivalent model options, best first
+CAPABILITY_TIERS: Dict[str, List[str]] = {
+    "fast chat": [
+        "Gemini (gemini-1.5-flash)",
+        "OpenAI (gpt-4o-mini)",
+        "Anthropic (claude-3-5-haiku-20241022)",
+    ],
+    "smart chat": [
+        "Anthropic (claude-3-5-sonnet-20241022)",
+        "OpenAI (gpt-4o)",
+        "Gemini (gemini-1.5-pro)",
+    ],
+    # Only the Gemini path sends images to the model
+    "vision": [
+        "Gemini (gemini-1.5-pro)",
+        "Gemini (gemini-1.5-flash)",
+    ],
+    "web search": [
+        "Perplexity (pplx-70b-online)",
+    ],
+}
+if os.environ.get("ROUTING_TIERS"):
+    CAPABILITY_TIERS.update(json.loads(os.environ["ROUTING_TIERS"]))
+
+ROUTING_SLO = os.environ.get("ROUTING_SLO", "p95 ttft < 1.5s")
+ROUTING_WINDOW_SECONDS = float(os.environ.get("ROUTING_WINDOW_SECONDS", "600"))
+ROUTING_MIN_SAMPLES = int(os.environ.get("ROUTING_MIN_SAMPLES", "5"))
+ROUTING_MAX_ERROR_RATE = float(os.environ.get("ROUTING_MAX_ERROR_RATE", "0.25"))
+ROUTING_EXPLORE_RATE = float(os.environ.get("ROUTING_EXPLORE_RATE", "0.05"))
+
+# Most recent samples kept per model option
+MAX_SAMPLES = 500
+
+_samples: Dict[str, deque] = {}
+_last_decisions: Dict[str, Dict[str, Any]] = {}
+_lock = threading.Lock()
+
+
+def parse_slo(slo: str) -> Tuple[str, float, float]:
+    """
+    Parse an SLO such as "p95 ttft < 1.5s" or "p99 latency < 8s".
+
+    Args:
+        slo: The SLO text
+
+    Returns:
+        Tuple of (metric, percentile fraction, threshold seconds)
+
+    Raises:
+        ValueError: If the text is not understood
+    """
+    match = re.fullmatch(r"\s*p(\d{1,2})\s+(ttft|latency)\s*<\s*([\d.]+)\s*(ms|s)?\s*", slo.lower())
+    if not match:
+        raise ValueError(f"Unrecognized SLO: {slo!r} (expected e.g. \"p95 ttft < 1.5s\")")
+    threshold = float(match.group(3))
+    if match.group(4) == "ms":
+        threshold /= 1000.0
+    return match.group(2), int(match.group(1)) / 100.0, threshold
+
+
+def tier_options() -> List[str]:
+    """
+    Model options for every capability tier.
+
+    Returns:
+        Options such as "Auto (fast chat)"
+    """
+    return [f"Auto ({tier})" for tier in CAPABILITY_TIERS]
+
+
+def record_call(model_option: str, latency: float, ok: bool, ttft: Optional[float] = None, cost: Optional[float] = None) -> None:
+    """
+    Add one finished call to a model option's rolling statistics.
+
+    Args:
+        model_option: The model option that was called
+        latency: Total seconds the call took
+        ok: Whether the call succeeded
+        ttft: Seconds to the first token, for streamed calls only
+        cost: Estimated cost in USD
+    """
+    with _lock:
+        samples = _samples.setdefault(model_option, deque(maxlen=MAX_SAMPLES))
+        samples.append({
+            "at": time.time(),
+            "latency": latency,
+            "ttft": ttft,
+            "ok": ok,
+            "cost": cost,
+        })
+
+
+def record_model_call(model_option: str, model_name: str, message_history: List[Dict[str, Any]], response: Optional[str], latency: float, ok: bool, usage: Optional[List[Dict[str, Any]]] = None, ttft: Optional[float] = None) -> None:
+    """
+    Record a call made through get_model_response, costing it from reported or estimated usage.
+
+    Args:
+        model_option: The model option that was called
+        model_name: Model identifier for the price table
+        message_history: History that was sent
+        response: Response text (None on failure)
+        latency: Total seconds the call took
+        ok: Whether the call succeeded
+        usage: Usage records the provider reported during the call
+        ttft: Seconds to the first token, if streamed
+    """
+    from utils.context import get_context_tokens, estimate_tokens
+
+    cost = None
+    if ok:
+        if usage:
+            cost = sum(u["cost"] for u in usage)
+        else:
+            cost = estimate_cost(model_name, get_context_tokens(message_history), estimate_tokens(response or ""))
+    record_call(model_option, latency, ok, ttft=ttft, cost=cost)
+
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def get_model_stats(model_option: str, percentile: float = 0.95) -> Dict[str, Any]:
+    """
+    Rolling statistics for one model option over ROUTING_WINDOW_SECONDS.
+
+    Args:
+        model_option: The model option
+        percentile: Percentile to report for latency and TTFT
+
+    Returns:
+        Dict with samples, error_rate, ttft/latency percentiles (and the
+        number of successful calls each was measured from) and avg_cost
+    """
+    cutoff = time.time() - ROUTING_WINDOW_SECONDS
+    with _lock:
+        samples = [s for s in _samples.get(model_option, ()) if s["at"] >= cutoff]
+    ok = [s for s in samples if s["ok"]]
+    ttfts = [s["ttft"] for s in ok if s["ttft"] is not None]
+    costs = [s["cost"] for s in ok if s["cost"] is not None]
+    return {
+        "samples": len(samples),
+        "error_rate": (len(samples) - len(ok)) / len(samples) if samples else 0.0,
+        "ttft": _percentile(ttfts, percentile),
+        "ttft_samples": len(ttfts),
+        "latency": _percentile([s["latency"] for s in ok], percentile),
+        "latency_samples": len(ok),
+        "avg_cost": sum(costs) / len(costs) if costs else None,
+    }
+
+
+def rank_candidates(tier: str, slo: Optional[str] = None) -> List[str]:
+    """
+    Order a tier's model options by the routing policy.
+
+    Args:
+        tier: Capability tier name
+        slo: SLO text (defaults to ROUTING_SLO)
+
+    Returns:
+        Model options, the one to try first at the front
+
+    Raises:
+        ValueError: If the tier is unknown
+    """
+    from utils.models import parse_model_option
+
+    if tier not in CAPABILITY_TIERS:
+        raise ValueError(f"Unknown capability tier: {tier}")
+    metric, percentile, threshold = parse_slo(slo or ROUTING_SLO)
+    health = get_provider_health()
+
+    scored = []
+    for order, option in enumerate(CAPABILITY_TIERS[tier]):
+        provider, _ = parse_model_option(option)
+        stats = get_model_stats(option, percentile)
+        breaker_open = health.get(provider, {}).get("state") == "open"
+        measured = stats["samples"] >= ROUTING_MIN_SAMPLES
+        healthy = not breaker_open and not (measured and stats["error_rate"] > ROUTING_MAX_ERROR_RATE)
+        observed = stats[metric]
+        slo_measured = stats[f"{metric}_samples"] >= ROUTING_MIN_SAMPLES
+        meets_slo = not slo_measured or observed is None or observed < threshold
+        scored.append({
+            "option": option,
+            "order": order,
+            "healthy": healthy,
+            "meets_slo": meets_slo,
+            "observed": observed if observed is not None else 0.0,
+            "cost": stats["avg_cost"] if stats["avg_cost"] is not None else float("inf"),
+            "error_rate": stats["error_rate"],
+        })
+
+    def sort_key(entry):
+        if entry["healthy"] and entry["meets_slo"]:
+            # Cheapest among those meeting the SLO; tier order breaks ties
+            return (0, entry["cost"] if entry["cost"] != float("inf") else 0.0, entry["order"])
+        if entry["healthy"]:
+            return (1, entry["observed"], entry["order"])
+        # Unhealthy models stay as a last resort, least failing first
+        return (2, entry["error_rate"], entry["order"])
+
+    ranked = sorted(scored, key=sort_key)
+    healthy = [entry for entry in ranked if entry["healthy"]]
+    if len(healthy) > 1 and random.random() < ROUTING_EXPLORE_RATE:
+        explore = random.choice(healthy[1:])
+        ranked.remove(explore)
+        ranked.insert(0, explore)
+    return [entry["option"] for entry in ranked]
+
+
+def get_routed_response(tier: str, prompt: str, message_history: List[Dict[str, Any]], image_data=None, audio_data=None, temperature=0.7) -> str:
+    """
+    Answer with the best model of a capability tier, failing over on errors.
+
+    Args:
+        tier: Capability tier name
+        prompt: The user's input prompt
+        message_history: Message history to send
+        image_data: Optional base64 encoded image data
+        audio_data: Optional base64 encoded audio data
+        temperature: Temperature for response generation
+
+    Returns:
+        The AI response text
+
+    Raises:
+        ProviderError: If every candidate failed (the last error)
+    """
+    from utils.models import get_model_response
+
+    candidates = rank_candidates(tier)
+    last_error = None
+    for attempt, option in enumerate(candidates):
+        try:
+            response = get_model_response(
+                option,
+                prompt,
+                message_history,
+                image_data=image_data,
+                audio_data=audio_data,
+                temperature=temperature
+            )
+        except CallCancelledError:
+            raise
+        except ProviderError as e:
+            # Statistics were updated by get_model_response; try the next candidate
+            last_error = e
+            continue
+
+        _record_decision(tier, option, attempt, candidates)
+        return response
+
+    _record_decision(tier, None, len(candidates), candidates)
+    raise last_error or ProviderError("auto", f"No models configured for tier {tier}")
+
+
+def stream_routed_response(tier: str, prompt: str, message_history: List[Dict[str, Any]], temperature=0.7, cancel_event=None):
+    """
+    Stream the answer of the best model of a capability tier, failing over on errors.
+
+    A candidate that fails before its first chunk is replaced by the next
+    one; once text has been shown, a failure is raised as is.
+
+    Args:
+        tier: Capability tier name
+        prompt: The user's input prompt
+        message_history: Message history to send
+        temperature: Temperature for response generation
+        cancel_event: Optional threading.Event that stops the stream when set
+
+    Yields:
+        Response text chunks
+
+    Raises:
+        ProviderError: If every candidate failed (the last error)
+    """
+    from utils.models import stream_model_response
+
+    candidates = rank_candidates(tier)
+    last_error = None
+    for attempt, option in enumerate(candidates):
+        started = False
+        try:
+            for chunk in stream_model_response(option, prompt, message_history, temperature=temperature, cancel_event=cancel_event):
+                if not started:
+                    started = True
+                    _record_decision(tier, option, attempt, candidates)
+                yield chunk
+        except CallCancelledError:
+            raise
+        except ProviderError as e:
+            if started:
+                raise
+            # Statistics were updated by stream_model_response; try the next candidate
+            last_error = e
+            continue
+        if not started:
+            _record_decision(tier, option, attempt, candidates)
+        return
+
+    _record_decision(tier, None, len(candidates), candidates)
+    raise last_error or ProviderError("auto", f"No models configured for tier {tier}")
+
+
+def _record_decision(tier: str, option: Optional[str], failovers: int, candidates: List[str]) -> None:
+    """Remember where a tier's call went, and note it on the running call."""
+    from utils.call_context import current_call
+
+    with _lock:
+        _last_decisions[tier] = {"option": option, "at": time.time(), "failovers": failovers, "candidates": candidates}
+    context = current_call()
+    if context is not None and option is not None:
+        context.route = option
+
+
+def get_routing_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Routing decisions and per-model statistics for every tier.
+
+    Returns:
+        Dict of tier to {"last": last decision, "models": {option: stats}}
+    """
+    _, percentile, _ = parse_slo(ROUTING_SLO)
+    with _lock:
+        decisions = dict(_last_decisions)
+    return {
+        tier: {
+            "last": decisions.get(tier),
+            "models": {option: get_model_stats(option, percentile) for option in options},
+        }
+        for tier, options in CAPABILITY_TIERS.items()
+    }
@@ -0,0 +1,214 @@
+"""
+Single-flight deduplication of identical in-flight provider calls
+
+When the same provider call is made again in the same conversation by the
+same user while the first one is still running (a double-clicked Send, a
+rerun that repeats the request), only the first one goes upstream. The
+others wait for it and receive the same result or error. Calls from
+different users or conversations are never merged, so every call is
+metered and budget-checked in its own scope. A waiting caller still stops
+at its own deadline or cancellation. Streaming calls are pumped by a
+background thread into a shared buffer; each caller reads the stream from
+the first chunk at its own pace, and the upstream stream is cancelled once
+every reader has left.
+
+Nothing is kept once a call finishes, so this is not a cache: a request
+made after the previous identical one completed goes upstream again.
+Set SINGLE_FLIGHT_ENABLED=0 to turn it off.
+"""
+import os
+import inspect
+import functools
+import threading
+import contextvars
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, Callable, List, Optional
+
+from utils.cassettes import request_key
+from utils.resilience import CallCancelledError
+from utils.call_context import current_call, check_cancelled
+
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") != "0"
+
+# How often a waiting caller checks its own cancellation and deadline
+WAIT_POLL_SECONDS = 0.25
+
+_in_flight: Dict[str, Any] = {}
+_lock = threading.Lock()
+_stats = {"leaders": 0, "shared": 0}
+
+
+def get_single_flight_stats() -> Dict[str, int]:
+    """
+    Counts of upstream calls made and duplicate calls that shared them.
+
+    Returns:
+        Dict with "leaders", "shared" and "in_flight"
+    """
+    with _lock:
+        return dict(_stats, in_flight=len(_in_flight))
+
+
+def _flight_key(name: str, fn: Callable, args: tuple, kwargs: Dict[str, Any]) -> str:
+    """Request key scoped to the calling user and conversation."""
+    context = current_call()
+    scope = (context.user, context.conversation_id) if context else (None, None)
+    return f"{request_key(name, fn, args, kwargs)}:{scope[0]}:{scope[1]}"
+
+
+def _wait_for(future: Future, provider: str) -> Any:
+    """Wait for the leader's result, giving up at the waiting caller's own cancellation or deadline."""
+    while True:
+        check_cancelled(provider)
+        try:
+            return future.result(timeout=WAIT_POLL_SECONDS)
+        except FutureTimeoutError:
+            continue
+
+
+class _SharedStream:
+    """One upstream stream, buffered so several readers can follow it."""
+    def __init__(self, provider: str, key: str, iterator):
+        self.provider = provider
+        self.key = key
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.readers = 0
+        self.cancelled = False
+        self._iterator = iterator
+        self._cond = threading.Condition()
+
+    def start(self) -> None:
+        # Run upstream in the leader's context, so usage is reported to its call scope
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._pump,), name="single-flight", daemon=True).start()
+
+    def _pump(self) -> None:
+        try:
+            for chunk in self._iterator:
+                with self._cond:
+                    if self.cancelled:
+                        # A reader that joined as the last one left must not see a truncated answer as complete
+                        if self.error is None:
+                            self.error = CallCancelledError(self.provider, "Shared stream cancelled")
+                        break
+                    self.chunks.append(chunk)
+                    self._cond.notify_all()
+        except BaseException as e:
+            with self._cond:
+                self.error = e
+        finally:
+            close = getattr(self._iterator, "close", None)
+            if close is not None:
+                close()
+            with _lock:
+                if _in_flight.get(self.key) is self:
+                    del _in_flight[self.key]
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    def read(self):
+        """Yield every chunk from the start, then re-raise the upstream error if there was one."""
+        with self._cond:
+            self.readers += 1
+        index = 0
+        try:
+            while True:
+                with self._cond:
+                    while index >= len(self.chunks) and not self.done and not self.cancelled:
+                        self._cond.wait(timeout=WAIT_POLL_SECONDS)
+                        check_cancelled(self.provider)
+                    if index < len(self.chunks):
+                        chunk = self.chunks[index]
+                        index += 1
+                    elif self.error is not None:
+                        raise self.error
+                    elif self.cancelled:
+                        raise CallCancelledError(self.provider, "Shared stream cancelled")
+                    else:
+                        return
+                yield chunk
+        finally:
+            with self._cond:
+                self.readers -= 1
+                # Last reader gone before the end: stop paying for the upstream stream
+                if self.readers == 0 and not self.done:
+                    self.cancelled = True
+                    with _lock:
+                        if _in_flight.get(self.key) is self:
+                            del _in_flight[self.key]
+
+
+def single_flight(provider: str) -> Callable:
+    """
+    Decorator that shares one upstream call among identical concurrent calls.
+
+    Place it outermost, above cassette, with_resilience and rate_limited,
+    so a duplicate is never recorded or replayed on its own and takes no
+    retries or rate limit capacity.
+
+    Args:
+        provider: Provider name (keeps keys distinct per provider and names errors)
+
+    Returns:
+        The decorator
+    """
+    def decorator(fn: Callable) -> Callable:
+        name = f"{provider}:{fn.__module__}.{fn.__name__}"
+
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def stream_wrapper(*args, **kwargs):
+                if not SINGLE_FLIGHT_ENABLED:
+                    yield from fn(*args, **kwargs)
+                    return
+                key = _flight_key(name, fn, args, kwargs)
+                with _lock:
+                    shared = _in_flight.get(key)
+                    if shared is None:
+                        shared = _SharedStream(provider, key, fn(*args, **kwargs))
+                        _in_flight[key] = shared
+                        _stats["leaders"] += 1
+                        leader = True
+                    else:
+                        _stats["shared"] += 1
+                        leader = False
+                if leader:
+                    shared.start()
+                yield from shared.read()
+            return stream_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not SINGLE_FLIGHT_ENABLED:
+                return fn(*args, **kwargs)
+            key = _flight_key(name, fn, args, kwargs)
+            with _lock:
+                future = _in_flight.get(key)
+                leader = future is None
+                if leader:
+                    future = Future()
+                    _in_flight[key] = future
+                    _stats["leaders"] += 1
+                else:
+                    _stats["shared"] += 1
+
+            if not leader:
+                return _wait_for(future, provider)
+
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            else:
+                future.set_result(result)
+                return result
+            finally:
+                with _lock:
+                    if _in_flight.get(key) is future:
+                        del _in_flight[key]
+        return wrapper
+    return decorator
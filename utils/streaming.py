@@ -0,0 +1,163 @@
+"""
+Streaming response helpers
+
+Wraps provider chunk iterators so they can be cancelled between chunks and
+measured: time to first chunk (TTFC) and the gaps between chunks (cadence).
+Per-provider aggregates are kept for the UI.
+"""
+import time
+import threading
+from typing import Dict, Any, Iterable, Iterator, Optional, List
+
+
+class StreamMetrics:
+    """Timing of one streamed response."""
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.started_at = time.time()
+        self.first_chunk_at = None
+        self.last_chunk_at = None
+        self.chunk_gaps: List[float] = []
+        self.chunks = 0
+        self.characters = 0
+        self.cancelled = False
+        self.finished_at = None
+
+    def on_chunk(self, text: str) -> None:
+        """Record the arrival of one chunk."""
+        now = time.time()
+        if self.first_chunk_at is None:
+            self.first_chunk_at = now
+        else:
+            self.chunk_gaps.append(now - self.last_chunk_at)
+        self.last_chunk_at = now
+        self.chunks += 1
+        self.characters += len(text)
+
+    def finish(self, cancelled: bool = False) -> None:
+        """Mark the stream as complete (or cancelled)."""
+        self.finished_at = time.time()
+        self.cancelled = cancelled
+
+    @property
+    def time_to_first_chunk(self) -> Optional[float]:
+        if self.first_chunk_at is None:
+            return None
+        return self.first_chunk_at - self.started_at
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Summarize the stream's timing.
+
+        Returns:
+            Dict with ttfc, chunk count, mean/p95/max gap between chunks and total time
+        """
+        gaps = sorted(self.chunk_gaps)
+        return {
+            "provider": self.provider,
+            "model": self.model,
+            "ttfc": self.time_to_first_chunk,
+            "chunks": self.chunks,
+            "characters": self.characters,
+            "mean_gap": sum(gaps) / len(gaps) if gaps else None,
+            "p95_gap": gaps[min(len(gaps) - 1, int(len(gaps) * 0.95))] if gaps else None,
+            "max_gap": gaps[-1] if gaps else None,
+            "total": (self.finished_at or time.time()) - self.started_at,
+            "cancelled": self.cancelled,
+        }
+
+
+_stream_stats: Dict[str, Dict[str, Any]] = {}
+_stats_lock = threading.Lock()
+
+
+def _record_stream(metrics: StreamMetrics) -> None:
+    """Fold one finished stream into its provider's rolling stats."""
+    summary = metrics.as_dict()
+    with _stats_lock:
+        stats = _stream_stats.setdefault(metrics.provider, {
+            "streams": 0,
+            "cancelled": 0,
+            "avg_ttfc": None,
+            "avg_gap": None,
+            "last": None,
+        })
+        stats["streams"] += 1
+        if summary["cancelled"]:
+            stats["cancelled"] += 1
+        # Exponentially weighted averages, as in the provider health stats
+        for key, value in (("avg_ttfc", summary["ttfc"]), ("avg_gap", summary["mean_gap"])):
+            if value is not None:
+                stats[key] = value if stats[key] is None else 0.8 * stats[key] + 0.2 * value
+        stats["last"] = summary
+
+
+def _report_partial_usage(metrics: StreamMetrics, input_tokens: int) -> None:
+    """Report estimated usage for the part of a stream that was read."""
+    from utils.call_context import report_usage
+    from utils.context import CHARS_PER_TOKEN
+
+    report_usage(
+        metrics.provider,
+        metrics.model,
+        input_tokens=input_tokens,
+        output_tokens=(metrics.characters + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN,
+        latency=metrics.finished_at - metrics.started_at
+    )
+
+
+def get_stream_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Snapshot of streaming statistics for every provider streamed so far.
+
+    Returns:
+        Dict of provider name to stats (averages plus the last stream's summary)
+    """
+    with _stats_lock:
+        return {provider: dict(stats) for provider, stats in _stream_stats.items()}
+
+
+def metered_stream(provider: str, model: str, chunks: Iterable[str], cancel_event: Optional[threading.Event] = None, input_tokens: Optional[int] = None) -> Iterator[str]:
+    """
+    Pass text chunks through while recording timing, stopping early on cancel.
+
+    The underlying iterator is closed when the consumer stops reading
+    (e.g. the Streamlit script is interrupted) or cancel_event is set, so
+    the upstream connection is released instead of read to the end.
+    Providers send usage with their last chunk, so a stream the consumer
+    leaves early is reported from estimates when input_tokens is given.
+
+    Args:
+        provider: Provider name for the stats
+        model: Model identifier
+        chunks: Iterator of text chunks from the provider
+        cancel_event: Optional event that stops the stream when set
+        input_tokens: Estimated prompt tokens of the request
+
+    Yields:
+        The text chunks
+    """
+    metrics = StreamMetrics(provider, model)
+    cancelled = False
+    abandoned = False
+    try:
+        for text in chunks:
+            if cancel_event is not None and cancel_event.is_set():
+                cancelled = True
+                break
+            if not text:
+                continue
+            metrics.on_chunk(text)
+            yield text
+    except GeneratorExit:
+        cancelled = abandoned = True
+        raise
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+        metrics.finish(cancelled=cancelled)
+        _record_stream(metrics)
+        if abandoned and input_tokens is not None and metrics.chunks:
+            _report_partial_usage(metrics, input_tokens)
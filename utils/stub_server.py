@@ -0,0 +1,695 @@
+"""
+Local stand-in server for offline testing
+
+Emulates the model provider HTTP APIs used by the app, including streaming:
+OpenAI and Perplexity chat completions, Anthropic messages, Gemini and
+Vertex AI generateContent / streamGenerateContent and cached contents.
+Also emulates the Cloud Storage JSON API endpoints used to upload media
+for Vertex AI, keeping objects in memory; model calls referencing a gs://
+object that is not there are refused with 404, as Vertex AI does.
+
+Model responses echo the last user message, or cycle through scripted
+responses. Latency (time to first byte), token rate and injected failures
+(429, 5xx and timeouts) are configurable from the command line, from
+MOCK_* environment variables, or at runtime with POST /__mock/config.
+GET /__mock/stats returns request counters.
+
+Vertex AI regions can be given extra latency (region_latency_ms, e.g.
+{"europe-west4": 40}) or taken down (down_regions, answered with 503),
+which applies to model calls and to the location lookups used to probe
+regions.
+
+Run it with:
+    python -m utils.stub_server --port 8765
+and point the app at it with:
+    AI_MOCK_SERVER_URL=http://127.0.0.1:8765
+For media uploads:
+    VERTEX_MEDIA_BUCKET=local
+"""
+import re
+import os
+import json
+import math
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+from typing import Dict, Any, Tuple, List, Optional, Iterable
+
+# Matches generateContent / streamGenerateContent for both the Gemini API
+# (/v1beta/models/...) and Vertex AI (/v1beta1/projects/.../publishers/google/models/...)
+GEMINI_ROUTE = re.compile(
+    r"/v1(?:beta1?)?/(?:projects/[^/]+/locations/([^/]+)/publishers/google/)?models/([^/:]+):(generateContent|streamGenerateContent)"
+)
+CACHED_CONTENTS_ROUTE = re.compile(r"/v1(?:beta1?)?/(?:projects/[^/]+/locations/([^/]+)/)?cachedContents")
+LOCATION_ROUTE = re.compile(r"/v1(?:beta1?)?/projects/([^/]+)/locations/([^/]+)")
+
+
+class MockConfig:
+    """
+    Behaviour of the mock model endpoints.
+
+    Latency is the delay before the first byte of a response; it is drawn
+    from a fixed, uniform (0 to 2x mean) or lognormal distribution. Tokens
+    are then paced at tokens_per_second. Error rates are probabilities per
+    request. With no scripted responses, the last user message is echoed.
+    Vertex AI regions add region_latency_ms to the delay, and regions in
+    down_regions answer every request with 503.
+    """
+    FIELDS = {
+        "latency": str,
+        "latency_ms": float,
+        "latency_sigma": float,
+        "tokens_per_second": float,
+        "error_429_rate": float,
+        "error_5xx_rate": float,
+        "timeout_rate": float,
+        "timeout_seconds": float,
+        "responses": list,
+        "seed": int,
+        "region_latency_ms": dict,
+        "down_regions": list,
+    }
+
+    def __init__(self, latency: str = "lognormal", latency_ms: float = 300.0, latency_sigma: float = 0.5,
+                 tokens_per_second: float = 80.0, error_429_rate: float = 0.0, error_5xx_rate: float = 0.0,
+                 timeout_rate: float = 0.0, timeout_seconds: float = 120.0, responses: Optional[List[str]] = None,
+                 seed: Optional[int] = None, region_latency_ms: Optional[Dict[str, float]] = None,
+                 down_regions: Optional[List[str]] = None):
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.error_429_rate = error_429_rate
+        self.error_5xx_rate = error_5xx_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.responses = list(responses or [])
+        self.seed = seed
+        self.region_latency_ms = dict(region_latency_ms or {})
+        self.down_regions = list(down_regions or [])
+
+    @classmethod
+    def from_env(cls) -> "MockConfig":
+        """
+        Build a config from MOCK_* environment variables.
+
+        Returns:
+            The MockConfig (defaults for unset variables)
+        """
+        config = cls()
+        values = {}
+        for field in cls.FIELDS:
+            raw = os.environ.get(f"MOCK_{field.upper()}")
+            if raw is not None and field != "responses":
+                values[field] = raw
+        responses_file = os.environ.get("MOCK_RESPONSES_FILE")
+        if responses_file:
+            values["responses"] = load_responses(responses_file)
+        config.update(values)
+        return config
+
+    def update(self, values: Dict[str, Any]) -> None:
+        """
+        Change settings in place.
+
+        Args:
+            values: Field names to new values; unknown fields raise ValueError
+        """
+        for field, value in values.items():
+            if field not in self.FIELDS:
+                raise ValueError(f"Unknown mock setting: {field}")
+            if value is None and field != "seed":
+                continue
+            if isinstance(value, str) and self.FIELDS[field] in (list, dict):
+                # From an environment variable or the command line
+                value = json.loads(value)
+            if value is not None and field != "responses":
+                value = self.FIELDS[field](value)
+            setattr(self, field, value)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def first_byte_delay(self, rng: random.Random) -> float:
+        """Draw a time-to-first-byte in seconds from the configured distribution."""
+        mean = self.latency_ms / 1000.0
+        if mean <= 0:
+            return 0.0
+        if self.latency == "fixed":
+            return mean
+        if self.latency == "uniform":
+            return rng.uniform(0, 2 * mean)
+        # Lognormal with the configured median, the usual shape of API latency
+        return rng.lognormvariate(math.log(mean), self.latency_sigma)
+
+
+def load_responses(path: str) -> List[str]:
+    """
+    Load scripted responses from a file.
+
+    Args:
+        path: A JSON list of strings, or JSONL with one string (or {"response": ...}) per line
+
+    Returns:
+        The responses in order
+    """
+    with open(path, "r") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return [str(item) for item in json.loads(text)]
+    responses = []
+    for line in text.splitlines():
+        if line.strip():
+            item = json.loads(line)
+            responses.append(item["response"] if isinstance(item, dict) else str(item))
+    return responses
+
+
+def _estimate_tokens(text: str) -> int:
+    # Same rough 4 characters per token rule as utils.context
+    return max(1, len(text) // 4) if text else 0
+
+
+def _split_tokens(text: str) -> List[str]:
+    """Split text into word-sized pieces that join back to the original."""
+    return re.findall(r"\S+\s*|\s+", text) or [""]
+
+
+def _text_of(content: Any) -> str:
+    """Plain text of an OpenAI/Anthropic message content (string or content blocks)."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(block.get("text", "") for block in content if isinstance(block, dict))
+    return ""
+
+
+class StubState:
+    """In-memory state shared by all request handlers of one server."""
+    def __init__(self, config: Optional[MockConfig] = None):
+        self.objects: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.upload_count = 0
+        self.lock = threading.Lock()
+        self.config = config or MockConfig()
+        self.rng = random.Random(self.config.seed)
+        self.request_counts: Dict[str, int] = {}
+        self.fault_counts: Dict[str, int] = {}
+        # Model requests per API key the client sent
+        self.key_counts: Dict[str, int] = {}
+        self.response_index = 0
+
+    def count(self, route: str, api_key: Optional[str] = None) -> None:
+        with self.lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+            if api_key:
+                self.key_counts[api_key] = self.key_counts.get(api_key, 0) + 1
+
+    def roll_fault(self) -> Optional[str]:
+        """Decide whether this request fails: "429", "5xx", "timeout" or None."""
+        with self.lock:
+            roll = self.rng.random()
+            for fault, rate in (("429", self.config.error_429_rate),
+                                ("5xx", self.config.error_5xx_rate),
+                                ("timeout", self.config.timeout_rate)):
+                if roll < rate:
+                    self.fault_counts[fault] = self.fault_counts.get(fault, 0) + 1
+                    return fault
+                roll -= rate
+            return None
+
+    def first_byte_delay(self) -> float:
+        with self.lock:
+            return self.config.first_byte_delay(self.rng)
+
+    def region_delay(self, region: Optional[str]) -> float:
+        """Extra latency in seconds for a Vertex AI region."""
+        with self.lock:
+            return float(self.config.region_latency_ms.get(region, 0.0)) / 1000.0 if region else 0.0
+
+    def region_down(self, region: Optional[str]) -> bool:
+        """Whether a Vertex AI region is configured to be down."""
+        with self.lock:
+            return bool(region) and region in self.config.down_regions
+
+    def next_response(self, user_text: str) -> str:
+        """The scripted response for this request, or an echo of the user's text."""
+        with self.lock:
+            if self.config.responses:
+                response = self.config.responses[self.response_index % len(self.config.responses)]
+                self.response_index += 1
+                return response
+        return f"Echo: {user_text}"
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "requests": dict(self.request_counts),
+                "faults": dict(self.fault_counts),
+                "uploads": self.upload_count,
+                "objects": len(self.objects),
+            }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Request handler; routes are matched by regular expression in do_* methods."""
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        # Keep test and benchmark output quiet
+        pass
+
+    def handle(self):
+        # Clients hanging up mid-stream (cancelled generations) are expected
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _read_json(self) -> Dict[str, Any]:
+        body = self._read_body()
+        return json.loads(body) if body else {}
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        match = re.fullmatch(r"/upload/storage/v1/b/([^/]+)/o", parsed.path)
+        if match:
+            return self._upload_object(match.group(1), parse_qs(parsed.query))
+        if re.fullmatch(r"(?:/v1)?/chat/completions", parsed.path):
+            return self._chat_completions(self._read_json())
+        if parsed.path == "/v1/messages":
+            return self._anthropic_messages(self._read_json())
+        match = GEMINI_ROUTE.fullmatch(parsed.path)
+        if match:
+            stream = match.group(3) == "streamGenerateContent"
+            sse = parse_qs(parsed.query).get("alt") == ["sse"]
+            return self._generate_content(match.group(2), self._read_json(), stream, sse, region=match.group(1))
+        match = CACHED_CONTENTS_ROUTE.fullmatch(parsed.path)
+        if match:
+            return self._create_cached_content(parsed.path, self._read_json())
+        if parsed.path == "/__mock/config":
+            try:
+                with self.state.lock:
+                    self.state.config.update(self._read_json())
+                    self.state.rng = random.Random(self.state.config.seed)
+                    self.state.response_index = 0
+            except (ValueError, TypeError) as e:
+                return self._send_json(400, {"error": {"code": 400, "message": str(e)}})
+            return self._send_json(200, self.state.config.as_dict())
+        self._send_json(404, {"error": {"code": 404, "message": f"No route for {parsed.path}"}})
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == "/__mock/config":
+            return self._send_json(200, self.state.config.as_dict())
+        if parsed.path == "/__mock/stats":
+            return self._send_json(200, self.state.stats())
+        match = LOCATION_ROUTE.fullmatch(parsed.path)
+        if match:
+            return self._get_location(match.group(1), match.group(2))
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)/o/(.+)", parsed.path)
+        if match:
+            key = (match.group(1), unquote(match.group(2)))
+            with self.state.lock:
+                stored = self.state.objects.get(key)
+            if stored is None:
+                return self._send_json(404, {"error": {"code": 404, "message": "No such object"}})
+            return self._send_json(200, stored["metadata"])
+        self._send_json(404, {"error": {"code": 404, "message": f"No route for {parsed.path}"}})
+
+    def do_DELETE(self):
+        parsed = urlparse(self.path)
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)/o/(.+)", parsed.path)
+        if match:
+            with self.state.lock:
+                self.state.objects.pop((match.group(1), unquote(match.group(2))), None)
+            self.send_response(204)
+            self.end_headers()
+            return
+        self._send_json(404, {"error": {"code": 404, "message": f"No route for {parsed.path}"}})
+
+    def _upload_object(self, bucket: str, query: Dict[str, list]) -> None:
+        name = (query.get("name") or [None])[0]
+        if not name:
+            return self._send_json(400, {"error": {"code": 400, "message": "Missing object name"}})
+        data = self._read_body()
+        metadata = {
+            "kind": "storage#object",
+            "bucket": bucket,
+            "name": name,
+            "size": str(len(data)),
+            "contentType": self.headers.get("Content-Type", "application/octet-stream"),
+            "md5Hash": hashlib.md5(data).hexdigest(),
+            "timeCreated": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        }
+        with self.state.lock:
+            self.state.objects[(bucket, name)] = {"data": data, "metadata": metadata}
+            self.state.upload_count += 1
+        self._send_json(200, metadata)
+
+
+    # --- Model endpoints -------------------------------------------------
+
+    def _api_key(self) -> Optional[str]:
+        """The API key the client authenticated with, in any provider's style."""
+        authorization = self.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            return authorization[len("Bearer "):]
+        query_key = parse_qs(urlparse(self.path).query).get("key")
+        return self.headers.get("x-goog-api-key") or self.headers.get("x-api-key") or (query_key[0] if query_key else None)
+
+    def _begin_model_response(self, route: str, error_body, region: Optional[str] = None) -> bool:
+        """
+        Count the request, inject a configured fault and wait out the first-byte latency.
+
+        Args:
+            route: Route name for the stats
+            error_body: Callable (status, message) returning the provider's error payload
+            region: Vertex AI region the request was sent to, if any
+
+        Returns:
+            True if the request should be answered normally
+        """
+        self.state.count(route, self._api_key())
+        fault = "region_down" if self.state.region_down(region) else self.state.roll_fault()
+        if fault == "timeout":
+            # Hold the connection open, then drop it without answering
+            time.sleep(self.state.config.timeout_seconds)
+            self.close_connection = True
+            return False
+        if fault == "429":
+            body = json.dumps(error_body(429, "Rate limit exceeded (injected by stub server)")).encode("utf-8")
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+        elif fault == "5xx":
+            body = json.dumps(error_body(503, "Service unavailable (injected by stub server)")).encode("utf-8")
+            self.send_response(503)
+        elif fault == "region_down":
+            body = json.dumps(error_body(503, f"Region {region} unavailable (injected by stub server)")).encode("utf-8")
+            self.send_response(503)
+        if fault:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return False
+        time.sleep(self.state.first_byte_delay() + self.state.region_delay(region))
+        return True
+
+    def _paced_tokens(self, text: str) -> Iterable[str]:
+        """Yield the response text piece by piece at the configured token rate."""
+        rate = self.state.config.tokens_per_second
+        for piece in _split_tokens(text):
+            if rate > 0:
+                time.sleep(max(1, _estimate_tokens(piece)) / rate)
+            yield piece
+
+    def _start_sse(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+    def _send_event(self, payload: Any, event: Optional[str] = None) -> None:
+        data = payload if isinstance(payload, str) else json.dumps(payload)
+        prefix = f"event: {event}\n" if event else ""
+        self.wfile.write(f"{prefix}data: {data}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def _chat_completions(self, body: Dict[str, Any]) -> None:
+        """OpenAI-compatible chat completions (also used by Perplexity)."""
+        def error_body(status, message):
+            kind = "rate_limit_exceeded" if status == 429 else "server_error"
+            return {"error": {"message": message, "type": kind, "code": kind}}
+
+        if not self._begin_model_response("chat_completions", error_body):
+            return
+
+        messages = body.get("messages") or []
+        user_text = next((_text_of(m.get("content")) for m in reversed(messages) if m.get("role") == "user"), "")
+        prompt_tokens = sum(_estimate_tokens(_text_of(m.get("content"))) for m in messages)
+        text = self.state.next_response(user_text)
+        completion_tokens = _estimate_tokens(text)
+        model = body.get("model", "mock")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+
+        if not body.get("stream"):
+            text = "".join(self._paced_tokens(text))
+            return self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+
+        self._start_sse()
+        self._send_event(chunk({"role": "assistant", "content": ""}))
+        for piece in self._paced_tokens(text):
+            self._send_event(chunk({"content": piece}))
+        self._send_event(chunk({}, "stop"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._send_event({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                              "model": model, "choices": [], "usage": usage})
+        self._send_event("[DONE]")
+
+    def _anthropic_messages(self, body: Dict[str, Any]) -> None:
+        """Anthropic messages API."""
+        def error_body(status, message):
+            kind = "rate_limit_error" if status == 429 else "overloaded_error"
+            return {"type": "error", "error": {"type": kind, "message": message}}
+
+        if not self._begin_model_response("messages", error_body):
+            return
+
+        messages = body.get("messages") or []
+        user_text = next((_text_of(m.get("content")) for m in reversed(messages) if m.get("role") == "user"), "")
+        input_tokens = _estimate_tokens(_text_of(body.get("system"))) + sum(_estimate_tokens(_text_of(m.get("content"))) for m in messages)
+        text = self.state.next_response(user_text)
+        model = body.get("model", "mock")
+        message = {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": model,
+            "content": [],
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": 0,
+                      "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0},
+        }
+
+        if not body.get("stream"):
+            text = "".join(self._paced_tokens(text))
+            message["content"] = [{"type": "text", "text": text}]
+            message["stop_reason"] = "end_turn"
+            message["usage"]["output_tokens"] = _estimate_tokens(text)
+            return self._send_json(200, message)
+
+        self._start_sse()
+        self._send_event({"type": "message_start", "message": message}, "message_start")
+        self._send_event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+        for piece in self._paced_tokens(text):
+            self._send_event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}}, "content_block_delta")
+        self._send_event({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        self._send_event({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                          "usage": {"output_tokens": _estimate_tokens(text)}}, "message_delta")
+        self._send_event({"type": "message_stop"}, "message_stop")
+
+    def _generate_content(self, model: str, body: Dict[str, Any], stream: bool, sse: bool, region: Optional[str] = None) -> None:
+        """Gemini API and Vertex AI generateContent / streamGenerateContent."""
+        def error_body(status, message):
+            return {"error": {"code": status, "message": message,
+                              "status": "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE"}}
+
+        if not self._begin_model_response("generate_content", error_body, region=region):
+            return
+
+        contents = body.get("contents") or []
+        # Like Vertex AI, refuse references to Cloud Storage objects that do not exist
+        for content in contents:
+            for part in content.get("parts", []):
+                file_data = part.get("fileData") or part.get("file_data") or {}
+                uri = file_data.get("fileUri") or file_data.get("file_uri") or ""
+                if uri.startswith("gs://"):
+                    bucket, _, name = uri[len("gs://"):].partition("/")
+                    with self.state.lock:
+                        missing = (bucket, name) not in self.state.objects
+                    if missing:
+                        return self._send_json(404, {"error": {"code": 404, "message": f"File {uri} not found.", "status": "NOT_FOUND"}})
+        texts = [
+            " ".join(part.get("text", "") for part in content.get("parts", []))
+            for content in contents
+        ]
+        user_text = next((t for c, t in zip(reversed(contents), reversed(texts)) if c.get("role", "user") == "user"), "")
+        prompt_tokens = sum(_estimate_tokens(t) for t in texts)
+        cached_tokens = 0
+        if body.get("cachedContent"):
+            with self.state.lock:
+                cached_tokens = self.state.objects.get(("cachedContents", body["cachedContent"]), {}).get("tokens", 0)
+        text = self.state.next_response(user_text)
+
+        def response(piece_text, final):
+            payload = {
+                "candidates": [{"content": {"role": "model", "parts": [{"text": piece_text}]}, "index": 0}],
+                "modelVersion": model,
+            }
+            if final:
+                payload["candidates"][0]["finishReason"] = "STOP"
+                output_tokens = _estimate_tokens(text)
+                payload["usageMetadata"] = {
+                    "promptTokenCount": prompt_tokens + cached_tokens,
+                    "candidatesTokenCount": output_tokens,
+                    "totalTokenCount": prompt_tokens + cached_tokens + output_tokens,
+                    "cachedContentTokenCount": cached_tokens,
+                }
+            return payload
+
+        if not stream:
+            return self._send_json(200, response("".join(self._paced_tokens(text)), True))
+
+        pieces = _split_tokens(text)
+        if sse:
+            self._start_sse()
+            for index, piece in enumerate(self._paced_tokens(text)):
+                self._send_event(response(piece, index == len(pieces) - 1))
+            return
+
+        # Without alt=sse the stream is one JSON array, written element by element
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b"[")
+        for index, piece in enumerate(self._paced_tokens(text)):
+            if index:
+                self.wfile.write(b",\r\n")
+            self.wfile.write(json.dumps(response(piece, index == len(pieces) - 1)).encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"]")
+
+    def _get_location(self, project: str, region: str) -> None:
+        """Vertex AI location metadata, used to probe a region's latency."""
+        self.state.count("locations")
+        if self.state.region_down(region):
+            return self._send_json(503, {"error": {"code": 503, "message": f"Region {region} unavailable (injected by stub server)",
+                                                   "status": "UNAVAILABLE"}})
+        time.sleep(self.state.region_delay(region))
+        self._send_json(200, {
+            "name": f"projects/{project}/locations/{region}",
+            "locationId": region,
+            "displayName": region,
+        })
+
+    def _create_cached_content(self, path: str, body: Dict[str, Any]) -> None:
+        """Explicit context caches for the Gemini API and Vertex AI."""
+        self.state.count("cached_contents")
+        tokens = sum(
+            _estimate_tokens(part.get("text", ""))
+            for content in body.get("contents") or []
+            for part in content.get("parts", [])
+        )
+        name = f"{path.split('/', 2)[2]}/{uuid.uuid4().hex[:16]}"
+        with self.state.lock:
+            self.state.objects[("cachedContents", name)] = {"tokens": tokens}
+        expire = time.gmtime(time.time() + float(str(body.get("ttl", "600s")).rstrip("s") or 600))
+        self._send_json(200, {
+            "name": name,
+            "model": body.get("model"),
+            "createTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "expireTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", expire),
+            "usageMetadata": {"totalTokenCount": tokens},
+        })
+
+
+def start_stub_server(host: str = "127.0.0.1", port: int = 0, config: Optional[MockConfig] = None) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Start the stand-in server on a background thread.
+
+    Args:
+        host: Interface to bind
+        port: Port to bind (0 picks a free port)
+        config: Mock endpoint behaviour (defaults to MOCK_* environment variables)
+
+    Returns:
+        Tuple of (server, base_url). Call server.shutdown() to stop it.
+        The shared StubState is available as server.state.
+    """
+    state = StubState(config or MockConfig.from_env())
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    thread = threading.Thread(target=server.serve_forever, name="stub-server", daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in server for offline testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], help="Time-to-first-byte distribution")
+    parser.add_argument("--latency-ms", type=float, help="Mean (fixed/uniform) or median (lognormal) latency")
+    parser.add_argument("--tokens-per-second", type=float, help="Output token rate (0 for no pacing)")
+    parser.add_argument("--error-429-rate", type=float, help="Fraction of requests answered with 429")
+    parser.add_argument("--error-5xx-rate", type=float, help="Fraction of requests answered with 503")
+    parser.add_argument("--timeout-rate", type=float, help="Fraction of requests that hang and are dropped")
+    parser.add_argument("--responses", help="JSON or JSONL file of scripted responses (default: echo)")
+    parser.add_argument("--seed", type=int, help="Random seed for latency and fault injection")
+    args = parser.parse_args()
+
+    config = MockConfig.from_env()
+    config.update({
+        field: getattr(args, field)
+        for field in ("latency", "latency_ms", "tokens_per_second", "error_429_rate",
+                      "error_5xx_rate", "timeout_rate", "seed")
+        if getattr(args, field) is not None
+    })
+    if args.responses:
+        config.update({"responses": load_responses(args.responses)})
+
+    handler = type("BoundStubHandler", (StubHandler,), {"state": StubState(config)})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print(f"Stub server listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
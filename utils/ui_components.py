@@ -135,4 +135,86 @@ def create_tooltip_html(message: str, position: str = "top") -> str:
     <div class="tooltip">
         <span class="tooltiptext tooltip-{position}">{message}</span>
     </div>
-    """
\ No newline at end of file
+    """
+
+def render_fanout_panel(run, on_pick: Callable[[str, str], None]) -> None:
+    """
+    Render side-by-side panes for a multi-model fan-out
+    
+    Args:
+        run: The FanOutRun being displayed
+        on_pick: Callback receiving (model_option, response) when a winner is picked
+    """
+    st.markdown(f"""
+    <div style="margin: 10px 0; color: #4285f4;">
+        <strong>Comparing {len(run.model_options)} models</strong>
+        <span style="color: #888; margin-left: 10px;">{run.elapsed():.1f}s elapsed</span>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    panes = st.columns(len(run.model_options))
+    for pane, option in zip(panes, run.model_options):
+        result = run.results[option]
+        with pane:
+            st.markdown(f"**{option}**")
+            
+            if result["status"] in ("pending", "running"):
+                if result["response"]:
+                    # Partial answer, still streaming
+                    st.markdown(result["response"] + " ▌")
+                else:
+                    st.info("Waiting for response...")
+            elif result["status"] == "cancelled":
+                st.caption("Cancelled")
+            else:
+                if result["status"] == "error":
+                    st.error(result["response"])
+                else:
+                    st.markdown(result["response"])
+                
+                # Per-model latency and token stats
+                st.caption(
+                    f"{result['latency']:.2f}s · {result['prompt_tokens']} prompt tokens · "
+                    f"~{result['output_tokens']} output tokens"
+                )
+                
+                if result["status"] == "done" and st.button("Use this answer", key=f"fanout_pick_{option}", use_container_width=True):
+                    on_pick(option, run.pick(option))
+
+
+def render_provider_health(health: Dict[str, Dict[str, Any]], rate_limits: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+    """
+    Render circuit breaker state and call statistics for each provider
+    
+    Args:
+        health: Provider health snapshot from get_provider_health()
+        rate_limits: Optional limiter snapshot from get_rate_limit_stats()
+    """
+    # Client-side rate limiter queues, keyed by provider and key fingerprint
+    for limiter_key, stats in sorted((rate_limits or {}).items()):
+        st.caption(
+            f"{limiter_key} queue: {stats['queue_depth']} waiting · "
+            f"{stats['avg_wait']:.2f}s avg wait · {stats['last_wait']:.2f}s last · {stats['timeouts']} timeouts"
+        )
+    
+    if not health:
+        st.caption("No provider calls yet.")
+        return
+    
+    state_colors = {"closed": "#4CAF50", "half_open": "#FFC107", "open": "#FF5252"}
+    for provider, stats in sorted(health.items()):
+        color = state_colors.get(stats["state"], "#888888")
+        latency = f"{stats['avg_latency']:.2f}s avg" if stats["avg_latency"] is not None else "no latency yet"
+        st.markdown(f"""
+        <div style="margin-bottom: 8px;">
+            <span style="color: {color};">●</span>
+            <strong>{provider}</strong> <span style="color: #888;">{stats['state'].replace('_', '-')}</span><br>
+            <span style="font-size: 0.85rem; color: #aaa;">
+                {stats['successes']}/{stats['calls']} ok · {stats['retries']} retries · {stats['rejected']} rejected · {latency}
+            </span>
+        </div>
+        """, unsafe_allow_html=True)
+        if stats["state"] == "open":
+            st.caption(f"Retrying in {stats['retry_in']:.0f}s")
+        if stats["last_error"]:
+            st.caption(f"Last error: {stats['last_error'][:200]}")
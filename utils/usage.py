@@ -0,0 +1,483 @@
+"""
+Token usage and cost metering
+
+Every usage record reported by a provider call (see call_context.report_usage)
+becomes one row in an append-only usage_events table: who, which
+conversation, provider, model, tokens, latency and the estimated cost from
+the price table. Rows are buffered and written in batches by a background
+thread, to PostgreSQL when DATABASE_URL is set and to a JSONL file
+otherwise (or when the database is unreachable).
+
+Aggregates by user, model, provider, conversation and day come from
+query_usage() or the command line:
+    python -m utils.usage --by user,day --since 2024-11-01
+
+Per-user daily budgets (USER_DAILY_BUDGET_USD, with overrides in
+USER_BUDGETS as JSON) are enforced before each model call. With the JSONL
+store, today's spend is read incrementally: only lines appended since the
+last read are parsed.
+"""
+import os
+import sys
+import json
+import atexit
+import argparse
+import datetime
+import threading
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Tuple
+
+from utils.resilience import ProviderError
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+USAGE_LOG_PATH = os.environ.get("USAGE_LOG_PATH", os.path.join(DATA_DIR, "usage_events.jsonl"))
+USAGE_BATCH_SIZE = int(os.environ.get("USAGE_BATCH_SIZE", "100"))
+USAGE_FLUSH_SECONDS = float(os.environ.get("USAGE_FLUSH_SECONDS", "5"))
+
+# Daily spend cap per user in USD (0 = no cap)
+USER_DAILY_BUDGET_USD = float(os.environ.get("USER_DAILY_BUDGET_USD", "0"))
+USER_BUDGETS: Dict[str, float] = json.loads(os.environ["USER_BUDGETS"]) if os.environ.get("USER_BUDGETS") else {}
+
+# Columns rows can be grouped by, and their SQL expressions
+GROUP_COLUMNS = {
+    "user": "user_id",
+    "conversation": "conversation_id",
+    "provider": "provider",
+    "model": "model",
+    "day": "CAST(at AT TIME ZONE 'UTC' AS DATE)",
+}
+
+_pending: List[Dict[str, Any]] = []
+_pending_lock = threading.Condition()
+_write_lock = threading.Lock()
+_writer: Optional[threading.Thread] = None
+_table_ready = False
+
+# Today's spend per user, seeded from the store on first use
+_spend: Dict[Tuple[str, str], float] = {}
+_spend_lock = threading.Lock()
+
+# Today's spend per user in the JSONL file, and how far the file has been read
+_log_lock = threading.Lock()
+_log_path: Optional[str] = None
+_log_offset = 0
+_log_day: Optional[str] = None
+_log_spend: Dict[str, float] = {}
+
+
+class BudgetExceededError(ProviderError):
+    """The user has spent their daily budget. Never retried."""
+
+
+def _today() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+
+def _db_url() -> Optional[str]:
+    return os.environ.get("POSTGRESQL_URL") or os.environ.get("DATABASE_URL")
+
+
+def _connect():
+    """Open a PostgreSQL connection, creating the usage table on first use."""
+    global _table_ready
+    import psycopg2
+
+    conn = psycopg2.connect(_db_url())
+    if not _table_ready:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS usage_events (
+                    id BIGSERIAL PRIMARY KEY,
+                    at TIMESTAMPTZ NOT NULL,
+                    user_id TEXT,
+                    conversation_id TEXT,
+                    provider TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    input_tokens INTEGER NOT NULL,
+                    output_tokens INTEGER NOT NULL,
+                    cached_tokens INTEGER NOT NULL,
+                    cache_write_tokens INTEGER NOT NULL,
+                    latency DOUBLE PRECISION,
+                    cost DOUBLE PRECISION NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS usage_events_user_at ON usage_events (user_id, at)")
+        conn.commit()
+        _table_ready = True
+    return conn
+
+
+def _write_postgres(events: List[Dict[str, Any]]) -> None:
+    from psycopg2.extras import execute_values
+
+    conn = _connect()
+    try:
+        with conn.cursor() as cursor:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO usage_events
+                (at, user_id, conversation_id, provider, model, input_tokens, output_tokens,
+                 cached_tokens, cache_write_tokens, latency, cost)
+                VALUES %s
+                """,
+                [
+                    (
+                        event["at"], event["user"], event["conversation_id"], event["provider"], event["model"],
+                        event["input_tokens"], event["output_tokens"], event["cached_tokens"],
+                        event["cache_write_tokens"], event["latency"], event["cost"],
+                    )
+                    for event in events
+                ]
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _write_jsonl(events: List[Dict[str, Any]]) -> None:
+    directory = os.path.dirname(USAGE_LOG_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(USAGE_LOG_PATH, "a", encoding="utf-8") as f:
+        for event in events:
+            f.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+
+def _write(events: List[Dict[str, Any]]) -> None:
+    """Append one batch to the store."""
+    with _write_lock:
+        if _db_url():
+            try:
+                _write_postgres(events)
+                return
+            except Exception as e:
+                # Keep the records rather than lose them
+                print(f"Usage store unavailable, writing to {USAGE_LOG_PATH}: {e}", file=sys.stderr)
+        _write_jsonl(events)
+
+
+def _take_batch() -> List[Dict[str, Any]]:
+    with _pending_lock:
+        batch = list(_pending)
+        _pending.clear()
+    return batch
+
+
+def _run_writer() -> None:
+    """Background loop: write a batch when it fills up or every USAGE_FLUSH_SECONDS."""
+    while True:
+        with _pending_lock:
+            if len(_pending) < USAGE_BATCH_SIZE:
+                _pending_lock.wait(timeout=USAGE_FLUSH_SECONDS)
+        batch = _take_batch()
+        if batch:
+            try:
+                _write(batch)
+            except Exception as e:
+                print(f"Failed to write {len(batch)} usage records: {e}", file=sys.stderr)
+
+
+def flush_usage() -> None:
+    """Write every buffered usage record now."""
+    batch = _take_batch()
+    if batch:
+        _write(batch)
+
+
+atexit.register(flush_usage)
+
+
+def record_usage_event(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Queue one usage record for the store and count it towards the user's spend.
+
+    Args:
+        record: Usage record from report_usage (with its "cost")
+
+    Returns:
+        The stored event
+    """
+    global _writer
+    event = {
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "user": record.get("user"),
+        "conversation_id": record.get("conversation_id"),
+        "provider": record["provider"],
+        "model": record["model"],
+        "input_tokens": record["input_tokens"],
+        "output_tokens": record["output_tokens"],
+        "cached_tokens": record["cached_tokens"],
+        "cache_write_tokens": record["cache_write_tokens"],
+        "latency": record.get("latency"),
+        "cost": record.get("cost") or 0.0,
+    }
+    if event["user"]:
+        key = (event["user"], event["at"][:10])
+        with _spend_lock:
+            if key in _spend:
+                _spend[key] += event["cost"]
+
+    with _pending_lock:
+        _pending.append(event)
+        if _writer is None:
+            _writer = threading.Thread(target=_run_writer, name="usage-writer", daemon=True)
+            _writer.start()
+        if len(_pending) >= USAGE_BATCH_SIZE:
+            _pending_lock.notify()
+    return event
+
+
+def _read_jsonl() -> List[Dict[str, Any]]:
+    if not os.path.exists(USAGE_LOG_PATH):
+        return []
+    events = []
+    with open(USAGE_LOG_PATH, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                events.append(json.loads(line))
+    return events
+
+
+def query_usage(group_by: Optional[List[str]] = None, since: Optional[str] = None, until: Optional[str] = None, user: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Aggregate usage events.
+
+    Args:
+        group_by: Any of "user", "conversation", "provider", "model" and "day"
+            (defaults to user, model and day)
+        since: First day to include (YYYY-MM-DD, UTC)
+        until: Last day to include (YYYY-MM-DD, UTC)
+        user: Only this user's events
+
+    Returns:
+        One dict per group with the group columns plus calls, token totals,
+        cost and avg_latency, most expensive first
+
+    Raises:
+        ValueError: If a group column is unknown
+    """
+    group_by = group_by or ["user", "model", "day"]
+    unknown = [column for column in group_by if column not in GROUP_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown usage group column(s): {', '.join(unknown)}")
+    flush_usage()
+
+    if _db_url():
+        try:
+            return _query_postgres(group_by, since, until, user)
+        except Exception as e:
+            print(f"Usage store unavailable, reading {USAGE_LOG_PATH}: {e}", file=sys.stderr)
+
+    groups: Dict[tuple, Dict[str, Any]] = {}
+    for event in _read_jsonl():
+        day = event["at"][:10]
+        if (since and day < since) or (until and day > until) or (user and event["user"] != user):
+            continue
+        values = {"user": event["user"], "conversation": event["conversation_id"], "provider": event["provider"], "model": event["model"], "day": day}
+        key = tuple(values[column] for column in group_by)
+        group = groups.setdefault(key, dict(
+            {column: values[column] for column in group_by},
+            calls=0, input_tokens=0, output_tokens=0, cached_tokens=0, cost=0.0, _latency=[]
+        ))
+        group["calls"] += 1
+        group["input_tokens"] += event["input_tokens"]
+        group["output_tokens"] += event["output_tokens"]
+        group["cached_tokens"] += event["cached_tokens"]
+        group["cost"] += event["cost"]
+        if event.get("latency") is not None:
+            group["_latency"].append(event["latency"])
+
+    rows = []
+    for group in groups.values():
+        latencies = group.pop("_latency")
+        group["avg_latency"] = sum(latencies) / len(latencies) if latencies else None
+        rows.append(group)
+    return sorted(rows, key=lambda row: row["cost"], reverse=True)
+
+
+def _query_postgres(group_by: List[str], since: Optional[str], until: Optional[str], user: Optional[str]) -> List[Dict[str, Any]]:
+    columns = [f"{GROUP_COLUMNS[column]} AS {column}" for column in group_by]
+    conditions, params = [], []
+    if since:
+        conditions.append(f"{GROUP_COLUMNS['day']} >= %s")
+        params.append(since)
+    if until:
+        conditions.append(f"{GROUP_COLUMNS['day']} <= %s")
+        params.append(until)
+    if user:
+        conditions.append("user_id = %s")
+        params.append(user)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = f"""
+        SELECT {', '.join(columns)}, COUNT(*), SUM(input_tokens), SUM(output_tokens),
+               SUM(cached_tokens), SUM(cost), AVG(latency)
+        FROM usage_events {where}
+        GROUP BY {', '.join(str(i + 1) for i in range(len(group_by)))}
+        ORDER BY SUM(cost) DESC
+    """
+    conn = _connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    results = []
+    for row in rows:
+        result = {column: (value.isoformat() if isinstance(value, datetime.date) else value) for column, value in zip(group_by, row)}
+        calls, input_tokens, output_tokens, cached_tokens, cost, avg_latency = row[len(group_by):]
+        result.update(
+            calls=calls,
+            input_tokens=int(input_tokens or 0),
+            output_tokens=int(output_tokens or 0),
+            cached_tokens=int(cached_tokens or 0),
+            cost=float(cost or 0.0),
+            avg_latency=float(avg_latency) if avg_latency is not None else None,
+        )
+        results.append(result)
+    return results
+
+
+def _jsonl_day_spend(day: str) -> Dict[str, float]:
+    """
+    Spend per user on one day in the JSONL file.
+
+    Lines are parsed once: each call reads only what was appended since the
+    previous one (the whole file again if it was replaced or truncated).
+
+    Args:
+        day: The day (YYYY-MM-DD, UTC), normally today
+
+    Returns:
+        Dict of user to spend in USD
+    """
+    global _log_path, _log_offset, _log_day, _log_spend
+    with _log_lock:
+        try:
+            size = os.path.getsize(USAGE_LOG_PATH)
+        except OSError:
+            size = 0
+        if _log_path != USAGE_LOG_PATH or size < _log_offset:
+            _log_path, _log_offset, _log_day, _log_spend = USAGE_LOG_PATH, 0, None, {}
+        if _log_day != day:
+            # Rows are appended in time order, so the new day starts from here
+            if _log_day is not None and day < _log_day:
+                _log_offset = 0
+            _log_day, _log_spend = day, {}
+        if size > _log_offset:
+            with open(USAGE_LOG_PATH, "rb") as f:
+                f.seek(_log_offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Still being written; read it next time
+                        break
+                    _log_offset += len(line)
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event["at"][:10] == day and event["user"]:
+                        _log_spend[event["user"]] = _log_spend.get(event["user"], 0.0) + event["cost"]
+        return dict(_log_spend)
+
+
+def _stored_spend(user: str, day: str) -> float:
+    """A user's spend on one day in the store."""
+    if _db_url():
+        try:
+            rows = _query_postgres(["user"], day, day, user)
+            return rows[0]["cost"] if rows else 0.0
+        except Exception as e:
+            print(f"Usage store unavailable, reading {USAGE_LOG_PATH}: {e}", file=sys.stderr)
+    return _jsonl_day_spend(day).get(user, 0.0)
+
+
+def get_user_spend(user: str) -> float:
+    """
+    What a user has spent today (UTC), including records not yet written.
+
+    Args:
+        user: The user's username
+
+    Returns:
+        Spend in USD
+    """
+    key = (user, _today())
+    with _spend_lock:
+        if key in _spend:
+            return _spend[key]
+    flush_usage()
+    spent = _stored_spend(user, key[1])
+    with _spend_lock:
+        # Records that arrived while reading were flushed first, so they are included
+        _spend.setdefault(key, spent)
+        return _spend[key]
+
+
+def get_user_budget(user: Optional[str]) -> Optional[float]:
+    """
+    A user's daily budget.
+
+    Args:
+        user: The user's username
+
+    Returns:
+        Budget in USD, or None if the user has no cap
+    """
+    budget = USER_BUDGETS.get(user, USER_DAILY_BUDGET_USD) if user else USER_DAILY_BUDGET_USD
+    return float(budget) if budget else None
+
+
+def check_budget(user: Optional[str]) -> None:
+    """
+    Refuse a call once the user has spent their daily budget.
+
+    Args:
+        user: The user's username (None skips the check)
+
+    Raises:
+        BudgetExceededError: If today's spend has reached the budget
+    """
+    budget = get_user_budget(user)
+    if not user or budget is None:
+        return
+    spent = get_user_spend(user)
+    if spent >= budget:
+        raise BudgetExceededError(
+            "budget",
+            f"Daily budget of ${budget:.2f} reached (spent ${spent:.2f}). It resets at midnight UTC."
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Summarize recorded token usage and cost.")
+    parser.add_argument("--by", default="user,model,day", help="Comma-separated group columns: " + ", ".join(GROUP_COLUMNS))
+    parser.add_argument("--since", help="First day (YYYY-MM-DD)")
+    parser.add_argument("--until", help="Last day (YYYY-MM-DD)")
+    parser.add_argument("--user", help="Only this user")
+    parser.add_argument("--json", action="store_true", help="Print JSON rows instead of a table")
+    args = parser.parse_args(argv)
+
+    rows = query_usage([column.strip() for column in args.by.split(",") if column.strip()], args.since, args.until, args.user)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return 0
+
+    group_by = [column.strip() for column in args.by.split(",") if column.strip()]
+    widths = {column: max([len(column)] + [len(str(row[column])) for row in rows]) for column in group_by}
+    header = "  ".join(column.ljust(widths[column]) for column in group_by)
+    print(f"{header}  {'calls':>6}  {'input':>10}  {'output':>10}  {'cached':>10}  {'cost $':>10}")
+    totals = defaultdict(float)
+    for row in rows:
+        line = "  ".join(str(row[column]).ljust(widths[column]) for column in group_by)
+        print(f"{line}  {row['calls']:>6}  {row['input_tokens']:>10}  {row['output_tokens']:>10}  {row['cached_tokens']:>10}  {row['cost']:>10.4f}")
+        for field in ("calls", "input_tokens", "output_tokens", "cached_tokens", "cost"):
+            totals[field] += row[field]
+    print(f"{'total'.ljust(len(header))}  {int(totals['calls']):>6}  {int(totals['input_tokens']):>10}  "
+          f"{int(totals['output_tokens']):>10}  {int(totals['cached_tokens']):>10}  {totals['cost']:>10.4f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
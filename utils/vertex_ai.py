@@ -2,34 +2,186 @@
 Vertex AI integration for models using service account authentication
 """
 import os
-import json
+import time
+import threading
+import itertools
+from datetime import datetime
 from google import genai
 from google.genai import types
-import base64
+from utils.resilience import with_resilience, classify_error, ProviderConfigError
+from utils.rate_limit import rate_limited
+from utils.cassettes import cassette
+from utils.single_flight import single_flight
+from utils.images import prepare_image
+from utils.media_cache import media_refs_enabled, get_media_ref, forget_media_refs
+from utils.call_context import current_conversation_id, report_usage
+from utils.history_cache import format_history
+from utils.context import estimate_tokens, get_context_tokens
+from utils.prompt_cache import get_cached_prefix, GEMINI_CACHE_TTL_SECONDS
+from utils.streaming import metered_stream
+from utils.endpoints import mock_server_url, get_base_url, MOCK_API_KEY, MOCK_PROJECT
+# Region for Vertex AI calls when none is given; calls pick one of VERTEX_LOCATIONS
+from utils.vertex_regions import VERTEX_LOCATION, call_in_regions
 
-def initialize_vertex_ai(service_account_path="service-account-key.json"):
+# Path to the service account key, read once per process
+SERVICE_ACCOUNT_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS", "service-account-key.json")
+
+# Refresh the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN_SECONDS = float(os.environ.get("VERTEX_TOKEN_REFRESH_MARGIN", "300"))
+
+# Longest a caller waits for another thread's refresh when its own token has expired
+TOKEN_REFRESH_WAIT_SECONDS = 30
+
+_credentials = None
+_credentials_path = None
+_clients = {}
+_auth_lock = threading.Lock()
+# Signalled when a token refresh finishes; only one thread refreshes at a time
+_auth_refreshed = threading.Condition(_auth_lock)
+_refreshing = False
+_auth_stats = {
+    "credentials_load_seconds": None,
+    "client_init_seconds": {},
+    "refresh_count": 0,
+    "last_refresh_seconds": None,
+    "last_refresh_at": None,
+    "token_expiry": None,
+}
+
+
+def _token_seconds_left(credentials) -> float:
+    """Seconds until the access token expires (0 without a token, infinite without an expiry)."""
+    if not credentials.token:
+        return 0.0
+    if credentials.expiry is None:
+        return float("inf")
+    return (credentials.expiry - datetime.utcnow()).total_seconds()
+
+
+def _refresh_if_needed(credentials) -> None:
+    """
+    Refresh the access token if it is missing or about to expire.
+
+    The network round trip runs outside _auth_lock, so other calls are not
+    blocked behind it. Only one thread refreshes at a time; the others keep
+    using the current token while it is still valid, or wait for the new one.
+    """
+    global _refreshing
+    from google.auth.transport.requests import Request
+    
+    with _auth_lock:
+        if _token_seconds_left(credentials) > TOKEN_REFRESH_MARGIN_SECONDS:
+            return
+        if _refreshing:
+            _auth_refreshed.wait_for(
+                lambda: not _refreshing or _token_seconds_left(credentials) > 0,
+                timeout=TOKEN_REFRESH_WAIT_SECONDS
+            )
+            return
+        _refreshing = True
+    
+    start = time.time()
+    try:
+        credentials.refresh(Request())
+    finally:
+        with _auth_lock:
+            _refreshing = False
+            _auth_refreshed.notify_all()
+    
+    with _auth_lock:
+        _auth_stats["refresh_count"] += 1
+        _auth_stats["last_refresh_seconds"] = time.time() - start
+        _auth_stats["last_refresh_at"] = time.time()
+        _auth_stats["token_expiry"] = credentials.expiry.isoformat() if credentials.expiry else None
+
+
+def get_vertex_credentials(service_account_path=None):
     """
-    Initialize Vertex AI with service account credentials
+    Get the service account credentials, loading them once and refreshing the token early
     
     Args:
         service_account_path: Path to the service account JSON key file
+        
+    Returns:
+        google.oauth2 service account credentials with a valid token
     """
-    # Read service account file
+    global _credentials, _credentials_path
+    from google.oauth2 import service_account
+    
+    # The stand-in server accepts any bearer token, so use a static one that never needs refreshing
+    if mock_server_url():
+        from google.oauth2.credentials import Credentials
+        return Credentials(token=MOCK_API_KEY)
+    
+    path = service_account_path or SERVICE_ACCOUNT_PATH
+    with _auth_lock:
+        if _credentials is None or _credentials_path != path:
+            start = time.time()
+            _credentials = service_account.Credentials.from_service_account_file(
+                path,
+                scopes=["https://www.googleapis.com/auth/cloud-platform"]
+            )
+            _credentials_path = path
+            _clients.clear()
+            _auth_stats["credentials_load_seconds"] = time.time() - start
+        credentials = _credentials
+    _refresh_if_needed(credentials)
+    return credentials
+
+
+def get_vertex_auth_stats() -> dict:
+    """
+    Get timing for credential loading, client setup and token refreshes
+    
+    Returns:
+        Dictionary of auth statistics
+    """
+    with _auth_lock:
+        stats = dict(_auth_stats)
+        stats["client_init_seconds"] = dict(_auth_stats["client_init_seconds"])
+        stats["cached_clients"] = list(_clients)
+        return stats
+
+
+def initialize_vertex_ai(service_account_path=None, location=None):
+    """
+    Get a Vertex AI client, creating it once per region and reusing it afterwards
+    
+    Args:
+        service_account_path: Path to the service account JSON key file
+        location: Vertex AI region (defaults to VERTEX_LOCATION)
+        
+    Returns:
+        A genai.Client for Vertex AI, or None if it could not be created
+    """
+    location = location or VERTEX_LOCATION
     try:
-        with open(service_account_path, 'r') as f:
-            service_account_info = json.load(f)
-            
-        # Initialize client with Vertex AI and project details
-        client = genai.Client(
-            vertexai=True,
-            project=service_account_info["project_id"],
-            location="us-central1",
-        )
+        # Also refreshes the shared token when it is close to expiry
+        credentials = get_vertex_credentials(service_account_path)
+        
+        with _auth_lock:
+            client = _clients.get(location)
+            if client is None:
+                start = time.time()
+                base_url = get_base_url("vertex")
+                client = genai.Client(
+                    vertexai=True,
+                    project=getattr(credentials, "project_id", None) or MOCK_PROJECT,
+                    location=location,
+                    credentials=credentials,
+                    http_options=types.HttpOptions(base_url=base_url) if base_url else None,
+                )
+                _clients[location] = client
+                _auth_stats["client_init_seconds"][location] = time.time() - start
         return client
     except Exception as e:
         print(f"Error initializing Vertex AI: {e}")
         return None
 
+@single_flight("vertex")
+@cassette("vertex")
+@with_resilience("vertex")
+@rate_limited("vertex")
 def get_vertex_gemini_response(prompt: str, message_history: list, temperature=0.7, model_name="gemini-2.5-pro-preview-03-25", image_data=None):
     """
     Get response from Gemini model using Vertex AI
@@ -45,56 +197,119 @@ def get_vertex_gemini_response(prompt: str, message_history: list, temperature=0
         Generated response text
     """
     try:
-        client = initialize_vertex_ai()
-        if not client:
-            return "Error initializing Vertex AI client"
+        # Upload each image once and send only its reference on later turns
+        use_media_refs = media_refs_enabled()
         
-        # Format conversation history for Vertex AI
-        contents = []
+        def image_part(image_b64, message=None):
+            if use_media_refs:
+                ref = get_media_ref(image_b64, message)
+                return types.Part.from_uri(file_uri=ref["uri"], mime_type=ref["mime_type"])
+            image = prepare_image(image_b64, "vertex")
+            return types.Part.from_bytes(data=image.data, mime_type=image.mime_type)
         
-        # Add conversation history
-        for msg in message_history:
+        def history_content(msg):
             if msg["role"] == "user":
                 # For user messages
                 parts = [types.Part.from_text(text=msg["content"])]
                 
                 # Add image if it exists in this message
                 if "image" in msg and msg["image"]:
-                    image_bytes = base64.b64decode(msg["image"])
-                    parts.append(types.Part.from_data(data=image_bytes, mime_type="image/jpeg"))
+                    parts.append(image_part(msg["image"], msg))
                     
-                contents.append(types.Content(role="user", parts=parts))
-            else:
-                # For assistant messages
-                contents.append(types.Content(
-                    role="model",
-                    parts=[types.Part.from_text(text=msg["content"])]
-                ))
+                return types.Content(role="user", parts=parts)
+            # For assistant messages
+            return types.Content(
+                role="model",
+                parts=[types.Part.from_text(text=msg["content"])]
+            )
         
-        # Add current prompt
-        parts = [types.Part.from_text(text=prompt)]
+        def build_contents():
+            if use_media_refs:
+                # Renew expired references first; a renewed reference invalidates that message's cached conversion
+                for msg in message_history:
+                    if msg.get("image"):
+                        get_media_ref(msg["image"], msg)
+            
+            # Format conversation history for Vertex AI, converting only messages not seen before
+            # (inline image bytes are converted each time rather than kept in the cache)
+            contents = list(format_history(
+                "vertex-refs" if use_media_refs else "vertex",
+                message_history,
+                history_content,
+                cache_if=None if use_media_refs else lambda msg: not msg.get("image")
+            ))
+            
+            # Add current prompt
+            parts = [types.Part.from_text(text=prompt)]
+            
+            # Add image data if provided
+            if image_data:
+                parts.append(image_part(image_data))
+                
+            contents.append(types.Content(role="user", parts=parts))
+            return contents
+        
+        conversation_id = current_conversation_id()
         
-        # Add image data if provided
-        if image_data:
-            image_bytes = base64.b64decode(image_data)
-            parts.append(types.Part.from_data(data=image_bytes, mime_type="image/jpeg"))
+        def generate(client, region):
+            contents = build_contents()
             
-        contents.append(types.Content(role="user", parts=parts))
-        
-        # Configure generation parameters
-        generate_content_config = types.GenerateContentConfig(
-            temperature=temperature,
-            top_p=0.8,
-            max_output_tokens=1024,
-            response_modalities=["TEXT"],
-        )
+            # Serve the stable prefix of long conversations from cached content
+            def create_cache(count):
+                return client.caches.create(
+                    model=model_name,
+                    config=types.CreateCachedContentConfig(
+                        contents=contents[:count],
+                        ttl=f"{GEMINI_CACHE_TTL_SECONDS}s"
+                    )
+                )
+            
+            # Cached contents live in one region, so each region keeps its own
+            cache, covered = get_cached_prefix(conversation_id, f"vertex:{region}", model_name, message_history, create_cache)
+            
+            # Configure generation parameters
+            generate_content_config = types.GenerateContentConfig(
+                temperature=temperature,
+                top_p=0.8,
+                max_output_tokens=1024,
+                response_modalities=["TEXT"],
+                cached_content=cache.name if cache else None,
+            )
+            
+            return client.models.generate_content(
+                model=model_name,
+                contents=contents[covered:],
+                config=generate_content_config
+            )
         
-        # Generate content
-        response = client.models.generate_content(
-            model=model_name,
-            contents=contents,
-            generation_config=generate_content_config
-        )
+        def generate_in(region):
+            client = initialize_vertex_ai(location=region)
+            if not client:
+                raise ProviderConfigError("vertex", "Error initializing Vertex AI client")
+            try:
+                return generate(client, region)
+            except Exception as e:
+                # A referenced object may have been removed by the bucket's lifecycle rule
+                missing_media = getattr(e, "code", None) in (400, 404) and "gs://" in str(e)
+                if not (use_media_refs and missing_media):
+                    raise
+                forget_media_refs(message_history)
+                return generate(client, region)
+        
+        # Generate content in the fastest healthy region, failing over on regional errors
+        start = time.time()
+        response = call_in_regions(generate_in)
+        
+        usage = response.usage_metadata
+        if usage:
+            report_usage(
+                "vertex",
+                model_name,
+                input_tokens=usage.prompt_token_count or 0,
+                output_tokens=usage.candidates_token_count or 0,
+                cached_tokens=usage.cached_content_token_count or 0,
+                latency=time.time() - start
+            )
         
         # Extract and return text response
         if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
@@ -103,40 +318,39 @@ def get_vertex_gemini_response(prompt: str, message_history: list, temperature=0
             return "No response generated"
     
     except Exception as e:
-        return f"Error with Vertex AI Gemini model: {str(e)}"
+        raise classify_error("vertex", e) from e
 
-def get_vertex_live_response(prompt: str, message_history: list, model_name="gemini-2.0-flash-live-preview-04-09"):
+@single_flight("vertex")
+@cassette("vertex")
+@with_resilience("vertex")
+@rate_limited("vertex")
+def stream_vertex_live_response(prompt: str, message_history: list, model_name="gemini-2.0-flash-live-preview-04-09", temperature=0.7, cancel_event=None):
     """
-    Get response from Gemini model using Vertex AI Live API
+    Stream a response from a Gemini model using Vertex AI, chunk by chunk
+    
+    Closing the generator (or setting cancel_event) stops reading and
+    releases the upstream connection.
     
     Args:
         prompt: User's text prompt
         message_history: Previous conversation history
         model_name: Specific Gemini model name
+        temperature: Generation temperature (0.0-1.0)
+        cancel_event: Optional threading.Event that stops the stream when set
         
-    Returns:
-        Generated response text
+    Yields:
+        Response text chunks as they arrive
     """
     try:
-        client = initialize_vertex_ai()
-        if not client:
-            return "Error initializing Vertex AI client"
-        
-        # Format conversation history for Vertex AI
-        contents = []
-        
-        # Add conversation history
-        for msg in message_history:
-            if msg["role"] == "user":
-                contents.append(types.Content(
-                    role="user",
-                    parts=[types.Part.from_text(text=msg["content"])]
-                ))
-            else:
-                contents.append(types.Content(
-                    role="model",
-                    parts=[types.Part.from_text(text=msg["content"])]
-                ))
+        # Format conversation history for Vertex AI, converting only messages not seen before
+        contents = list(format_history(
+            "vertex-text",
+            message_history,
+            lambda msg: types.Content(
+                role="user" if msg["role"] == "user" else "model",
+                parts=[types.Part.from_text(text=msg["content"])]
+            )
+        ))
         
         # Add current prompt
         contents.append(types.Content(
@@ -144,26 +358,86 @@ def get_vertex_live_response(prompt: str, message_history: list, model_name="gem
             parts=[types.Part.from_text(text=prompt)]
         ))
         
-        # Generate content with streaming for live API
-        response_parts = []
-        for chunk in client.models.generate_content_stream(
-            model=model_name,
-            contents=contents,
-            generation_config=types.GenerateContentConfig(
-                temperature=0.7,
-                top_p=0.8,
-                max_output_tokens=1024,
-                response_modalities=["TEXT"],
+        def open_stream(region):
+            client = initialize_vertex_ai(location=region)
+            if not client:
+                raise ProviderConfigError("vertex", "Error initializing Vertex AI client")
+            response_stream = client.models.generate_content_stream(
+                model=model_name,
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    temperature=temperature,
+                    top_p=0.8,
+                    max_output_tokens=1024,
+                    response_modalities=["TEXT"],
+                )
+            )
+            # Errors surface with the first chunk, while another region can still be tried
+            try:
+                first = next(response_stream, None)
+            except Exception:
+                close = getattr(response_stream, "close", None)
+                if close is not None:
+                    close()
+                raise
+            return response_stream, first
+        
+        start = time.time()
+        
+        # Usage totals arrive on the final chunk
+        usage = {}
+        
+        def text_chunks():
+            # Opened lazily so the stream metrics time the first chunk
+            response_stream, first = call_in_regions(open_stream)
+            try:
+                for chunk in itertools.chain([first] if first is not None else [], response_stream):
+                    if chunk.usage_metadata:
+                        usage["metadata"] = chunk.usage_metadata
+                    if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
+                        for part in chunk.candidates[0].content.parts:
+                            if part.text:
+                                yield part.text
+            finally:
+                close = getattr(response_stream, "close", None)
+                if close is not None:
+                    close()
+        
+        yield from metered_stream(
+            "vertex",
+            model_name,
+            text_chunks(),
+            cancel_event=cancel_event,
+            input_tokens=estimate_tokens(prompt) + get_context_tokens(message_history)
+        )
+        
+        metadata = usage.get("metadata")
+        if metadata:
+            report_usage(
+                "vertex",
+                model_name,
+                input_tokens=metadata.prompt_token_count or 0,
+                output_tokens=metadata.candidates_token_count or 0,
+                cached_tokens=metadata.cached_content_token_count or 0,
+                latency=time.time() - start
             )
-        ):
-            # Collect text chunks
-            if chunk.candidates:
-                for part in chunk.candidates[0].content.parts:
-                    if part.text:
-                        response_parts.append(part.text)
-        
-        # Combine all parts into full response
-        return "".join(response_parts)
     
+    except GeneratorExit:
+        raise
     except Exception as e:
-        return f"Error with Vertex AI Gemini Live model: {str(e)}"
\ No newline at end of file
+        raise classify_error("vertex", e) from e
+
+def get_vertex_live_response(prompt: str, message_history: list, model_name="gemini-2.0-flash-live-preview-04-09"):
+    """
+    Get response from Gemini model using Vertex AI Live API
+    
+    Args:
+        prompt: User's text prompt
+        message_history: Previous conversation history
+        model_name: Specific Gemini model name
+        
+    Returns:
+        Generated response text
+    """
+    # Retries and rate limiting are applied by the streaming call
+    return "".join(stream_vertex_live_response(prompt, message_history, model_name=model_name))
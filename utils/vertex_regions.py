@@ -0,0 +1,279 @@
+"""
+Vertex AI region selection
+
+VERTEX_LOCATIONS lists the regions Vertex AI calls may use, in order of
+preference (default: just VERTEX_LOCATION). With more than one region,
+each is probed in the background every VERTEX_PROBE_INTERVAL_SECONDS with
+a cheap authenticated request for its location metadata, and calls go to
+the healthy region with the lowest smoothed probe latency. The current
+region is kept unless another is faster by VERTEX_REGION_SWITCH_MARGIN,
+so context caches (which are regional) are not thrown away over jitter.
+
+A call that fails with a regional error (5xx, quota 429, timeout) moves on
+to the next region, and the failed region is skipped for
+VERTEX_REGION_COOLDOWN_SECONDS. A failed probe marks a region down until a
+later probe succeeds. Against the stand-in server (AI_MOCK_SERVER_URL),
+per-region latency and outages are set with the stub's region_latency_ms
+and down_regions settings.
+"""
+import os
+import time
+import threading
+from typing import Dict, Any, List, Callable, Optional
+
+import requests
+
+from utils.resilience import classify_error, ProviderError, TransientProviderError
+from utils.endpoints import get_base_url, MOCK_PROJECT
+
+VERTEX_LOCATION = os.environ.get("VERTEX_LOCATION", "us-central1")
+VERTEX_LOCATIONS = [
+    region.strip()
+    for region in os.environ.get("VERTEX_LOCATIONS", VERTEX_LOCATION).split(",")
+    if region.strip()
+] or [VERTEX_LOCATION]
+
+VERTEX_PROBE_INTERVAL_SECONDS = float(os.environ.get("VERTEX_PROBE_INTERVAL_SECONDS", "60"))
+VERTEX_PROBE_TIMEOUT_SECONDS = float(os.environ.get("VERTEX_PROBE_TIMEOUT_SECONDS", "3"))
+VERTEX_REGION_COOLDOWN_SECONDS = float(os.environ.get("VERTEX_REGION_COOLDOWN_SECONDS", "60"))
+VERTEX_REGION_SWITCH_MARGIN = float(os.environ.get("VERTEX_REGION_SWITCH_MARGIN", "0.2"))
+
+# Weight of the newest probe in the smoothed latency
+LATENCY_SMOOTHING = 0.3
+
+_lock = threading.Lock()
+_regions: Dict[str, Dict[str, Any]] = {
+    region: {
+        "latency": None,
+        "last_latency": None,
+        "probe_ok": None,
+        "probed_at": None,
+        "calls": 0,
+        "failures": 0,
+        "down_until": 0.0,
+        "last_error": None,
+    }
+    for region in VERTEX_LOCATIONS
+}
+_chosen: Optional[str] = VERTEX_LOCATIONS[0]
+_probe_state = {"running": False, "last_started": None, "rounds": 0}
+
+
+def probe_region(region: str) -> float:
+    """
+    Time one request for a region's location metadata.
+
+    Args:
+        region: Vertex AI region (e.g. "europe-west4")
+
+    Returns:
+        Round-trip time in seconds
+
+    Raises:
+        ProviderError: If the region did not answer or answered with an error
+    """
+    from utils.vertex_ai import get_vertex_credentials
+
+    try:
+        credentials = get_vertex_credentials()
+        project = getattr(credentials, "project_id", None) or MOCK_PROJECT
+        base_url = get_base_url("vertex") or f"https://{region}-aiplatform.googleapis.com"
+        start = time.monotonic()
+        response = requests.get(
+            f"{base_url}/v1/projects/{project}/locations/{region}",
+            headers={"Authorization": f"Bearer {credentials.token}"},
+            timeout=VERTEX_PROBE_TIMEOUT_SECONDS
+        )
+        latency = time.monotonic() - start
+    except Exception as e:
+        raise classify_error("vertex", e) from e
+    if response.status_code == 429 or response.status_code >= 500:
+        raise TransientProviderError("vertex", f"Region {region} answered {response.status_code}", response.status_code)
+    return latency
+
+
+def probe_regions() -> Dict[str, Any]:
+    """
+    Probe every candidate region at once and record the results.
+
+    Returns:
+        The region stats after the probe (see get_region_stats)
+    """
+    def probe(region):
+        try:
+            latency = probe_region(region)
+        except ProviderError as e:
+            with _lock:
+                _regions[region].update(probe_ok=False, probed_at=time.time(), last_error=str(e))
+            return
+        with _lock:
+            state = _regions[region]
+            previous = state["latency"]
+            state["latency"] = latency if previous is None else (
+                LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * previous
+            )
+            state.update(last_latency=latency, probe_ok=True, probed_at=time.time())
+
+    threads = [
+        threading.Thread(target=probe, args=(region,), name=f"vertex-probe-{region}", daemon=True)
+        for region in VERTEX_LOCATIONS
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with _lock:
+        _probe_state["rounds"] += 1
+        _probe_state["running"] = False
+    return get_region_stats()
+
+
+def _healthy(region: str, now: float) -> bool:
+    """Whether a region passed its last probe and is not cooling down. Caller holds _lock."""
+    state = _regions[region]
+    return state["probe_ok"] is not False and state["down_until"] <= now
+
+
+def _probe_if_stale() -> None:
+    """Start a background probe round when the last one is older than the interval."""
+    if len(VERTEX_LOCATIONS) < 2:
+        return
+    with _lock:
+        last = _probe_state["last_started"]
+        if _probe_state["running"] or (last is not None and time.monotonic() - last < VERTEX_PROBE_INTERVAL_SECONDS):
+            return
+        _probe_state["running"] = True
+        _probe_state["last_started"] = time.monotonic()
+    threading.Thread(target=probe_regions, name="vertex-region-probe", daemon=True).start()
+
+
+def candidate_regions() -> List[str]:
+    """
+    Regions to try for the next call, best first.
+
+    Healthy regions come first, fastest first (unprobed ones after probed
+    ones, in configured order); regions that are down come last, soonest
+    back first, as a last resort.
+
+    Returns:
+        Every configured region, in the order to try them
+    """
+    global _chosen
+    _probe_if_stale()
+    now = time.monotonic()
+    with _lock:
+        def speed(region):
+            latency = _regions[region]["latency"]
+            return (latency is None, latency or 0.0, VERTEX_LOCATIONS.index(region))
+
+        up = sorted([region for region in VERTEX_LOCATIONS if _healthy(region, now)], key=speed)
+        down = sorted(
+            [region for region in VERTEX_LOCATIONS if not _healthy(region, now)],
+            key=lambda region: _regions[region]["down_until"]
+        )
+
+        # Stay in the current region unless the fastest one is clearly faster
+        if up and _chosen in up and _chosen != up[0]:
+            best = _regions[up[0]]["latency"]
+            current = _regions[_chosen]["latency"]
+            if best is None or current is None or current <= best * (1 + VERTEX_REGION_SWITCH_MARGIN):
+                up.remove(_chosen)
+                up.insert(0, _chosen)
+
+        order = up + down
+        _chosen = order[0]
+    return order
+
+
+def is_regional_error(error: ProviderError) -> bool:
+    """
+    Check whether an error is worth retrying in another region.
+
+    Args:
+        error: A classified provider error
+
+    Returns:
+        True for timeouts, connection failures, 5xx and quota errors
+    """
+    return isinstance(error, TransientProviderError)
+
+
+def record_region_result(region: str, error: Optional[ProviderError] = None) -> None:
+    """
+    Record the outcome of a call made in a region.
+
+    Args:
+        region: The region the call went to
+        error: The regional error it failed with, or None on success
+    """
+    with _lock:
+        state = _regions.get(region)
+        if state is None:
+            return
+        state["calls"] += 1
+        if error is None:
+            return
+        state["failures"] += 1
+        state["down_until"] = time.monotonic() + VERTEX_REGION_COOLDOWN_SECONDS
+        state["last_error"] = str(error)
+
+
+def call_in_regions(fn: Callable[[str], Any]) -> Any:
+    """
+    Call fn in the best region, moving on to the next region after a regional error.
+
+    Every healthy region is tried, then the first region that is down as a
+    last resort (so retries do not multiply calls into regions known to be down).
+
+    Args:
+        fn: Callable taking a region and making the call there
+
+    Returns:
+        Whatever fn returned
+    """
+    from utils.call_context import check_cancelled
+
+    regions = candidate_regions()
+    now = time.monotonic()
+    with _lock:
+        up = [region for region in regions if _healthy(region, now)]
+    regions = up + [region for region in regions if region not in up][:1]
+    for index, region in enumerate(regions):
+        check_cancelled("vertex")
+        try:
+            result = fn(region)
+        except Exception as e:
+            error = classify_error("vertex", e)
+            if not is_regional_error(error):
+                raise
+            record_region_result(region, error)
+            if index == len(regions) - 1:
+                raise
+            print(f"Vertex AI region {region} failed, trying {regions[index + 1]}: {error}")
+            continue
+        record_region_result(region)
+        return result
+
+
+def get_region_stats() -> Dict[str, Any]:
+    """
+    The region calls go to and what was observed about every candidate.
+
+    Returns:
+        Dict with "chosen", "probe_rounds" and "regions" (region -> latency_ms,
+        last_latency_ms, healthy, calls, failures, last_error)
+    """
+    now = time.monotonic()
+    with _lock:
+        regions = {}
+        for region in VERTEX_LOCATIONS:
+            state = _regions[region]
+            regions[region] = {
+                "latency_ms": state["latency"] * 1000 if state["latency"] is not None else None,
+                "last_latency_ms": state["last_latency"] * 1000 if state["last_latency"] is not None else None,
+                "healthy": _healthy(region, now),
+                "calls": state["calls"],
+                "failures": state["failures"],
+                "last_error": state["last_error"],
+            }
+        return {"chosen": _chosen, "probe_rounds": _probe_state["rounds"], "regions": regions}